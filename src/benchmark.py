@@ -0,0 +1,308 @@
+"""Benchmarks of the hot paths of the pipeline on synthetic contracts, at several sizes.
+
+Every benchmark is run repeat times per size. The median wall time, the throughput (input rows per second) and the
+peak memory are saved to a results file and compared against the stored baseline: a benchmark that got more than
+BENCHMARK_REGRESSION_THRESHOLD slower (or uses that much more memory) is reported as a regression. Example:
+
+python src/benchmark.py --sizes 10000 100000 --repeat 3
+python src/benchmark.py --sizes 10000 100000 --save-baseline
+
+Note that the expanded train set grows with the number of contracts times the number of monthly peildatums since the
+oldest contract, so expand_rows and peildatum_variables need several GB of memory at 100k contracts and more.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.frozen import FrozenEstimator
+
+from src.columns import (
+    COL_ENDDATE,
+    COL_HOVK_STATUS,
+    COL_LABEL_EVENT,
+    COL_STARTDATE,
+    FEATURE_COLUMNS,
+)
+from src.my_logging import logger
+from src.prepare import DataPreprocessor, create_peildatum_based_variables
+from src.prepare_duckdb import expand_rows_with_variables
+from src.score import score_horizons, split_predict_set
+from src.settings import BENCHMARK_BASELINE_PATH, BENCHMARK_REGRESSION_THRESHOLD
+from src.train import search_hyperparameters
+from src.utils import get_timestamp
+from src.utils.synthetic import fit_synthetic_models, make_synthetic_contracts
+from src.utils.tracing import peak_rss_mb
+
+YEARS_AHEAD = 1
+
+
+def _traindate() -> pd.Timestamp:
+    """First of January YEARS_AHEAD + 1 years ago, so the labels of its test set are known."""
+    return pd.Timestamp(datetime.today().year - YEARS_AHEAD - 1, 1, 1)
+
+
+def _preprocessor(df_combined: pd.DataFrame) -> DataPreprocessor:
+    """DataPreprocessor holding df_combined as prepare() has it just before _expand_rows."""
+    preprocessor = DataPreprocessor(traindate=_traindate(), testdate=_traindate(), years_ahead=YEARS_AHEAD)
+    preprocessor.df = df_combined
+    preprocessor.df.loc[preprocessor.df[COL_HOVK_STATUS] == "Actief", COL_ENDDATE] = pd.NaT
+    return preprocessor
+
+
+def _peildatum_set(df_combined: pd.DataFrame) -> pd.DataFrame:
+    """Contracts active on the traindate, with peildatum based variables (as the test set in prepare)."""
+    traindate = _traindate()
+    df = df_combined.loc[(df_combined[COL_STARTDATE] < traindate) & (df_combined[COL_ENDDATE] > traindate)].copy()
+    df["peildatum"] = traindate
+    return create_peildatum_based_variables(df, years_ahead=YEARS_AHEAD)
+
+
+def bench_expand_rows(n: int, seed: int) -> tuple[Callable, int]:
+    """DataPreprocessor._expand_rows: a row per contract and peildatum."""
+    preprocessor = _preprocessor(make_synthetic_contracts(n, seed=seed))
+    df = preprocessor.df
+
+    def run():
+        preprocessor.df = df
+        preprocessor._expand_rows()
+
+    return run, len(df)
+
+
+def bench_peildatum_variables(n: int, seed: int) -> tuple[Callable, int]:
+    """create_peildatum_based_variables on the expanded rows."""
+    preprocessor = _preprocessor(make_synthetic_contracts(n, seed=seed))
+    preprocessor._expand_rows()
+    df = preprocessor.df
+    return lambda: create_peildatum_based_variables(df, years_ahead=YEARS_AHEAD), len(df)
+
+
+def bench_expand_duckdb(n: int, seed: int) -> tuple[Callable, int]:
+    """_expand_rows and create_peildatum_based_variables in one DuckDB query (PREPARE_ENGINE = "duckdb").
+
+    Compare with the sum of expand_rows and peildatum_variables, which together are the pandas engine. The peak
+    memory only includes the result, as tracemalloc does not see the memory of DuckDB itself.
+    """
+    preprocessor = _preprocessor(make_synthetic_contracts(n, seed=seed))
+    df = preprocessor.df
+    dates = preprocessor._create_date_sequence(startdate=df[COL_STARTDATE].min())
+    return lambda: expand_rows_with_variables(df, dates, years_ahead=YEARS_AHEAD), len(df)
+
+
+def bench_column_transformer(n: int, seed: int) -> tuple[Callable, int]:
+    """Fit and transform of the preprocessing ColumnTransformer, including the DataFrame wrapper as in prepare."""
+    df = _peildatum_set(make_synthetic_contracts(n, seed=seed))[FEATURE_COLUMNS]
+    preprocessor = DataPreprocessor(traindate=_traindate(), testdate=_traindate(), years_ahead=YEARS_AHEAD)
+
+    def run():
+        preprocessor._get_preprocessing_pipeline()
+        X = preprocessor.pipe.fit_transform(df)
+        return pd.DataFrame(X, columns=preprocessor.pipe.get_feature_names_out())
+
+    return run, len(df)
+
+
+def bench_train(n: int, seed: int) -> tuple[Callable, int]:
+    """Hyperparameter search (XGBoost, 2 candidates) and sigmoid calibration, as in train_and_evaluate_models.
+
+    Logging to aim and the calibration plots are left out. The search cache is not used: from the second repeat on it
+    would only refit the best candidate instead of searching.
+    """
+    df = _peildatum_set(make_synthetic_contracts(n, seed=seed))
+    preprocessor = DataPreprocessor(traindate=_traindate(), testdate=_traindate(), years_ahead=YEARS_AHEAD)
+    preprocessor._get_preprocessing_pipeline()
+    # As a numpy array: in the synthetic data every category of opleverjaarcategorie is frequent, so '<1900' ends up
+    # in a feature name, which XGBoost does not accept
+    X = preprocessor.pipe.fit_transform(df[FEATURE_COLUMNS])
+    y = df[COL_LABEL_EVENT].to_numpy()
+
+    def run():
+        search = search_hyperparameters("XGBoostClassifier", X, y, number_of_experiments=2, use_cache=False)
+        model = CalibratedClassifierCV(FrozenEstimator(search.best_estimator_), method="sigmoid", ensemble=False)
+        return model.fit(X, y)
+
+    return run, len(X)
+
+
+def bench_score(n: int, seed: int) -> tuple[Callable, int]:
+    """split_predict_set and score_horizons of three horizons, as in generate_verhuiskansen."""
+    df_combined = make_synthetic_contracts(n, seed=seed, for_predict=True)
+    models = fit_synthetic_models(df_combined, seed=seed)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def run():
+        df_actief, df_opgezegd = split_predict_set(df_combined, peildatum=datetime.today())
+        return score_horizons(df_actief, df_opgezegd, models=models, timestamp=timestamp)
+
+    return run, len(df_combined)
+
+
+# Every benchmark returns the function to time, set up on n synthetic contracts, and the number of rows it processes
+BENCHMARKS = {
+    "expand_rows": bench_expand_rows,
+    "peildatum_variables": bench_peildatum_variables,
+    "expand_duckdb": bench_expand_duckdb,
+    "column_transformer": bench_column_transformer,
+    "train": bench_train,
+    "score": bench_score,
+}
+
+
+def run_benchmark(name: str, n: int, repeat: int = 3, seed: int = 0) -> dict:
+    """Runs benchmark name on n synthetic contracts and returns its median wall time, throughput and peak memory.
+
+    The wall time is measured in repeat runs without tracing. The peak memory is measured with tracemalloc (Python,
+    numpy and pandas allocations) in one extra run, as tracing slows down the code.
+    """
+    run, rows = BENCHMARKS[name](n, seed)
+
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run()
+        durations.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    seconds = float(np.median(durations))
+    result = {
+        "benchmark": name,
+        "contracts": n,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / max(seconds, 1e-9),
+        "peak_memory_mb": peak_memory / 1e6,
+    }
+    logger.info(
+        f"Benchmark {name} ({n} contracts, {rows} rows): {seconds:.3f}s, {result['rows_per_second']:.0f} rows/s, "
+        f"peak memory {result['peak_memory_mb']:.0f} MB"
+    )
+    return result
+
+
+def compare_to_baseline(results: list[dict], baseline: list[dict], threshold: float) -> list[dict]:
+    """Adds the relative change against the baseline to every result and returns the regressions.
+
+    A result is a regression if its wall time or peak memory is more than threshold (relative) higher than in the
+    baseline run of the same benchmark and size. Results without baseline are not compared.
+    """
+    baseline_results = {(result["benchmark"], result["contracts"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_results.get((result["benchmark"], result["contracts"]))
+        if base is None:
+            continue
+        for metric in ["seconds", "peak_memory_mb"]:
+            change = result[metric] / max(base[metric], 1e-9) - 1
+            result[f"{metric}_change"] = change
+            if change > threshold:
+                regressions.append({**result, "metric": metric, "baseline": base[metric], "change": change})
+
+        logger.info(
+            f"Benchmark {result['benchmark']} ({result['contracts']} contracts): "
+            f"time {result['seconds_change']:+.0%}, peak memory {result['peak_memory_mb_change']:+.0%} vs. baseline"
+        )
+
+    for regression in regressions:
+        logger.warning(
+            f"Regression in {regression['benchmark']} ({regression['contracts']} contracts): {regression['metric']} "
+            f"{regression['baseline']:.3f} -> {regression[regression['metric']]:.3f} ({regression['change']:+.0%})"
+        )
+    return regressions
+
+
+def run_benchmarks(
+    names: list[str],
+    sizes: list[int],
+    repeat: int = 3,
+    output_dir: str | None = "reports",
+    baseline_path: str = BENCHMARK_BASELINE_PATH,
+    threshold: float = BENCHMARK_REGRESSION_THRESHOLD,
+    save_baseline: bool = False,
+) -> dict:
+    """Runs the benchmarks at all sizes, saves the results and compares them against the baseline (if it exists).
+
+    Returns:
+        dict: report with the environment, all results and the regressions against the baseline
+    """
+    results = [run_benchmark(name, n, repeat=repeat) for name in names for n in sizes]
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "repeat": repeat,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+        "regressions": [],
+    }
+
+    if save_baseline:
+        _save_json(report, Path(baseline_path))
+        logger.info(f"Benchmark baseline saved to {baseline_path}")
+    elif Path(baseline_path).exists():
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare_to_baseline(results, baseline["results"], threshold=threshold)
+        logger.info(f"{len(report['regressions'])} regression(s) of more than {threshold:.0%} against {baseline_path}")
+    else:
+        logger.info(f"No benchmark baseline in {baseline_path}, save one with --save-baseline")
+
+    if output_dir is not None:
+        output_path = Path(output_dir) / f"benchmark_{get_timestamp()}.json"
+        _save_json(report, output_path)
+        logger.info(f"Benchmark results saved to {output_path}")
+
+    return report
+
+
+def _save_json(report: dict, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--benchmarks", help="benchmarks to run", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS)
+    )
+    parser.add_argument(
+        "--sizes", help="numbers of synthetic contracts", nargs="+", type=int, default=[10_000, 100_000]
+    )
+    parser.add_argument("--repeat", help="number of timed runs per benchmark and size", type=int, default=3)
+    parser.add_argument("--output-dir", help="folder to save the results as json", type=str, default="reports")
+    parser.add_argument("--baseline", help="baseline to compare against", type=str, default=BENCHMARK_BASELINE_PATH)
+    parser.add_argument(
+        "--threshold", help="relative slowdown that is a regression", type=float, default=BENCHMARK_REGRESSION_THRESHOLD
+    )
+    parser.add_argument("--save-baseline", help="save the results as the new baseline", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    report = run_benchmarks(
+        names=args.benchmarks,
+        sizes=args.sizes,
+        repeat=args.repeat,
+        output_dir=args.output_dir,
+        baseline_path=args.baseline,
+        threshold=args.threshold,
+        save_baseline=args.save_baseline,
+    )
+    sys.exit(1 if report["regressions"] else 0)
@@ -0,0 +1,299 @@
+"""Compiles a fitted (pipeline, model) pair into a compact scorer that works on NumPy columns.
+
+At predict time the sklearn path goes ColumnTransformer.transform -> pd.DataFrame ->
+CalibratedClassifierCV.predict_proba, where every step allocates and validates column names. The compiled scorer
+only keeps the fitted constants:
+- imputer and scaler constants of the numerical columns
+- a lookup table per categorical column from category to one-hot output column
+- the booster (XGBoost inplace_predict) or the fitted tree arrays (RandomForest)
+- the calibrator as a vectorized function
+"""
+import time
+import warnings
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.compose import ColumnTransformer
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.frozen import FrozenEstimator
+from sklearn.isotonic import IsotonicRegression
+from xgboost import XGBClassifier
+
+from src.columns import CAT_COLUMNS, FEATURE_COLUMNS, NUM_COLUMNS
+from src.my_logging import logger
+from src.settings import PRODUCTIONIZED_MODELS
+from src.utils.aml_models import get_models_from_AML
+
+
+@dataclass
+class CompiledTransformer:
+    """DataFrame-free replacement of the fitted preprocessing ColumnTransformer."""
+
+    n_features_out: int
+    cat_columns: list[str]
+    cat_fill_values: list[object]
+    cat_index: list[pd.Index]
+    cat_lookup: list[np.ndarray]
+    num_columns: list[str]
+    num_slice: slice
+    num_mean: np.ndarray
+    num_scale: np.ndarray
+    num_fill_values: np.ndarray
+
+    def transform(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """Transforms raw feature columns (name -> 1d array) into the model input matrix."""
+        n_rows = len(columns[self.num_columns[0]])
+        X = np.zeros((n_rows, self.n_features_out), dtype=np.float64)
+
+        # Numerical: scale first, then impute with the median of the scaled trainset (same order as the pipeline)
+        num = np.column_stack([np.asarray(columns[col], dtype=np.float64) for col in self.num_columns])
+        num -= self.num_mean
+        num /= self.num_scale
+        missing_rows, missing_cols = np.nonzero(np.isnan(num))
+        num[missing_rows, missing_cols] = self.num_fill_values[missing_cols]
+        X[:, self.num_slice] = num
+
+        # Categorical: impute NaN with the most frequent value, then look up the one-hot column of every category.
+        # Unknown and dropped categories map to -1, so these rows stay all zeros (handle_unknown="ignore").
+        rows = np.arange(n_rows)
+        for col, fill_value, index, lookup in zip(
+            self.cat_columns, self.cat_fill_values, self.cat_index, self.cat_lookup
+        ):
+            values = np.asarray(columns[col], dtype=object)
+            missing = values != values
+            if missing.any():
+                values = values.copy()
+                values[missing] = fill_value
+            out_columns = lookup[index.get_indexer(values)]
+            is_encoded = out_columns >= 0
+            X[rows[is_encoded], out_columns[is_encoded]] = 1.0
+
+        return X
+
+
+@dataclass
+class CompiledModel:
+    """Vectorized replacement of a fitted (calibrated) classifier, returning the probability of the positive class."""
+
+    algorithm: str
+    estimators: list[object]
+    calibration_method: str
+    calibrators: list[dict]
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Probability of the positive class, averaged over the (calibrated) estimators."""
+        proba = np.zeros(X.shape[0], dtype=np.float64)
+        for estimator, calibrator in zip(self.estimators, self.calibrators):
+            proba += self._calibrate(self._predict_estimator(estimator, X), calibrator)
+        proba /= len(self.estimators)
+
+        # Same clean-up as sklearn's CalibratedClassifierCV
+        proba[np.isnan(proba)] = 0.5
+        proba[(proba > 1.0) & (proba <= 1.0 + 1e-5)] = 1.0
+        return proba
+
+    def _predict_estimator(self, estimator: object, X: np.ndarray) -> np.ndarray:
+        if self.algorithm == "XGBoostClassifier":
+            booster, iteration_range = estimator
+            return booster.inplace_predict(X, iteration_range=iteration_range, validate_features=False)
+
+        # RandomForestClassifier: evaluate the fitted tree arrays directly, without any input validation
+        X32 = np.ascontiguousarray(X, dtype=np.float32)
+        proba = np.zeros(X.shape[0], dtype=np.float64)
+        for tree in estimator:
+            value = tree.predict(X32)
+            normalizer = value.sum(axis=1)
+            normalizer[normalizer == 0.0] = 1.0
+            proba += value[:, 1] / normalizer
+        return proba / len(estimator)
+
+    def _calibrate(self, proba: np.ndarray, calibrator: dict) -> np.ndarray:
+        if self.calibration_method == "sigmoid":
+            return 1.0 / (1.0 + np.exp(calibrator["a"] * proba + calibrator["b"]))
+        if self.calibration_method == "isotonic":
+            if len(calibrator["x"]) == 1:
+                return np.full(proba.shape, calibrator["y"][0], dtype=np.float64)
+            clipped = np.clip(proba, calibrator["x_min"], calibrator["x_max"])
+            return np.interp(clipped, calibrator["x"], calibrator["y"]).astype(proba.dtype)
+        return proba
+
+
+@dataclass
+class CompiledScorer:
+    """Compiled (pipeline, model) pair: raw feature columns in, verhuiskans out."""
+
+    transformer: CompiledTransformer
+    model: CompiledModel
+
+    def predict_proba(self, columns: dict[str, np.ndarray]) -> np.ndarray:
+        """Returns the verhuiskans (probability of the positive class) per row."""
+        return self.model.predict_proba(self.transformer.transform(columns))
+
+
+def compile_scorer(pipeline: ColumnTransformer, model: object) -> CompiledScorer:
+    """Compiles a fitted preprocessing pipeline and a fitted model into a CompiledScorer."""
+    return CompiledScorer(transformer=compile_transformer(pipeline), model=compile_model(model))
+
+
+def compile_transformer(pipeline: ColumnTransformer) -> CompiledTransformer:
+    """Extracts the fitted constants of the preprocessing pipeline built in DataPreprocessor."""
+    cat_pipeline = pipeline.named_transformers_["categorical"]
+    num_pipeline = pipeline.named_transformers_["numerical"]
+    cat_imputer, encoder = cat_pipeline.named_steps["imputer"], cat_pipeline.named_steps["one-hot-encoder"]
+    scaler, num_imputer = num_pipeline.named_steps["scaler"], num_pipeline.named_steps["imputer"]
+
+    n_features_out = len(pipeline.get_feature_names_out())
+    cat_slice = pipeline.output_indices_["categorical"]
+    num_slice = pipeline.output_indices_["numerical"]
+    if num_slice.stop - num_slice.start != len(NUM_COLUMNS) or len(cat_imputer.statistics_) != len(CAT_COLUMNS):
+        raise ValueError("Pipeline drops empty features, this is not supported by the compiled scorer")
+
+    cat_index, cat_lookup = [], []
+    for i, categories in enumerate(encoder.categories_):
+        index = pd.Index(categories, dtype=object)
+        # Last element is the lookup for unknown categories (get_indexer returns -1)
+        lookup = np.full(len(categories) + 1, -1, dtype=np.int64)
+        lookup[:-1] = _encoded_columns(encoder, feature=i, categories=categories) + cat_slice.start
+        lookup[lookup < cat_slice.start] = -1
+        cat_index.append(index)
+        cat_lookup.append(lookup)
+
+    return CompiledTransformer(
+        n_features_out=n_features_out,
+        cat_columns=list(CAT_COLUMNS),
+        cat_fill_values=list(cat_imputer.statistics_),
+        cat_index=cat_index,
+        cat_lookup=cat_lookup,
+        num_columns=list(NUM_COLUMNS),
+        num_slice=num_slice,
+        num_mean=scaler.mean_.astype(np.float64),
+        num_scale=scaler.scale_.astype(np.float64),
+        num_fill_values=num_imputer.statistics_.astype(np.float64),
+    )
+
+
+def _encoded_columns(encoder: object, feature: int, categories: np.ndarray) -> np.ndarray:
+    """Returns per category of one feature the column of the encoder output it lights up, or -1 if none.
+
+    All other features get a value the encoder has never seen, so they are encoded as all zeros. This way dropped and
+    infrequent categories are handled exactly as the fitted encoder does.
+    """
+    X = np.full((len(categories), len(encoder.categories_)), "__unknown_category__", dtype=object)
+    X[:, feature] = categories
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=UserWarning)
+        encoded = encoder.transform(X)
+    encoded = encoded.toarray() if hasattr(encoded, "toarray") else np.asarray(encoded)
+    return np.where(encoded.any(axis=1), encoded.argmax(axis=1), -1)
+
+
+def compile_model(model: object) -> CompiledModel:
+    """Extracts the booster or tree arrays and the calibrator constants of a model from train_and_evaluate_models."""
+    if isinstance(model, CalibratedClassifierCV):
+        calibration_method = model.method
+        classifiers = [(c.estimator, c.calibrators[0]) for c in model.calibrated_classifiers_]
+    else:
+        calibration_method = "no calibration"
+        classifiers = [(model, None)]
+
+    estimators, calibrators = [], []
+    for estimator, calibrator in classifiers:
+        if isinstance(estimator, FrozenEstimator):
+            estimator = estimator.estimator
+        algorithm, compiled_estimator = _compile_estimator(estimator)
+        estimators.append(compiled_estimator)
+        calibrators.append(_compile_calibrator(calibrator))
+
+    return CompiledModel(
+        algorithm=algorithm, estimators=estimators, calibration_method=calibration_method, calibrators=calibrators
+    )
+
+
+def _compile_estimator(estimator: object) -> tuple[str, object]:
+    if isinstance(estimator, XGBClassifier):
+        if estimator.get_params()["objective"] != "binary:logistic":
+            raise ValueError(f"Only binary:logistic XGBoost models can be compiled, got {estimator.objective}")
+        return "XGBoostClassifier", (estimator.get_booster(), _iteration_range(estimator))
+    if isinstance(estimator, RandomForestClassifier):
+        return "RandomForestClassifier", [tree.tree_ for tree in estimator.estimators_]
+    raise ValueError(f"Estimator {type(estimator).__name__} is not supported by the compiled scorer")
+
+
+def _iteration_range(estimator: XGBClassifier) -> tuple[int, int]:
+    """The trees predict_proba uses: up to best_iteration if fitted with early stopping, otherwise all of them."""
+    try:
+        return 0, estimator.best_iteration + 1
+    except AttributeError:  # best_iteration is only defined when early stopping is used
+        return 0, 0
+
+
+def _compile_calibrator(calibrator: object) -> dict:
+    if calibrator is None:
+        return {}
+    if isinstance(calibrator, IsotonicRegression):
+        return {
+            "x": calibrator.X_thresholds_.astype(np.float64),
+            "y": calibrator.y_thresholds_.astype(np.float64),
+            "x_min": calibrator.X_min_,
+            "x_max": calibrator.X_max_,
+        }
+    # sklearn.calibration._SigmoidCalibration
+    return {"a": float(calibrator.a_), "b": float(calibrator.b_)}
+
+
+def feature_columns(df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """Converts the FEATURE_COLUMNS of a DataFrame into NumPy columns, with NaN for missing numerical values."""
+    columns = {col: df[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in NUM_COLUMNS}
+    columns.update({col: df[col].to_numpy(dtype=object) for col in CAT_COLUMNS})
+    return columns
+
+
+def check_compiled_scorers(df: pd.DataFrame) -> None:
+    """Compiles all PRODUCTIONIZED_MODELS and checks them against the sklearn path on df (FEATURE_COLUMNS).
+
+    Run this before setting USE_COMPILED_SCORER: it raises if a compiled scorer deviates from its sklearn model.
+    """
+    model_dicts = get_models_from_AML(PRODUCTIONIZED_MODELS)
+    for years_ahead in PRODUCTIONIZED_MODELS:
+        pipeline, model = model_dicts[years_ahead]["pipeline"], model_dicts[years_ahead]["model"]
+        logger.info(f"Checking the compiled scorer of the {years_ahead} year(s) ahead model..")
+        compare_with_sklearn(compile_scorer(pipeline, model), pipeline, model, df)
+
+    return None
+
+
+def compare_with_sklearn(
+    scorer: CompiledScorer, pipeline: ColumnTransformer, model: object, df: pd.DataFrame, atol: float = 1e-5
+) -> float:
+    """Checks that the compiled scorer reproduces the sklearn path and logs the throughput of both.
+
+    Returns:
+        float: maximum absolute difference between both predicted probabilities
+    """
+    t0 = time.perf_counter()
+    X = pd.DataFrame(pipeline.transform(df[FEATURE_COLUMNS]), columns=pipeline.get_feature_names_out())
+    expected = model.predict_proba(X)[:, 1]
+    t1 = time.perf_counter()
+    actual = scorer.predict_proba(feature_columns(df))
+    t2 = time.perf_counter()
+
+    max_diff = float(np.max(np.abs(expected - actual))) if len(df) else 0.0
+    logger.info(
+        f"Compiled scorer: max abs diff {max_diff:.2e}, "
+        f"sklearn {len(df) / (t1 - t0):,.0f} rows/s, compiled {len(df) / (t2 - t1):,.0f} rows/s "
+        f"({(t1 - t0) / (t2 - t1):.1f}x)"
+    )
+    if max_diff > atol:
+        raise AssertionError(f"Compiled scorer deviates {max_diff} from the sklearn path (tolerance {atol})")
+    return max_diff
+
+
+if __name__ == "__main__":
+    from src.score import split_predict_set
+    from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl
+
+    df_combined = load_from_pkl(generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle"))
+    df_actief, _ = split_predict_set(df_combined, peildatum=pd.Timestamp.today())
+    check_compiled_scorers(df_actief)
@@ -0,0 +1,181 @@
+"""Downsampling of the negative peildatum rows per contract, selected with NEGATIVE_SAMPLING_RATE.
+
+_expand_rows gives every contract a row per year (and per month in its last year), so the train set grows with the
+portfolio times its history and most rows of long tenancies are near-duplicate negatives. downsample_negatives keeps a
+fraction of the negative rows of every contract and weights the kept ones, so every contract keeps its total weight
+and the model learns the same distribution from fewer rows. The weights are passed to fit in the search and every
+refit; the calibration and test sets are not downsampled.
+
+python src/downsample.py --contracts 20000 --rates 1 0.5 0.25 0.1 reports the test ROC AUC and Brier score against
+the speedup of fitting per rate, on synthetic contracts (or on df_combined with --data).
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.columns import COL_ENDDATE, COL_HOVK_STATUS, COL_ID_HOVK, COL_LABEL_EVENT
+from src.my_logging import logger
+from src.settings import RANDOM_SEED
+
+# Hyperparameters of the models fitted for the report, the same for every rate so only the number of rows differs
+REPORT_HYPERPARAMETERS = {
+    "XGBoostClassifier": {"n_estimators": 200, "max_depth": 5, "learning_rate": 0.1},
+    "RandomForestClassifier": {"n_estimators": 200, "max_depth": 10, "min_samples_leaf": 4},
+}
+
+
+def downsample_negatives(df: pd.DataFrame, rate: float, seed: int = RANDOM_SEED) -> tuple[pd.DataFrame, pd.Series]:
+    """Keeps a fraction rate of the negative rows (COL_LABEL_EVENT False) of every contract, with weights.
+
+    Of a contract with n negative rows, round(rate * n) random ones (at least one) are kept with weight n / kept, so
+    the negative rows of every contract keep their total weight. The positive rows are all kept with weight 1.
+
+    Args:
+        df (pd.DataFrame): expanded rows with COL_ID_HOVK and COL_LABEL_EVENT, e.g. the train set of prepare
+        rate (float): fraction of the negative rows to keep, in (0, 1]
+        seed (int, optional): seed of the random selection
+
+    Returns:
+        tuple[pd.DataFrame, pd.Series]: the kept rows of df in their original order, and their weights (same index)
+    """
+    if not 0 < rate <= 1:
+        raise ValueError(f"rate should be in (0, 1], not {rate}")
+    negative = ~df[COL_LABEL_EVENT].to_numpy(dtype=bool)
+    contracts = df[COL_ID_HOVK].to_numpy()
+
+    n_negative = pd.Series(negative).groupby(contracts).transform("sum").to_numpy()
+    n_keep = np.maximum(np.round(rate * n_negative), 1)
+    # Rank of every negative row among the negative rows of its contract, in random order
+    random_key = np.where(negative, np.random.default_rng(seed).random(len(df)), np.inf)
+    rank = pd.Series(random_key).groupby(contracts).rank(method="first").to_numpy() - 1
+
+    keep = ~negative | (rank < n_keep)
+    weights = np.where(negative, n_negative / n_keep, 1.0)[keep]
+    logger.info(f"Downsampled the negative rows with rate {rate}: {keep.sum()} of {len(df)} rows kept")
+    return df[keep], pd.Series(weights, index=df.index[keep], name="sample_weight")
+
+
+def downsampling_report(
+    df_combined: pd.DataFrame,
+    traindate: datetime,
+    years_ahead: int,
+    rates: list[float],
+    algorithm: str = "XGBoostClassifier",
+) -> list[dict]:
+    """Prepares and fits a model per rate and returns its test ROC AUC and Brier score, rows and speedup.
+
+    The model of every rate has the hyperparameters in REPORT_HYPERPARAMETERS and is calibrated (sigmoid) on the
+    untouched calibration set. The speedup is the fit time without downsampling divided by that with rate (1 for rate
+    1), so rate 1 has to be in rates.
+    """
+    from sklearn.calibration import CalibratedClassifierCV
+    from sklearn.frozen import FrozenEstimator
+    from sklearn.metrics import brier_score_loss, roc_auc_score
+
+    from src.prepare import DataPreprocessor
+    from src.train import fit_with_hyperparameters
+
+    testdate = traindate + pd.DateOffset(years=years_ahead)
+    # The peildatum expansion is the same for every rate
+    expander = DataPreprocessor(traindate=traindate, testdate=testdate, years_ahead=years_ahead)
+    expander.df = df_combined.copy()
+    expander.df.loc[expander.df[COL_HOVK_STATUS] == "Actief", COL_ENDDATE] = pd.NaT
+    expander._expand_rows_with_variables()
+
+    results = []
+    for rate in sorted(rates, reverse=True):
+        preprocessor = DataPreprocessor(
+            traindate=traindate, testdate=testdate, years_ahead=years_ahead, negative_sampling_rate=rate
+        )
+        preprocessor.df = expander.df
+        preprocessor._make_expanded_train_test_sets()
+        # As numpy arrays: in synthetic data every category of opleverjaarcategorie is frequent, so '<1900' ends up in
+        # a feature name, which XGBoost does not accept
+        sets = {name: values.to_numpy() for name, values in preprocessor.train_test_sets.items()}
+
+        t0 = time.perf_counter()
+        model = fit_with_hyperparameters(
+            algorithm, REPORT_HYPERPARAMETERS[algorithm], sets["X_train"], sets["y_train"], sets["w_train"]
+        )
+        fit_time = time.perf_counter() - t0
+        calibrated_model = CalibratedClassifierCV(estimator=FrozenEstimator(model), method="sigmoid")
+        calibrated_model.fit(sets["X_calibrate"], sets["y_calibrate"])
+
+        proba = calibrated_model.predict_proba(sets["X_test"])[:, 1]
+        results.append(
+            {
+                "rate": rate,
+                "train_rows": len(sets["X_train"]),
+                "fit_time": fit_time,
+                "test_roc_auc": roc_auc_score(sets["y_test"], proba),
+                "test_brier_score": brier_score_loss(sets["y_test"], proba),
+            }
+        )
+
+    full = next(result for result in results if result["rate"] == 1)
+    for result in results:
+        result["speedup"] = full["fit_time"] / result["fit_time"]
+        logger.info(
+            f"Rate {result['rate']}: {result['train_rows']} train rows, fit in {result['fit_time']:.1f}s "
+            f"({result['speedup']:.1f}x), test ROC AUC {result['test_roc_auc']:.4f}, "
+            f"Brier {result['test_brier_score']:.4f}"
+        )
+    return results
+
+
+def save_report(results: list[dict], output_dir: str | Path) -> Path:
+    """Saves the results of downsampling_report as json and as a plot of ROC AUC and Brier score against speedup."""
+    import matplotlib.pyplot as plt
+
+    from src.utils import get_timestamp
+
+    path = Path(output_dir) / f"downsampling_{get_timestamp()}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    for ax, metric in zip(axes, ["test_roc_auc", "test_brier_score"]):
+        ax.plot([result["speedup"] for result in results], [result[metric] for result in results], marker="o")
+        for result in results:
+            ax.annotate(f"rate {result['rate']}", (result["speedup"], result[metric]), fontsize=8)
+        ax.set_xlabel("speedup of fit")
+        ax.set_ylabel(metric)
+    fig.savefig(path.with_suffix(".png"), dpi=150, bbox_inches="tight")
+    plt.close(fig)
+    logger.info(f"Downsampling report saved to {path} and {path.with_suffix('.png')}")
+    return path
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", help="number of synthetic contracts", type=int, default=20_000)
+    parser.add_argument("--data", help="df_combined (.pickle) to use instead of synthetic contracts", type=Path)
+    parser.add_argument("--rates", help="fractions of negative rows to keep", type=float, nargs="+", default=[1, 0.5])
+    parser.add_argument("--years-ahead", help="horizon of the label", type=int, default=1)
+    parser.add_argument("--algorithm", help="algorithm to fit", type=str, default="XGBoostClassifier")
+    parser.add_argument("--output-dir", help="folder to save the report", type=str, default="reports")
+    parser.add_argument("--seed", help="random seed of the synthetic contracts", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from src.utils.io import load_from_pkl
+    from src.utils.synthetic import make_synthetic_contracts
+
+    args = get_args()
+    if args.data is not None:
+        df_combined = load_from_pkl(args.data)
+    else:
+        df_combined = make_synthetic_contracts(args.contracts, seed=args.seed)
+    traindate = datetime(datetime.today().year - args.years_ahead - 1, 1, 1)
+    results = downsampling_report(
+        df_combined, traindate, args.years_ahead, sorted(set(args.rates) | {1.0}), algorithm=args.algorithm
+    )
+    save_report(results, args.output_dir)
@@ -1,18 +1,336 @@
 """You can run this file to generate an Exploratory Data Analysis report.
 
-The program will likely not run without errors, but still create a report file (.html) in the /notebooks folder.
+The full report uses ydata_profiling. It will likely not run without errors, but still create a report file (.html)
+in the /notebooks folder. On all data it takes very long and a lot of memory.
+
+The fast report (--fast) computes per column the null rate, summary statistics, quantiles and histograms (numerical),
+the most frequent values (categorical) and the date range (dates), plus the correlations between the numerical
+FEATURE_COLUMNS, in a single pass over batches of the data. It reads the df_combined pickle or a Parquet file (in
+batches, so the data never has to fit in memory at once) and writes a compact report as .html and .json. Example:
+
+python src/eda.py --fast --sample 0.1
+python src/eda.py --fast --path data/load/df_combined.parquet
 """
-from ydata_profiling import ProfileReport
+import argparse
+import html
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Iterator
 
+import numpy as np
+import pandas as pd
+
+from src.columns import CAT_COLUMNS, COL_HOVK_STATUS, DATE_COLUMNS, NUM_COLUMNS
+from src.my_logging import logger
+from src.prepare import create_peildatum_based_variables
 from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl
 
-# Load your DataFrame
-df_combined_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
-df_combined = load_from_pkl(df_combined_path)
+# Quantiles and histograms are computed on a uniform sample of at most this many rows of the (sampled) data
+QUANTILE_SAMPLE_SIZE = 200_000
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+HISTOGRAM_BINS = 20
+TOP_CATEGORIES = 10
+
+
+def full_report(df_path: Path, output_path: Path) -> None:
+    """Generates the ydata_profiling report of all columns of df_combined."""
+    from ydata_profiling import ProfileReport
+
+    df_combined = load_from_pkl(df_path)
+    profile = ProfileReport(df_combined)
+    profile.to_file(output_path)
+
+
+class FastProfile:
+    """Accumulates the summaries of the columns over batches of data, see update and result.
+
+    Counts, null rates, sums, extremes, category frequencies and the correlation sums are exact over all batches.
+    Quantiles and histograms come from a uniform random sample of at most sample_size rows.
+    """
+
+    def __init__(self, sample_size: int = QUANTILE_SAMPLE_SIZE, seed: int = 0):
+        self.num_columns = NUM_COLUMNS
+        self.cat_columns = CAT_COLUMNS + [COL_HOVK_STATUS]
+        self.date_columns = DATE_COLUMNS
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+
+        k = len(self.num_columns)
+        self.rows = 0
+        self.nulls = {col: 0 for col in self.num_columns + self.cat_columns + self.date_columns}
+        self.num = {stat: np.zeros(k) for stat in ["sum", "sum_sq", "zeros"]}
+        self.num["min"], self.num["max"] = np.full(k, np.inf), np.full(k, -np.inf)
+        self.categories = {col: pd.Series(dtype=np.int64) for col in self.cat_columns}
+        self.date_range = {col: [pd.NaT, pd.NaT] for col in self.date_columns}
+        # Pairwise sums over the rows where both columns are known, for the correlations
+        self.pair = {stat: np.zeros((k, k)) for stat in ["n", "sum", "sum_sq", "sum_product"]}
+        self.sample = pd.DataFrame(columns=self.num_columns, dtype="float64")
+        self.sample_keys = np.array([])
+
+    def update(self, df: pd.DataFrame) -> None:
+        """Adds a batch of rows to the summaries."""
+        self.rows += len(df)
+        for col in self.nulls:
+            self.nulls[col] += int(df[col].isna().sum())
+
+        X = df[self.num_columns].astype("float64").to_numpy(na_value=np.nan)
+        is_known = ~np.isnan(X)
+        X0 = np.where(is_known, X, 0.0)
+        known = is_known.astype("float64")
+        self.num["sum"] += X0.sum(axis=0)
+        self.num["sum_sq"] += (X0**2).sum(axis=0)
+        self.num["zeros"] += (is_known & (X == 0)).sum(axis=0)
+        if len(df):
+            self.num["min"] = np.fmin(self.num["min"], np.nanmin(np.where(is_known, X, np.inf), axis=0))
+            self.num["max"] = np.fmax(self.num["max"], np.nanmax(np.where(is_known, X, -np.inf), axis=0))
+        self.pair["n"] += known.T @ known
+        self.pair["sum"] += X0.T @ known
+        self.pair["sum_sq"] += (X0**2).T @ known
+        self.pair["sum_product"] += X0.T @ X0
+
+        for col in self.cat_columns:
+            counts = df[col].value_counts(dropna=True)
+            self.categories[col] = self.categories[col].add(counts, fill_value=0).astype(np.int64)
+
+        for col in self.date_columns:
+            known = df[col].dropna()
+            if len(known):
+                lo, hi = self.date_range[col]
+                self.date_range[col] = [
+                    known.min() if pd.isna(lo) else min(lo, known.min()),
+                    known.max() if pd.isna(hi) else max(hi, known.max()),
+                ]
+
+        # Bottom-k sampling: every row gets a random key, the rows with the smallest keys form a uniform sample
+        keys = self.rng.random(len(df))
+        sample = pd.concat([self.sample, df[self.num_columns].astype("float64")], ignore_index=True)
+        keys = np.concatenate([self.sample_keys, keys])
+        keep = np.argsort(keys)[: self.sample_size]
+        self.sample, self.sample_keys = sample.iloc[keep].reset_index(drop=True), keys[keep]
+
+    def result(self) -> dict:
+        """Returns the summaries of all columns and the correlation matrix of the numerical columns."""
+        n_known = self.rows - np.array([self.nulls[col] for col in self.num_columns])
+        mean = self.num["sum"] / np.maximum(n_known, 1)
+        std = np.sqrt(np.maximum(self.num["sum_sq"] / np.maximum(n_known, 1) - mean**2, 0))
+
+        numerical = {}
+        for i, col in enumerate(self.num_columns):
+            values = self.sample[col].dropna().to_numpy()
+            counts, edges = np.histogram(values, bins=HISTOGRAM_BINS) if len(values) else (np.array([]), np.array([]))
+            numerical[col] = {
+                **self._null_summary(col),
+                "mean": _number(mean[i]),
+                "std": _number(std[i]),
+                "min": _number(self.num["min"][i]),
+                "max": _number(self.num["max"][i]),
+                "zeros": int(self.num["zeros"][i]),
+                "quantiles": {str(q): _number(v) for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))}
+                if len(values)
+                else {},
+                "histogram": {"counts": counts.tolist(), "edges": [_number(edge) for edge in edges]},
+            }
+
+        categorical = {}
+        for col in self.cat_columns:
+            counts = self.categories[col].sort_values(ascending=False)
+            categorical[col] = {
+                **self._null_summary(col),
+                "distinct": int(len(counts)),
+                "top": {str(value): int(count) for value, count in counts.iloc[:TOP_CATEGORIES].items()},
+                "other": int(counts.iloc[TOP_CATEGORIES:].sum()),
+            }
+
+        dates = {
+            col: {**self._null_summary(col), "min": _date(lo), "max": _date(hi)}
+            for col, (lo, hi) in self.date_range.items()
+        }
+
+        n, s, sq, sp = (self.pair[stat] for stat in ["n", "sum", "sum_sq", "sum_product"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # s[i, j] is the sum of column i over the rows where both i and j are known, s.T[i, j] that of column j
+            covariance = n * sp - s * s.T
+            correlation = covariance / np.sqrt((n * sq - s**2) * (n * sq.T - s.T**2))
+        correlations = {
+            col: {other: _number(correlation[i, j]) for j, other in enumerate(self.num_columns)}
+            for i, col in enumerate(self.num_columns)
+        }
+
+        return {
+            "rows": self.rows,
+            "numerical": numerical,
+            "categorical": categorical,
+            "dates": dates,
+            "correlations": correlations,
+        }
+
+    def _null_summary(self, col: str) -> dict:
+        return {"nulls": self.nulls[col], "null_rate": self.nulls[col] / max(self.rows, 1)}
+
+
+def read_batches(path: Path, batch_size: int) -> Iterator[pd.DataFrame]:
+    """Reads a pickled DataFrame or a Parquet file in batches of batch_size rows."""
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            yield batch.to_pandas()
+    else:
+        df = load_from_pkl(path)
+        for start in range(0, len(df), batch_size):
+            stop = start + batch_size
+            yield df.iloc[start:stop]
+
+
+def fast_report(
+    df_path: Path,
+    output_path: Path,
+    sample: float | None = None,
+    batch_size: int = 100_000,
+    peildatum: datetime | None = None,
+    seed: int = 0,
+) -> dict:
+    """Generates the fast report of df_combined (see the module docstring) as .html and .json.
+
+    Args:
+        df_path (Path): df_combined as .pickle or .parquet
+        output_path (Path): path of the .html report, the .json report is written next to it
+        sample (float | None): if set, only this fraction of the rows (drawn at random) is profiled
+        batch_size (int): number of rows per batch
+        peildatum (datetime | None): peildatum of the peildatum based FEATURE_COLUMNS (e.g. leeftijd_woning), by
+            default today, as at predict time
+
+    Returns:
+        dict: the report
+    """
+    t0 = time.perf_counter()
+    peildatum = pd.Timestamp(peildatum or datetime.today().date())
+    rng = np.random.default_rng(seed)
+    profile = FastProfile(seed=seed)
+
+    rows_read = 0
+    for batch in read_batches(df_path, batch_size=batch_size):
+        rows_read += len(batch)
+        if sample is not None:
+            batch = batch.loc[rng.random(len(batch)) < sample]
+        batch = batch.assign(peildatum=peildatum)
+        profile.update(create_peildatum_based_variables(batch))
+
+    report = {
+        "source": str(df_path),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "peildatum": _date(peildatum),
+        "rows_read": rows_read,
+        "sample": sample,
+        **profile.result(),
+    }
+    report["seconds"] = time.perf_counter() - t0
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path.with_suffix(".json"), "w") as f:
+        json.dump(report, f, indent=2)
+    with open(output_path, "w") as f:
+        f.write(report_html(report))
+    logger.info(f"Fast EDA report of {report['rows']} rows in {report['seconds']:.1f}s saved to {output_path}")
+    return report
+
+
+def report_html(report: dict) -> str:
+    """Renders the fast report as a compact, self-contained html page."""
+
+    def table(header: list[str], rows: list[list]) -> str:
+        head = "".join(f"<th>{html.escape(str(cell))}</th>" for cell in header)
+        body = "".join("<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>" for row in rows)
+        return f"<table><tr>{head}</tr>{body}</table>"
+
+    def bars(counts: list[int]) -> str:
+        top = max(counts, default=0) or 1
+        return "".join(f'<span class="bar" style="height:{20 * count / top:.0f}px"></span>' for count in counts)
+
+    def fmt(value) -> str:
+        return "" if value is None else f"{value:.4g}" if isinstance(value, float) else html.escape(str(value))
+
+    numerical = [
+        [html.escape(col), f"{s['null_rate']:.1%}", fmt(s["mean"]), fmt(s["std"]), fmt(s["min"])]
+        + [fmt(s["quantiles"].get(str(q))) for q in [0.05, 0.5, 0.95]]
+        + [fmt(s["max"]), bars(s["histogram"]["counts"])]
+        for col, s in report["numerical"].items()
+    ]
+    categorical = [
+        [html.escape(col), f"{s['null_rate']:.1%}", s["distinct"]]
+        + [
+            "<br>".join(f"{html.escape(value)}: {count}" for value, count in s["top"].items())
+            + f"<br>other: {s['other']}"
+        ]
+        for col, s in report["categorical"].items()
+    ]
+    dates = [
+        [html.escape(col), f"{s['null_rate']:.1%}", fmt(s["min"]), fmt(s["max"])] for col, s in report["dates"].items()
+    ]
+    columns = list(report["correlations"])
+    correlations = [
+        [html.escape(col)] + [f'<span style="background:{_correlation_color(r)}">{fmt(r)}</span>' for r in row.values()]
+        for col, row in report["correlations"].items()
+    ]
+
+    sample = f", sample {report['sample']:.0%}" if report["sample"] else ""
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>EDA {html.escape(report['source'])}</title><style>
+body {{font-family: sans-serif; font-size: 13px}} table {{border-collapse: collapse; margin-bottom: 20px}}
+td, th {{border: 1px solid #ccc; padding: 3px 6px; vertical-align: bottom}}
+.bar {{display: inline-block; width: 4px; margin-right: 1px; background: #4878a8}}
+</style></head><body>
+<h1>EDA {html.escape(report['source'])}</h1>
+<p>{report['rows']} of {report['rows_read']} rows{sample}, peildatum {report['peildatum']},
+created {report['created']} in {report['seconds']:.1f}s</p>
+<h2>Numerical</h2>
+{table(["column", "nulls", "mean", "std", "min", "p5", "p50", "p95", "max", "histogram"], numerical)}
+<h2>Categorical</h2>
+{table(["column", "nulls", "distinct", f"top {TOP_CATEGORIES}"], categorical)}
+<h2>Dates</h2>
+{table(["column", "nulls", "min", "max"], dates)}
+<h2>Correlations (Pearson, pairwise complete)</h2>
+{table([""] + columns, correlations)}
+</body></html>
+"""
+
+
+def _number(value: float) -> float | None:
+    """Float that can be written to json (None instead of NaN or infinity)."""
+    return float(value) if np.isfinite(value) else None
+
+
+def _date(value) -> str | None:
+    return None if pd.isna(value) else str(pd.Timestamp(value).date())
+
+
+def _correlation_color(r: float | None) -> str:
+    """Blue for positive, red for negative correlations, more opaque the stronger they are."""
+    r = r or 0
+    return f"rgba({255 if r < 0 else 0},0,{255 if r > 0 else 0},{abs(r):.2f})"
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    default_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fast", help="generate the fast report instead of ydata_profiling", action="store_true")
+    parser.add_argument("--path", help="df_combined as .pickle or .parquet", type=Path, default=default_path)
+    parser.add_argument("--sample", help="fraction of the rows to profile (fast report)", type=float, default=None)
+    parser.add_argument("--batch-size", help="number of rows per batch (fast report)", type=int, default=100_000)
+    return parser.parse_args()
 
-# Generate the report
-profile = ProfileReport(df_combined)
 
-# Save the report to an HTML file
-profile.to_file("notebooks/df_combined_profile.html")
-print("")
+if __name__ == "__main__":
+    args = get_args()
+    if args.fast:
+        fast_report(
+            args.path,
+            Path("notebooks/df_combined_profile_fast.html"),
+            sample=args.sample,
+            batch_size=args.batch_size,
+        )
+    else:
+        full_report(args.path, Path("notebooks/df_combined_profile.html"))
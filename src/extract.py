@@ -0,0 +1,256 @@
+"""Incremental extraction of vhk_alle_queries_v2 from the warehouse.
+
+The base rows of all contracts (src/sql_queries/vhk_alle_queries_v2_basis.sql) are cached locally in a parquet file
+keyed by d_huurovereenkomst, together with a watermark: the snapshot (d_dag) of f_huurovereenkomst they are up to date
+with. An incremental extraction only queries the contracts whose row in f_huurovereenkomst is new, changed (e.g. got an
+end date) or disappeared since the watermark (vhk_gewijzigde_huurovereenkomsten.sql) and upserts them into the cache.
+A full refresh queries all contracts and replaces the cache. It is done when there is no cache yet, when the queries
+changed, when the watermark snapshot is no longer in the warehouse and every EXTRACT_FULL_REFRESH_DAYS days, to pick up
+changes outside f_huurovereenkomst (e.g. in the eenheid or the status of a contract).
+
+The columns that depend on the day of the extraction (survival_hovk_einddatum and the filters on it) are not cached,
+but derived from the cached rows on every extraction, so the result equals that of vhk_alle_queries_v2.sql on that day.
+The queries are standard SQL with qmark parameters, so any DB-API connection works: the warehouse through pyodbc, or
+a SQLite or DuckDB database with the same tables in schema dm_gold.
+
+python src/extract.py [--full-refresh]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+
+from src.columns import COL_ENDDATE, COL_HOVK_STATUS, COL_STARTDATE
+from src.data_types import DataTypes
+from src.my_logging import logger
+from src.settings import EXTRACT_FULL_REFRESH_DAYS
+from src.utils import get_env_var
+from src.utils.io import LEVEL, generate_data_dir_path
+from src.utils.tracing import stage
+
+SQL_DIR = Path(__file__).parent / "sql_queries"
+BASE_QUERY_PATH = SQL_DIR / "vhk_alle_queries_v2_basis.sql"
+CHANGED_QUERY_PATH = SQL_DIR / "vhk_gewijzigde_huurovereenkomsten.sql"
+ALL_CONTRACTS_QUERY = (
+    "SELECT d_huurovereenkomst FROM dm_gold.f_huurovereenkomst "
+    "WHERE d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst)"
+)
+KEY_COLUMN = "d_huurovereenkomst"
+# Dates of the base table as datetime64[s], as contracts without end date have einddatum 2999-12-31
+BASE_DATE_COLUMNS = [COL_STARTDATE, "huurovereenkomst_einddatum", "min_geboortedatum", "max_geboortedatum"]
+# survival_hovk_einddatum >= MIN_ENDDATE, as in vhk_alle_queries_v2.sql
+MIN_ENDDATE = pd.Timestamp("2023-01-01")
+
+
+class IncrementalExtractor:
+    """Extracts vhk_alle_queries_v2 from the warehouse, querying only what changed since the previous extraction."""
+
+    def __init__(
+        self,
+        connection,
+        cache_path: str | Path | None = None,
+        full_refresh_days: int = EXTRACT_FULL_REFRESH_DAYS,
+    ):
+        """Extracts through DB-API connection into the base table cache in cache_path (.parquet).
+
+        The watermark is stored next to it, with suffix .json.
+        """
+        self.connection = connection
+        if cache_path is None:
+            cache_path = generate_data_dir_path(LEVEL.LOAD, "vhk_alle_queries_v2_basis", suffix=".parquet")
+        self.cache_path = Path(cache_path)
+        self.state_path = self.cache_path.with_suffix(".json")
+        self.full_refresh_days = full_refresh_days
+        self.base_query = BASE_QUERY_PATH.read_text()
+        self.changed_query = CHANGED_QUERY_PATH.read_text()
+        self.queries_sha256 = hashlib.sha256((self.base_query + self.changed_query).encode()).hexdigest()
+
+    def extract(self, full_refresh: bool = False, now: datetime | None = None) -> pd.DataFrame:
+        """Updates the cached base table and returns vhk_alle_queries_v2 as of now (by default the current time).
+
+        Args:
+            full_refresh (bool): query all contracts, even if an incremental extraction is possible
+            now (datetime, optional): moment of the extraction, the GETDATE() of vhk_alle_queries_v2.sql
+        """
+        now = pd.Timestamp(now if now is not None else datetime.now())
+        state = self._read_state()
+        latest = self._fetchone("SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst")
+
+        reason = "requested" if full_refresh else self._full_refresh_reason(state, now)
+        mode = "full" if reason else "incremental"
+        with stage("extract", mode=mode) as span:
+            t0 = time.perf_counter()
+            if reason:
+                logger.info(f"Full refresh of {self.cache_path.name} ({reason})")
+                base = self._query(self.base_query.replace("{contracten}", ALL_CONTRACTS_QUERY), [f"{now:%Y-%m-%d}"])
+                changed = len(base)
+                last_full_refresh = f"{now:%Y-%m-%d}"
+            else:
+                base = _to_base_types(pd.read_parquet(self.cache_path))
+                changed = 0
+                if _json_value(latest) != state["watermark"]:
+                    base, changed = self._upsert_changes(base, state["watermark"], now)
+                last_full_refresh = state["last_full_refresh"]
+
+            self._write_cache(base)
+            self._write_state(
+                {
+                    "watermark": _json_value(latest),
+                    "last_full_refresh": last_full_refresh,
+                    "queries_sha256": self.queries_sha256,
+                    "rows": len(base),
+                }
+            )
+            df = derive_vhk_alle_queries(base, now=now)
+            span.set(rows_in=changed, rows_out=len(df))
+
+        logger.info(
+            f"{mode.capitalize()} extraction up to snapshot {latest}: {changed} contracts queried, {len(base)} in the "
+            f"base table, {len(df)} in vhk_alle_queries_v2, in {time.perf_counter() - t0:.1f}s"
+        )
+        return df
+
+    def _full_refresh_reason(self, state: dict | None, now: pd.Timestamp) -> str | None:
+        """Returns why a full refresh is needed, or None if the cache can be updated incrementally."""
+        if state is None or not self.cache_path.exists():
+            return "no cache yet"
+        if state["queries_sha256"] != self.queries_sha256:
+            return "the queries changed"
+        days = (now - pd.Timestamp(state["last_full_refresh"])).days
+        if days >= self.full_refresh_days:
+            return f"last full refresh {days} days ago"
+        if self._fetchone("SELECT 1 FROM dm_gold.f_huurovereenkomst WHERE d_dag = ?", [state["watermark"]]) is None:
+            return f"watermark snapshot {state['watermark']} is no longer in the warehouse"
+        return None
+
+    def _upsert_changes(self, base: pd.DataFrame, watermark, now: pd.Timestamp) -> tuple[pd.DataFrame, int]:
+        """Replaces the rows of the contracts that changed since watermark by their current rows.
+
+        Contracts that changed but no longer match the filters of the base query (or disappeared) are removed.
+        """
+        changed = self._query(self.changed_query, [watermark, watermark])[KEY_COLUMN]
+        rows = self._query(
+            self.base_query.replace("{contracten}", self.changed_query), [watermark, watermark, f"{now:%Y-%m-%d}"]
+        )
+        kept = base.loc[~base[KEY_COLUMN].isin(changed)]
+        logger.info(
+            f"{len(changed)} contracts changed since snapshot {watermark}: {len(base) - len(kept)} rows replaced or "
+            f"removed, {len(rows)} rows upserted"
+        )
+        return pd.concat([kept, rows], ignore_index=True), len(changed)
+
+    def _query(self, sql: str, params: list) -> pd.DataFrame:
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+        finally:
+            cursor.close()
+        if KEY_COLUMN in df.columns and COL_STARTDATE in df.columns:
+            df = _to_base_types(df)
+        return df
+
+    def _fetchone(self, sql: str, params: list | None = None):
+        """First value of the first row of the result of sql, or None if there are no rows."""
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, params or [])
+            row = cursor.fetchone()
+        finally:
+            cursor.close()
+        return None if row is None else row[0]
+
+    def _read_state(self) -> dict | None:
+        if not self.state_path.exists():
+            return None
+        with open(self.state_path) as f:
+            return json.load(f)
+
+    def _write_state(self, state: dict) -> None:
+        tmp_path = self.state_path.with_name(f".{self.state_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    def _write_cache(self, base: pd.DataFrame) -> None:
+        # Written to a temporary file first, so an interrupted write never replaces the cache by a partial one
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_name(f".{self.cache_path.name}.tmp")
+        base.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.cache_path)
+
+
+def derive_vhk_alle_queries(base: pd.DataFrame, now: datetime) -> pd.DataFrame:
+    """Derives vhk_alle_queries_v2 as of now from the base table, as vhk_alle_queries_v2.sql does with GETDATE().
+
+    Returns the columns of DataTypes.all_datatypes, in that order.
+    """
+    now = pd.Timestamp(now)
+    in_31_days = now + pd.Timedelta(days=31)
+    in_3_months = now + pd.DateOffset(months=3)
+    einddatum = base["huurovereenkomst_einddatum"]
+    status = base[COL_HOVK_STATUS]
+
+    # Active (or cancelled with an end date far ahead): censored today. Ended (or about to end): the end date
+    is_censored = ((status == "Actief") & (einddatum > now)) | ((status == "Opgezegd") & (einddatum > in_3_months))
+    is_ended = (status.isin(["Beëindigd", "Historisch"]) & (einddatum < in_31_days)) | (
+        status.isin(["Opgezegd", "Beëindigd"]) & (einddatum <= in_3_months)
+    )
+    survival_einddatum = einddatum.where(is_ended).astype("datetime64[ns]")
+    survival_einddatum.loc[is_censored] = now
+
+    df = base.assign(
+        **{
+            COL_STARTDATE: base[COL_STARTDATE].astype("datetime64[ns]"),
+            "startjaar_huurovereenkomst": base[COL_STARTDATE].dt.year.astype("Int64"),
+            COL_ENDDATE: survival_einddatum,
+            "opleverdatum": (base["opleverjaar"].astype("string") + "-01-01").astype(object),
+        }
+    )
+    # Active contracts with an end date in the past are left out
+    is_active_in_past = (status == "Actief") & (einddatum < now)
+    df = df.loc[~is_active_in_past.to_numpy() & (df[COL_ENDDATE] >= MIN_ENDDATE).to_numpy()]
+    return df[list(DataTypes.all_datatypes)].reset_index(drop=True)
+
+
+def _to_base_types(df: pd.DataFrame) -> pd.DataFrame:
+    """Same types for the base table, whatever the database or parquet returned (e.g. strings for dates in SQLite)."""
+    df[BASE_DATE_COLUMNS] = df[BASE_DATE_COLUMNS].astype("datetime64[s]")
+    df["opleverjaar"] = df["opleverjaar"].astype("Int64")
+    for col, dtype in DataTypes.all_datatypes.items():
+        if col in df.columns and col not in BASE_DATE_COLUMNS and dtype != "object":
+            df[col] = df[col].astype(dtype)
+    return df
+
+
+def _json_value(value):
+    """Watermark as it can be stored in json: dates as iso strings."""
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def connect_warehouse():
+    """DB-API connection to the warehouse, with pyodbc and the connection string in WAREHOUSE_CONNECTION_STRING.
+
+    Requires pyodbc and the ODBC driver for SQL Server, which are only needed with EXTRACT_FROM_WAREHOUSE.
+    """
+    import pyodbc
+
+    return pyodbc.connect(get_env_var("WAREHOUSE_CONNECTION_STRING"))
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full-refresh", help="query all contracts instead of only the changed", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    IncrementalExtractor(connect_warehouse()).extract(full_refresh=args.full_refresh)
@@ -0,0 +1,351 @@
+"""Discrete-time hazard model: one model for the verhuiskans of every horizon.
+
+train_and_evaluate_models fits a separate classifier per years_ahead, each on its own label. The hazard model instead
+learns the yearly hazard: the probability that a contract that is still active k - 1 years after the peildatum ends in
+year k (k = 1, ..., max_years). Its training data is the person-period panel of the expanded rows: every yearly
+peildatum (1 January) of a contract becomes a row per year k that was completely observed at the traindate and in
+which the contract was still at risk, with k as an extra feature (INTERVAL_COLUMN) and as label whether the contract
+ended in that year. Years after the end of the contract are left out and years that were not over at the traindate are
+censored. The monthly peildatums in the last 12 months of a contract are not used: they only exist for contracts that
+ended, so they would inflate the hazard.
+
+The cumulative verhuiskans of horizon h follows from the hazards of the first h years:
+P(ended within h years) = 1 - (1 - hazard_1) * ... * (1 - hazard_h). All horizons are therefore scored by one model in
+one predict_proba call, on the rows of every contract repeated for k = 1, ..., max(horizons). The label of horizon h is
+the same as COL_LABEL_EVENT with years_ahead = h, so the test metrics can be compared with those of the per-horizon
+models.
+"""
+import copy
+import subprocess
+from io import BytesIO
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV, CalibrationDisplay
+from sklearn.frozen import FrozenEstimator
+from sklearn.metrics import brier_score_loss, roc_auc_score
+
+from src.columns import COL_ENDDATE, COL_STARTDATE, FEATURE_COLUMNS
+from src.my_logging import logger
+from src.prepare import DataPreprocessor
+from src.settings import (
+    ALGORITHMS,
+    CALIBRATION_METHODS,
+    LOG_EXPERIMENT_TO_AIM,
+    OUTPUTS_DIR,
+    PREPARE_ENGINE,
+    conf,
+)
+from src.train import fit_with_hyperparameters, search_hyperparameters
+from src.utils.tracing import stage
+
+INTERVAL_COLUMN = "jaar_na_peildatum"
+
+
+class HazardPreprocessor(DataPreprocessor):
+    """DataPreprocessor for the hazard model: person-period train and calibration sets and a label per horizon.
+
+    Loading and the peildatum expansion are those of DataPreprocessor, only the train, calibration and test sets differ:
+    - train set: the person-period rows of the yearly peildatums before traindate - 1 year, with the years that were
+      over at traindate - 1 year. Otherwise the year of the calibration set would be in it too, for the same contracts
+    - calibration set: the person-period rows of the peildatum traindate - 1 year (only year 1 is observed)
+    - test set: the contracts active at the traindate, with in y_test a column per horizon
+    """
+
+    train_test_sets_name = "hazard_train_test_sets"
+    cache_arguments = DataPreprocessor.cache_arguments + ["horizons", "max_years"]
+
+    def __init__(
+        self,
+        traindate: pd.Timestamp,
+        horizons: list[int],
+        max_years: int | None = None,
+        expand_interval: int = 1,
+        engine: str = PREPARE_ENGINE,
+    ):
+        """Initializes the class.
+
+        Args:
+            traindate (pd.Timestamp): as in DataPreprocessor
+            horizons (list[int]): years ahead with a label in y_test, these have to be known at the traindate + horizon.
+                Horizon 1 is always included, the production model is calibrated on it
+            max_years (int, optional): the model learns the hazards of the years up to max_years (default
+                max(horizons)), so it can score every horizon up to max_years
+        """
+        self.horizons = sorted(set(horizons) | {1})
+        self.max_years = max_years or self.horizons[-1]
+        if self.max_years < self.horizons[-1]:
+            raise ValueError(f"max_years ({self.max_years}) should be at least the largest horizon {self.horizons[-1]}")
+        super().__init__(
+            traindate=traindate,
+            testdate=traindate + pd.DateOffset(years=self.horizons[-1]),
+            years_ahead=1,
+            expand_interval=expand_interval,
+            engine=engine,
+        )
+
+    def __call__(self) -> tuple[dict | None, object]:
+        """Calls the prepare function and returns train_test_sets and preprocessing pipeline."""
+        with stage("prepare", traindate=str(self.traindate.date()), model="hazard"):
+            self.train_test_sets, self.pipe = self._prepare_or_reuse()
+            self._save()
+        return self.train_test_sets, self.pipe
+
+    def _make_expanded_train_test_sets(self) -> None:
+        """Makes the person-period train and calibration sets and the test set, see the class docstring.
+
+        The pipeline is fitted on the yearly rows themselves, so every row is transformed once and repeated per year.
+        y_test is a DataFrame with a column per horizon that is known at the traindate + horizon.
+        """
+        # Hovks that started after traindate will not be used for training & testing
+        self.df = self.df.loc[lambda x: x[COL_STARTDATE] <= self.traindate]
+
+        yearly = self.df.loc[self.df["is_1_januari"]]
+        trainset = yearly[yearly["peildatum"] <= self.traindate - pd.DateOffset(years=1)]
+        # Onderstaande regel is hoe we omgaan met survivorship bias. Zie Confluence voor gemaakte keuzes.
+        trainset = trainset.query("startjaar_huurovereenkomst >= 2002")
+
+        # Laatste peildatum in trainset wordt calibratieset & verwijderd uit trainset
+        max_peildatum = trainset.peildatum.max()
+        self.calibratieset = trainset[trainset.peildatum == max_peildatum]
+        self.trainset = trainset[trainset.peildatum != max_peildatum]
+        self.testset = self.df[self.df["peildatum"] == self.traindate]
+
+        self._get_preprocessing_pipeline()
+        self.pipe.fit(self.trainset[FEATURE_COLUMNS])
+        X_train, y_train = self._person_period_set(self.trainset, observed_until=max_peildatum)
+        X_calibrate, y_calibrate = self._person_period_set(self.calibratieset, observed_until=self.traindate)
+        X_test = pd.DataFrame(
+            self.pipe.transform(self.testset[FEATURE_COLUMNS]), columns=self.pipe.get_feature_names_out()
+        )
+
+        days_to_end = (self.testset[COL_ENDDATE] - self.testset["peildatum"]).dt.days
+        y_test = pd.DataFrame({h: (days_to_end < 365 * h).to_numpy() for h in self.horizons})
+
+        self.train_test_sets = {
+            "X_train": X_train,
+            "X_calibrate": X_calibrate,
+            "X_test": X_test,
+            "y_train": y_train,
+            "y_calibrate": y_calibrate,
+            "y_test": y_test,
+        }
+        return None
+
+    def _person_period_set(self, df: pd.DataFrame, observed_until: pd.Timestamp) -> tuple[pd.DataFrame, pd.Series]:
+        """Transforms the yearly rows of df and repeats them per year k that is at risk and over at observed_until."""
+        rows, intervals, labels = person_period_rows(
+            df["peildatum"], df[COL_ENDDATE], observed_until=observed_until, max_years=self.max_years
+        )
+        X = pd.DataFrame(self.pipe.transform(df[FEATURE_COLUMNS])[rows], columns=self.pipe.get_feature_names_out())
+        X[INTERVAL_COLUMN] = intervals
+        return X, pd.Series(labels, name="hazard_label")
+
+
+def person_period_rows(
+    peildatum: pd.Series, enddate: pd.Series, observed_until: pd.Timestamp, max_years: int
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Person-period expansion of rows with a peildatum and an (optional) end date of the contract.
+
+    Year k after the peildatum is kept if the contract was still active at its start and if the year was over at
+    observed_until. Its label is whether the contract ended in year k, with the day count of COL_LABEL_EVENT:
+    365 * (k - 1) <= days until the end < 365 * k.
+
+    Returns:
+        tuple: positions of the rows in the input, year k and label of every person-period row
+    """
+    days_to_end = (enddate - peildatum).dt.days.to_numpy(dtype="float64")
+    days_observed = (observed_until - peildatum).dt.days.to_numpy()
+    positions, intervals, labels = [], [], []
+    for k in range(1, max_years + 1):
+        # Comparisons with NaN (no end date) are False: active contracts are at risk and have no event
+        at_risk = ~(days_to_end < 365 * (k - 1))
+        keep = np.flatnonzero(at_risk & (days_observed >= 365 * k))
+        positions.append(keep)
+        intervals.append(np.full(len(keep), k))
+        labels.append(days_to_end[keep] < 365 * k)
+    return np.concatenate(positions), np.concatenate(intervals), np.concatenate(labels)
+
+
+def cumulative_probabilities(model, X: pd.DataFrame, horizons: list[int]) -> dict[int, np.ndarray]:
+    """Returns per horizon the probability that a contract ends within that many years, from the yearly hazards.
+
+    Args:
+        model: fitted classifier of the hazard, with INTERVAL_COLUMN as last feature
+        X (pd.DataFrame): transformed rows of the contracts, without INTERVAL_COLUMN
+        horizons (list[int]): years ahead to return the cumulative probabilities of
+    """
+    max_years = max(horizons)
+    stacked = pd.DataFrame(np.tile(X.to_numpy(), (max_years, 1)), columns=X.columns)
+    stacked[INTERVAL_COLUMN] = np.repeat(np.arange(1, max_years + 1), len(X))
+    hazards = model.predict_proba(stacked)[:, 1].reshape(max_years, len(X))
+    survival = np.cumprod(1 - hazards, axis=0)
+    return {h: 1 - survival[h - 1] for h in horizons}
+
+
+class HazardScorer:
+    """Scores active contracts for all horizons with one hazard model, as HorizonScorer does with a model each."""
+
+    def __init__(self, model, pipeline, horizons: list[int]):
+        """model and pipeline as returned by train_and_evaluate_hazard_models and HazardPreprocessor."""
+        self.model = model
+        self.pipeline = pipeline
+        self.horizons = horizons
+
+    def predict(self, df_actief: pd.DataFrame) -> dict[int, np.ndarray]:
+        """Returns per years_ahead the verhuiskans of every row in df_actief (see split_predict_set)."""
+        X = pd.DataFrame(
+            self.pipeline.transform(df_actief[FEATURE_COLUMNS]), columns=self.pipeline.get_feature_names_out()
+        )
+        return cumulative_probabilities(self.model, X, self.horizons)
+
+
+def train_and_evaluate_hazard_models(
+    train_test_sets: dict, display_name: str, traindate_str: str, number_of_experiments: int = 5
+) -> dict:
+    """Train and evaluate hazard models, as train_and_evaluate_models does for the models per horizon.
+
+    1. For each type of algorithm, searches the hyperparameters of the hazard with the best ROC AUC.
+    2. With the best hyperparameters, the CALIBRATION_METHODS are applied to the hazard on the calibration set.
+    3. The cumulative probabilities of every horizon in y_test are evaluated on the test set (ROC AUC, Brier score and
+       a calibration plot per horizon).
+    4. Each model is then trained on train+calibration and calibrated on the first year of the test set.
+    5. All models + info and the calibration plots are returned.
+    """
+    # 0. Setting things up..
+    X_train, y_train = train_test_sets["X_train"], train_test_sets["y_train"]
+    X_calibrate, y_calibrate = train_test_sets["X_calibrate"], train_test_sets["y_calibrate"]
+    X_test, y_test = train_test_sets["X_test"], train_test_sets["y_test"]
+    horizons = list(y_test.columns)
+
+    results = []
+    _, axes = plt.subplots(1, len(horizons), figsize=(10 * len(horizons), 10), squeeze=False)
+    colors = plt.get_cmap("Dark2")
+    color_index = 0
+
+    # 1. Looping over ALGORITHMS
+    for algorithm in ALGORITHMS:
+        search = search_hyperparameters(algorithm, X_train, y_train, number_of_experiments=number_of_experiments)
+        best_model, best_params, cv_roc_auc = search.best_estimator_, search.best_params_, search.best_score_
+
+        # 2. Loop over all CALIBRATION_METHODS with the model best hyperparameters for ranking (= ROC_AUC)
+        for calibration_method in CALIBRATION_METHODS:
+            if calibration_method == "no calibration":
+                calibrated_model = best_model
+            else:
+                calibrated_model = CalibratedClassifierCV(
+                    estimator=FrozenEstimator(best_model), method=calibration_method, ensemble=False
+                )
+                with stage("calibrate", algorithm=algorithm, calibration_method=calibration_method) as span:
+                    calibrated_model.fit(X_calibrate, y_calibrate)
+                    span.set(rows_in=len(X_calibrate))
+
+            # 3. Evaluation of performance: all horizons from one scoring pass
+            cv_calibrated_brier_score = brier_score_loss(
+                y_true=y_calibrate, y_proba=calibrated_model.predict_proba(X_calibrate)[:, 1]
+            )
+            with stage("score", algorithm=algorithm, calibration_method=calibration_method) as span:
+                probabilities = cumulative_probabilities(calibrated_model, X_test, horizons)
+                span.set(rows_in=len(X_test), rows_out=len(X_test) * len(horizons))
+
+            test_roc_auc, test_brier_score = {}, {}
+            for ax, years_ahead in zip(axes[0], horizons):
+                test_roc_auc[years_ahead] = round(roc_auc_score(y_test[years_ahead], probabilities[years_ahead]), 3)
+                test_brier_score[years_ahead] = round(
+                    brier_score_loss(y_test[years_ahead], probabilities[years_ahead]), 3
+                )
+                CalibrationDisplay.from_predictions(
+                    y_true=y_test[years_ahead],
+                    y_prob=probabilities[years_ahead],
+                    n_bins=40,
+                    strategy="quantile",
+                    name=f"{algorithm}_{calibration_method}_AUC_{test_roc_auc[years_ahead]}",
+                    ax=ax,
+                    color=colors(color_index),
+                    marker="o",
+                    markersize=0.2,
+                    linewidth=0.3,
+                )
+                ax.set_title(f"{display_name} YA {years_ahead}")
+            color_index += 1
+
+            # 4. Make model production-ready (meaning: train it on latest data)
+            X_train_prd = pd.concat([X_train, X_calibrate], ignore_index=True)
+            y_train_prd = np.concatenate((y_train, y_calibrate), axis=0)
+            with stage("refit", algorithm=algorithm, calibration_method=calibration_method) as span:
+                prd_model = fit_with_hyperparameters(algorithm, best_params, X_train_prd, y_train_prd)
+
+                # If valid calibration method is selected, it will be done on the first year of the test set
+                calibrated_model = prd_model
+                if calibration_method != "no calibration":
+                    X_calibrate_prd = X_test.assign(**{INTERVAL_COLUMN: 1})
+                    calibrated_model = CalibratedClassifierCV(
+                        estimator=FrozenEstimator(prd_model), method=calibration_method, ensemble=False
+                    )
+                    calibrated_model.fit(X_calibrate_prd, y_test[1])
+                span.set(rows_in=len(X_train_prd))
+
+            # 5. Store result to results
+            results.append(
+                {
+                    "algorithm": algorithm,
+                    "hyperparameters": best_params,
+                    "calibration_method": calibration_method,
+                    "cross_validated_roc_auc": cv_roc_auc,
+                    "test_roc_auc": test_roc_auc,
+                    "cross_validated_brier_score": cv_calibrated_brier_score,
+                    "test_brier_score": test_brier_score,
+                    "model": calibrated_model,
+                }
+            )
+            summary = f"""
+                {display_name}
+                Cross-validated results (yearly hazard)
+                Algorithm: {algorithm}
+                Calibration method: {calibration_method}
+                CV_ROC_AUC: {cv_roc_auc}
+                CV_Brier Score: {cv_calibrated_brier_score}
+                Test_ROC_AUC per years_ahead: {test_roc_auc}
+                Test_Brier Score per years_ahead: {test_brier_score}
+            """
+            logger.info(summary)
+            if LOG_EXPERIMENT_TO_AIM:
+                _log_to_aim(traindate_str, algorithm, calibration_method, results[-1], summary)
+
+    # Calibration plots of all models in the ALGORITHMS/CALIBRATION_METHODS loops, a subplot per horizon
+    for ax in axes[0]:
+        ax.legend()
+    output_filepath = f"{OUTPUTS_DIR}/calibrationplots_hazard_{display_name.replace(' ', '_')}.png"
+    plt.savefig(output_filepath, dpi=300, format="png")
+
+    plot_buffer = BytesIO()
+    plt.savefig(plot_buffer, format="png")
+    plot_buffer.seek(0)
+    plt.close()
+
+    return {"models": results, "calibration_plot": plot_buffer, "horizons": horizons}
+
+
+def _log_to_aim(traindate_str: str, algorithm: str, calibration_method: str, result: dict, summary: str) -> None:
+    """Logs a result of train_and_evaluate_hazard_models to aim, with the test metrics per years_ahead."""
+    from aim import Run, Text
+
+    aim_run = Run(repo=conf.aim_repo, experiment=conf.aim_experiment)
+    aim_run["traindate"] = traindate_str
+    aim_run["model_type"] = "hazard"
+    model_params = copy.deepcopy(result["hyperparameters"])
+    model_params["type"] = algorithm
+    model_params["calibration_method"] = calibration_method
+    aim_run["model"] = model_params
+    aim_run.track(result["cross_validated_roc_auc"], name="AUC", context={"subset": "train"})
+    aim_run.track(result["cross_validated_brier_score"], name="Brier", context={"subset": "train"})
+    for years_ahead, test_roc_auc in result["test_roc_auc"].items():
+        aim_run.track(test_roc_auc, name="AUC", context={"subset": "test", "years_ahead": years_ahead})
+        aim_run.track(
+            result["test_brier_score"][years_ahead],
+            name="Brier",
+            context={"subset": "test", "years_ahead": years_ahead},
+        )
+    aim_run["commit_hash"] = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf-8").strip()
+    aim_run.track(Text(summary), name="summary", context={"subset": "train"})
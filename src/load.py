@@ -1,14 +1,14 @@
-import mltable
+from functools import cache
+
 import numpy as np
 import pandas as pd
-from azure.ai.ml import MLClient
-from azure.identity import DefaultAzureCredential
 
 from src.columns import COL_ENDDATE, COL_HOVK_STATUS, COL_STARTDATE, DATE_COLUMNS
 from src.data_types import DataTypes
 from src.my_logging import logger
 from src.settings import (
     DATASTORENAME_PRD,
+    EXTRACT_FROM_WAREHOUSE,
     INPUT_PATH,
     RGNAME,
     SUBSCRIPTIONID,
@@ -21,6 +21,8 @@ from src.utils.io import (
     save_df_to_csv,
     save_to_pkl,
 )
+from src.utils.stage_cache import cached_stage
+from src.utils.tracing import stage, traced
 
 TOBIAS_AX_DATASET = "vhk_alle_queries_AX_backupp_v2"
 
@@ -33,71 +35,131 @@ DATA_ASSETS = {
     },
     "vhk_alle_queries_v2": {"version": "latest", "type": "mltable", "kwargs": {"dtype": DataTypes.all_datatypes}},
 }
+if EXTRACT_FROM_WAREHOUSE:
+    DATA_ASSETS["vhk_alle_queries_v2"] = {"type": "warehouse", "kwargs": {"dtype": DataTypes.all_datatypes}}
 
 DEFAULT_URI = f"azureml://subscriptions/{SUBSCRIPTIONID}/resourcegroups/{RGNAME}/workspaces/{WORKSPACE_NAME}/datastores/{DATASTORENAME_PRD}/paths/{INPUT_PATH}"  # noqa:E501
 
 
+@traced("load")
 def load_data_assets(for_predict: bool = False) -> None:
     """Laadt alle verhuiskans data assets uit AzureML in op basis van naam en versie, en concat deze.
 
-    Filtert rijen met lege begin/datums eruit. Slaat ze op in raw en interim.
+    Filtert rijen met lege begin/datums eruit. Slaat ze op in raw en interim. Zijn dezelfde versies van de data assets
+    al eens geladen voor trainen, dan komt de samengevoegde data uit de stage cache (zie src/utils/stage_cache.py);
+    predict (for_predict) gebruikt de stage cache niet.
     """
-
-    credential = DefaultAzureCredential()
-    ml_client = MLClient(
-        subscription_id=SUBSCRIPTIONID, resource_group_name=RGNAME, workspace_name=WORKSPACE_NAME, credential=credential
-    )
-
-    dfs = {}
+    data_assets = {}
     for data_asset_name, data_asset_details in DATA_ASSETS.items():
         if for_predict and data_asset_name == TOBIAS_AX_DATASET:
             logger.info(f"Skipping {data_asset_name} because we only require data for predictions")
             continue
 
+        if data_asset_details.get("version") == "latest":
+            data_asset_details["version"] = get_latest_data_asset_version(_get_ml_client(), data_asset_name)
+        data_assets[data_asset_name] = data_asset_details
+
+    if for_predict:
+        # Predict runs once a day on the data of that day, so it would only fill the stage cache with outputs it never
+        # reuses: the stage cache is only used for training
+        df_combined = combine_data_assets.__wrapped__(data_assets, for_predict)
+    elif any(data_asset_details["type"] == "warehouse" for data_asset_details in data_assets.values()):
+        # The warehouse has no versions: every run extracts what changed since the previous run, see src/extract.py
+        df_combined = combine_data_assets.__wrapped__(data_assets, for_predict)
+    else:
+        df_combined = combine_data_assets(data_assets, for_predict)
+
+    with stage("save") as span:
+        df_combined_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
+        save_to_pkl(df_combined, df_combined_path)
+        span.set(rows_out=len(df_combined), bytes_written=df_combined_path.stat().st_size)
+    return None
+
+
+@cached_stage(
+    LEVEL.LOAD,
+    code=["src.data_types", "src.columns"],
+    settings_used=["WORKSPACE_NAME", "DATASTORENAME_PRD", "INPUT_PATH"],
+)
+def combine_data_assets(data_assets: dict[str, dict], for_predict: bool) -> pd.DataFrame:
+    """Downloads the data assets (with their version resolved) and combines them into df_combined.
+
+    Args:
+        data_assets (dict[str, dict]): the items of DATA_ASSETS to load, the version of an AML asset is part of the key
+            of the stage cache
+        for_predict (bool): whether the data is loaded for predict, see load_data_assets
+
+    Returns:
+        pd.DataFrame: df_combined
+    """
+    dfs = {}
+    for data_asset_name, data_asset_details in data_assets.items():
         logger.info(f"loading {data_asset_name} data")
 
-        if data_asset_details["version"] == "latest":
-            data_asset_details["version"] = get_latest_data_asset_version(ml_client, data_asset_name)
+        with stage("download", asset=data_asset_name) as span:
+            if data_asset_details["type"] == "warehouse":
+                # Only the contracts that changed since the previous run are queried, see src/extract.py
+                from src.extract import IncrementalExtractor, connect_warehouse
+
+                df = IncrementalExtractor(connect_warehouse()).extract()
 
-        data_asset = ml_client.data.get(data_asset_name, version=int(data_asset_details["version"]))
+            elif data_asset_details["type"] == "mltable":
+                import mltable
 
-        if data_asset_details["type"] == "mltable":
-            tbl = mltable.load(data_asset.path)
-            df = tbl.to_pandas_dataframe()
+                data_asset = _get_ml_client().data.get(data_asset_name, version=int(data_asset_details["version"]))
+                tbl = mltable.load(data_asset.path)
+                df = tbl.to_pandas_dataframe()
 
-        elif data_asset_details["type"] == "file":
-            separator = ";"
+            elif data_asset_details["type"] == "file":
+                data_asset = _get_ml_client().data.get(data_asset_name, version=int(data_asset_details["version"]))
+                separator = ";"
 
-            uri = f"{DEFAULT_URI}/{data_asset_details['filename']}"
-            df = pd.read_csv(uri, sep=separator, **data_asset_details["kwargs"])
+                uri = f"{DEFAULT_URI}/{data_asset_details['filename']}"
+                df = pd.read_csv(uri, sep=separator, **data_asset_details["kwargs"])
+            span.set(rows_out=len(df))
 
-        save_df_to_csv(LEVEL.LOAD, data_asset_name, df)
+        with stage("save_and_reload", asset=data_asset_name) as span:
+            csv_path = save_df_to_csv(LEVEL.LOAD, data_asset_name, df)
 
-        df = load_df_from_csv(LEVEL.LOAD, data_asset_name, **data_asset_details["kwargs"])
-        df[DATE_COLUMNS] = df[DATE_COLUMNS].apply(pd.to_datetime)
+            df = load_df_from_csv(LEVEL.LOAD, data_asset_name, **data_asset_details["kwargs"])
+            df[DATE_COLUMNS] = df[DATE_COLUMNS].apply(pd.to_datetime)
+            span.set(rows_out=len(df), bytes_written=csv_path.stat().st_size, bytes_read=csv_path.stat().st_size)
         dfs[data_asset_name] = df
 
-    dfs_path = generate_data_dir_path(LEVEL.LOAD, "dfs_with_datatypes", suffix=".pickle")
-    save_to_pkl(dfs, dfs_path)
+    with stage("combine") as span:
+        dfs_path = generate_data_dir_path(LEVEL.LOAD, "dfs_with_datatypes", suffix=".pickle")
+        save_to_pkl(dfs, dfs_path)
 
-    if for_predict:
-        df_combined = dfs["vhk_alle_queries_v2"]
-    else:
-        df_combined = pd.concat([dfs["vhk_alle_queries_v2"], dfs[TOBIAS_AX_DATASET]], axis=0).reset_index(drop=True)
+        if for_predict:
+            df_combined = dfs["vhk_alle_queries_v2"]
+        else:
+            df_combined = pd.concat([dfs["vhk_alle_queries_v2"], dfs[TOBIAS_AX_DATASET]], axis=0).reset_index(drop=True)
 
-    df_combined["survival_eindjaar"] = df_combined[COL_ENDDATE].dt.year
-    df_combined[COL_ENDDATE] = df_combined[COL_ENDDATE].dt.normalize()
+        df_combined["survival_eindjaar"] = df_combined[COL_ENDDATE].dt.year
+        df_combined[COL_ENDDATE] = df_combined[COL_ENDDATE].dt.normalize()
 
-    # Beëindigd en historisch betekent praktisch hetzelfde. Deze trekken we gelijk.
-    df_combined.replace({COL_HOVK_STATUS: {"Historisch": "Beëindigd"}}, inplace=True)
-    if not for_predict:
-        # For train we don't want 'Opgezegd', for predict we want to keep it: it's highly informative
-        df_combined = df_combined.query("huurovereenkomst_statusnaam != 'Opgezegd'")
+        # Beëindigd en historisch betekent praktisch hetzelfde. Deze trekken we gelijk.
+        df_combined.replace({COL_HOVK_STATUS: {"Historisch": "Beëindigd"}}, inplace=True)
+        if not for_predict:
+            # For train we don't want 'Opgezegd', for predict we want to keep it: it's highly informative
+            df_combined = df_combined.query("huurovereenkomst_statusnaam != 'Opgezegd'")
 
-    datakwaliteitscontrole(df_combined)
-    df_combined_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
-    save_to_pkl(df_combined, df_combined_path)
-    return None
+        datakwaliteitscontrole(df_combined)
+        span.set(rows_in=sum(len(df) for df in dfs.values()), rows_out=len(df_combined))
+    return df_combined
+
+
+@cache
+def _get_ml_client():
+    """Returns the Azure ML client of the workspace, created on first use."""
+    # The Azure ML SDKs are slow to import, so they are only imported when data is actually loaded
+    from azure.ai.ml import MLClient
+    from azure.identity import DefaultAzureCredential
+
+    credential = DefaultAzureCredential()
+    return MLClient(
+        subscription_id=SUBSCRIPTIONID, resource_group_name=RGNAME, workspace_name=WORKSPACE_NAME, credential=credential
+    )
 
 
 def get_latest_data_asset_version(ml_client, data_asset_name) -> str:
@@ -0,0 +1,109 @@
+"""Load test for the single-contract scoring service in src/serve.py.
+
+Starts the service locally on synthetic contracts and synthetic models, fires requests from a number of concurrent
+clients and reports the latency percentiles and throughput. Example:
+
+python src/loadtest.py --contracts 50000 --requests 5000 --concurrency 4 --batch-size 1
+"""
+import argparse
+import http.client
+import json
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.columns import COL_ID_HOVK
+from src.my_logging import logger
+from src.serve import ScoringService, create_server
+from src.utils import get_timestamp
+from src.utils.synthetic import fit_synthetic_models, make_synthetic_contracts
+
+
+def run_load_test(
+    n_contracts: int, n_requests: int, concurrency: int, batch_size: int, seed: int = 0, output_dir: str | None = None
+) -> dict:
+    """Runs the load test and returns (and logs) the latency and throughput report."""
+    logger.info(f"Building scoring service on {n_contracts} synthetic contracts..")
+    df_combined = make_synthetic_contracts(n_contracts, seed=seed, for_predict=True)
+    service = ScoringService(df_combined, fit_synthetic_models(df_combined, seed=seed), max_batch_size=batch_size)
+
+    server = create_server(service, host="127.0.0.1", port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(service.ids_hovk, size=(n_requests, batch_size))
+    latencies = np.zeros(n_requests, dtype=np.float64)
+    statuses = np.zeros(n_requests, dtype=np.int64)
+
+    def client(request_numbers: range) -> None:
+        connection = http.client.HTTPConnection(host, port)
+        for i in request_numbers:
+            # As bytes, so http.client sends headers and body in a single packet
+            body = json.dumps({COL_ID_HOVK: ids[i].tolist()}).encode("utf-8")
+            t0 = time.perf_counter()
+            connection.request("POST", "/verhuiskans", body=body, headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            response.read()
+            latencies[i] = time.perf_counter() - t0
+            statuses[i] = response.status
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(range(c, n_requests, concurrency),)) for c in range(concurrency)]
+    t_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - t_start
+    server.shutdown()
+
+    report = {
+        "contracts": n_contracts,
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "batch_size": batch_size,
+        "errors": int((statuses != 200).sum()),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "max_ms": float(latencies.max() * 1000),
+        "requests_per_second": n_requests / duration,
+    }
+    logger.info(
+        f"Load test: {report['requests']} requests (batch size {batch_size}, concurrency {concurrency}): "
+        f"p50 {report['p50_ms']:.2f} ms, p99 {report['p99_ms']:.2f} ms, "
+        f"{report['requests_per_second']:.0f} requests/s, {report['errors']} errors"
+    )
+
+    if output_dir is not None:
+        output_path = Path(output_dir) / f"loadtest_{get_timestamp()}.json"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Load test report saved to {output_path}")
+
+    return report
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", help="number of synthetic contracts", type=int, default=50_000)
+    parser.add_argument("--requests", help="total number of requests", type=int, default=5_000)
+    parser.add_argument("--concurrency", help="number of concurrent clients", type=int, default=4)
+    parser.add_argument("--batch-size", help="number of IDs per request", type=int, default=1)
+    parser.add_argument("--output-dir", help="folder to save the report as json", type=str, default="reports")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    run_load_test(
+        n_contracts=args.contracts,
+        n_requests=args.requests,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        output_dir=args.output_dir,
+    )
@@ -1,74 +1,86 @@
 from datetime import datetime
+from pathlib import Path
 
-import pandas as pd
-
-from src.columns import COL_HOVK_STATUS, COL_ID_EENHEID, COL_ID_HOVK, FEATURE_COLUMNS
 from src.load import load_data_assets
 from src.my_logging import logger
-from src.prepare import create_peildatum_based_variables
-from src.settings import PRODUCTIONIZED_MODELS
-from src.utils.aml_models import get_model_from_AML
+from src.score import score_horizons, score_in_chunks, split_predict_set
+from src.settings import OUTPUTS_DIR, PREDICT_CHUNK_SIZE, PRODUCTIONIZED_MODELS
+from src.utils.aml_models import get_models_from_AML
 from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl
 from src.utils.msteams import log_result_to_MS_teams
-from src.utils.save_to_datalake import save_outputs_to_datalake
+from src.utils.save_to_datalake import (
+    save_outputs_to_datalake,
+    upload_outputs_to_datalake,
+)
+from src.utils.tracing import stage, traced
+from src.utils.upload_manager import UploadManager
 
 
-def generate_verhuiskansen() -> None:
+@traced("predict")
+def generate_verhuiskansen() -> UploadManager:
     """Genereert verhuiskansen en slaat deze op op het datalake.
 
     - Haalt de meest recente data op om voorspellingen te doen
-    - Loopt over PRODUCTIONIZED_MODELS, duwt recente data door pipeline en genereert verhuiskans
+    - Berekent de peildatum-variabelen van de actieve huurovereenkomsten eenmalig voor alle PRODUCTIONIZED_MODELS
+    - Duwt deze data eenmalig door elke unieke pipeline en genereert per model een verhuiskans
     - Plakt verhuiskansen van elk model onder elkaar en slaat deze op op het datalake
+
+    Als PREDICT_CHUNK_SIZE is gezet, gebeurt dit per chunk van actieve huurovereenkomsten en wordt elke chunk direct
+    naar een lokale parquet-dataset geschreven. Het geheugengebruik hangt dan af van de chunkgrootte.
+
+    De uploads naar het datalake lopen op de achtergrond door: wacht met wait() op de teruggegeven UploadManager
+    tot alle bestanden zijn geüpload.
     """
-    # Initialize outputs
-    outputs = []
     # Loading in data assets is not parametrized as we assume you would always want the latest data.
     load_data_assets(for_predict=True)
 
-    # Load in data, filter only the active huurovereenkomsten
+    with stage("load_models") as span:
+        model_dicts = get_models_from_AML(PRODUCTIONIZED_MODELS)
+        span.set(models=len(model_dicts))
+    models = {years_ahead: {**model_dicts[years_ahead], **info} for years_ahead, info in PRODUCTIONIZED_MODELS.items()}
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
     df_combined_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
     df_combined = load_from_pkl(df_combined_path)
-    df_combined["peildatum"] = datetime.today()
-
-    for years_ahead, model_info in PRODUCTIONIZED_MODELS.items():
-        logger.info(f"Predicting {years_ahead} year(s) ahead..")
-
-        version_name = model_info["version_name"]
-        version_number = model_info["version_number"]
-        model_dict = get_model_from_AML(version_name=version_name, version_number=version_number)
-
-        model = model_dict["model"]
-        pipeline = model_dict["pipeline"]
 
-        # Actieve huurovereenkomsten krijgen voorspelde verhuiskans
-        df_actief = df_combined.loc[df_combined[COL_HOVK_STATUS] == "Actief"].copy()
-        df_actief = create_peildatum_based_variables(df=df_actief, years_ahead=years_ahead)
-        X = pd.DataFrame(pipeline.transform(df_actief[FEATURE_COLUMNS]), columns=pipeline.get_feature_names_out())
-        predictions = pd.Series(model.predict_proba(X)[:, 1], name="verhuiskans")
-        df_actief = pd.concat([df_actief[[COL_ID_HOVK, COL_ID_EENHEID]], predictions], axis=1)
+    if PREDICT_CHUNK_SIZE:
+        with stage("score_in_chunks", chunk_size=PREDICT_CHUNK_SIZE) as span:
+            outputs_path = score_in_chunks(
+                df_combined,
+                models=models,
+                peildatum=datetime.today(),
+                timestamp=timestamp,
+                path=Path(OUTPUTS_DIR) / "verhuiskansen",
+                chunk_size=PREDICT_CHUNK_SIZE,
+            )
+            span.set(rows_in=len(df_combined), bytes_written=_folder_size(outputs_path))
+        with stage("save"):
+            return upload_outputs_to_datalake(outputs_path)
 
-        # Opgezegde huurovereenkomsten krijgen verhuiskans van 1.0
-        df_opgezegd = df_combined.loc[df_combined[COL_HOVK_STATUS] == "Opgezegd", [COL_ID_HOVK, COL_ID_EENHEID]].copy()
-        df_opgezegd["verhuiskans"] = 1.0
+    # Split into active contracts (to predict) and terminated contracts
+    with stage("score") as span:
+        rows_in = len(df_combined)
+        df_actief, df_opgezegd = split_predict_set(df_combined, peildatum=datetime.today())
+        del df_combined
 
-        output = pd.concat([df_actief, df_opgezegd], axis=0, ignore_index=True)
-        output["aantal_jaar_vooruit"] = years_ahead
-        output["voorspellingslabel"] = f"binnen {years_ahead} jaar"
-        output["modelnaam"] = version_name
-        output["modelversie"] = version_number
-        output["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        outputs = score_horizons(df_actief, df_opgezegd, models=models, timestamp=timestamp)
+        span.set(rows_in=rows_in, rows_out=len(outputs))
 
-        outputs.append(output)
+    with stage("save") as span:
+        uploads = save_outputs_to_datalake(outputs)
+        span.set(rows_in=len(outputs), bytes_written=_folder_size(Path(OUTPUTS_DIR) / "verhuiskansen"))
+    return uploads
 
-    outputs = pd.concat(outputs, axis=0, ignore_index=True)
-    save_outputs_to_datalake(outputs)
 
-    return None
+def _folder_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
 
 
 if __name__ == "__main__":
     try:
-        generate_verhuiskansen()
+        uploads = generate_verhuiskansen()
+        with stage("upload") as span:
+            span.set(bytes_written=uploads.shutdown())
         message = "VERHUISKANS ALGORITME: predict run succesvol afgerond"
         logger.info(message)
         log_result_to_MS_teams(message)
@@ -1,11 +1,17 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import partial
 from multiprocessing import Pool
 from pathlib import Path
 
 import pandas as pd
 import randomname
+from omegaconf import OmegaConf
+from sklearn.compose import ColumnTransformer
 
+from src.hazard import HazardPreprocessor, train_and_evaluate_hazard_models
 from src.load import load_data_assets
 from src.my_logging import logger
 from src.prepare import DataPreprocessor
@@ -15,12 +21,23 @@ from src.settings import (
     LOAD_DATA_FROM_AML,
     MODEL_DIR,
     PARALLELIZE,
+    PIPELINE_TRAIN_JOBS,
+    RESUME_TRAIN_RUNS,
+    STABILITY_RUNS_REUSE_HYPERPARAMETERS,
+    TRACE_DIR,
+    TRAIN_HAZARD_MODEL,
+    USE_STAGE_CACHE,
     azure,
     conf,
 )
 from src.train import train_and_evaluate_models
+from src.utils import get_timestamp
 from src.utils.aml_models import upload_model_to_AML
-from src.utils.io import load_from_pkl, save_to_pkl
+from src.utils.checkpoint import JobCheckpoint, RunCheckpoint, run_unit
+from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl, save_to_pkl
+from src.utils.stage_cache import get_stage_cache, imported_source_files, stage_key
+from src.utils.timeline import TimelineExporter
+from src.utils.tracing import get_exporters, set_exporters, stage
 
 pd.set_option("future.no_silent_downcasting", True)
 
@@ -33,6 +50,14 @@ def run_train_jobs():
         processing of cross-validation in train. Still it's a bit quicker.
     - If not PARALLELIZE, even though you run train jobs consecutively, cross-validation
         in train is done in parallel.
+
+    If RESUME_TRAIN_RUNS, every job and its units (prepare, search, calibration, evaluation, refit) are checkpointed
+    (see src.utils.checkpoint): a rerun of a run that crashed or was preempted skips what was completed before. With
+    USE_STAGE_CACHE, prepare is not checkpointed, since the stage cache already holds its output.
+
+    If STABILITY_RUNS_REUSE_HYPERPARAMETERS, the production jobs (see settings.conf.data.production_dates) run first
+    and the other jobs are stability runs with the hyperparameters of the production job of the same years_ahead, see
+    train_and_evaluate_models.
     """
     exp_name = azure.project_name
     logger.info(f"Experiment name: {exp_name}")
@@ -45,67 +70,286 @@ def run_train_jobs():
 
     processes = [(traindate, years_ahead) for traindate in traindates for years_ahead in years_ahead_list]
     processes = sorted(processes, key=lambda x: (x[1], x[0]))
+    run_checkpoint = _get_run_checkpoint(processes)
+
+    if STABILITY_RUNS_REUSE_HYPERPARAMETERS:
+        production = [job for job in processes if conf.data.production_dates[job[1]] == job[0]]
+        production_hyperparameters = dict(zip([job[1] for job in production], _run_jobs(production, run_checkpoint)))
+        stability = [
+            (traindate, years_ahead, production_hyperparameters.get(years_ahead))
+            for traindate, years_ahead in processes
+            if (traindate, years_ahead) not in production
+        ]
+        for years_ahead in sorted({job[1] for job in stability if job[2] is None}):
+            logger.warning(
+                f"No hyperparameters of a production job for years_ahead {years_ahead} (not in the jobs, or skipped): "
+                "its stability runs search their own hyperparameters."
+            )
+        _run_jobs(stability, run_checkpoint)
+    else:
+        _run_jobs(processes, run_checkpoint)
+
+    if TRAIN_HAZARD_MODEL:
+        for traindate in traindates:
+            _train_hazard_pipeline(traindate, run_checkpoint)
+
+    if run_checkpoint is not None:
+        run_checkpoint.remove()
+
+
+def _get_run_checkpoint(processes: list[tuple[str, int]]) -> RunCheckpoint | None:
+    """Returns the checkpoints of this run if RESUME_TRAIN_RUNS, else None.
+
+    The run is identified by its jobs, conf, the code of every module of src that main_train imports (src/settings.py
+    included, so every setting) and the data (df_combined): after a crash the same run resumes, after a change to any
+    of these it starts over.
+    """
+    if not RESUME_TRAIN_RUNS:
+        return None
+    run_key = stage_key(
+        get_stage_cache(),
+        [
+            processes,
+            OmegaConf.to_container(conf),
+            imported_source_files("src.main_train"),
+            generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle"),
+        ],
+    )
+    run_checkpoint = RunCheckpoint(generate_data_dir_path(LEVEL.TRAIN, f"checkpoints/{run_key[:16]}"))
+    logger.info(f"Checkpoints of this run: {run_checkpoint.run_dir}")
+    return run_checkpoint
 
+
+def _run_jobs(jobs: list[tuple], run_checkpoint: RunCheckpoint | None = None) -> list[dict[str, dict] | None]:
+    """Runs _train_pipeline for every job, in parallel if PARALLELIZE, and returns the results in the order of jobs.
+
+    If not PARALLELIZE but PIPELINE_TRAIN_JOBS, the jobs are pipelined, see _run_jobs_pipelined.
+    """
     if PARALLELIZE:
         logger.warning(
             "You are parallelizing the train runs. Ensure you run it from a compute with sufficient cores and RAM."
         )
         with Pool() as pool:
-            pool.map(_train_pipeline, processes)  # Parallel execution
-    else:
-        for train_job in processes:
-            _train_pipeline(train_job)
+            return pool.map(partial(_train_pipeline, run_checkpoint=run_checkpoint), jobs)  # Parallel execution
+    if PIPELINE_TRAIN_JOBS:
+        return _run_jobs_pipelined(jobs, run_checkpoint)
+    return [_train_pipeline(train_job, run_checkpoint=run_checkpoint) for train_job in jobs]
+
 
+def _run_jobs_pipelined(jobs: list[tuple], run_checkpoint: RunCheckpoint | None = None) -> list[dict[str, dict] | None]:
+    """Runs the jobs as _run_jobs does, but overlaps the I/O of one job with the training of another.
 
-def _train_pipeline(args: tuple[str, int]) -> None:
+    While a job trains (in this thread), a background worker prepares the next job (loading df_combined, expanding,
+    transforming) and another one saves the artifacts of the previous job. So at most three jobs are in memory at
+    once. The prepare, train and save stages are drawn per worker in a timeline in TRACE_DIR (see
+    src.utils.timeline), which shows the overlap that was achieved.
+    """
+    timeline = TimelineExporter(stages=["prepare", "train", "save_job"])
+    exporters = get_exporters()
+    set_exporters(exporters + [timeline])
+    try:
+        prepared_jobs, saves = [], []
+        with ThreadPoolExecutor(1, thread_name_prefix="prepare") as preparer, ThreadPoolExecutor(
+            1, thread_name_prefix="save"
+        ) as saver:
+            next_job = preparer.submit(_prepare_job, jobs[0], run_checkpoint) if jobs else None
+            for i in range(len(jobs)):
+                job = next_job.result()
+                if i + 1 < len(jobs):
+                    next_job = preparer.submit(_prepare_job, jobs[i + 1], run_checkpoint)
+                if not job.done:
+                    saves.append(saver.submit(_save_job, job, _train_job(job)))
+                prepared_jobs.append(job)
+            for save in saves:
+                save.result()  # Raises the exception of a failed save
+    finally:
+        set_exporters(exporters)
+        timeline.save(Path(TRACE_DIR) / f"timeline_{get_timestamp()}.png")
+    return [job.result for job in prepared_jobs]
+
+
+@dataclass
+class TrainJob:
+    """A job of _train_pipeline between its phases: _prepare_job, _train_job and _save_job."""
+
+    traindate: pd.Timestamp
+    testdate: pd.Timestamp
+    years_ahead: int
+    hyperparameters: dict[str, dict] | None
+    basic_logging: str
+    checkpoint: JobCheckpoint | None = None
+    train_test_sets: dict | None = None
+    pipeline: ColumnTransformer | None = None
+    # Whether nothing is left to do, and the hyperparameters per algorithm (None if the job is skipped)
+    done: bool = False
+    result: dict[str, dict] | None = None
+
+    @property
+    def traindate_str(self) -> str:
+        return str(self.traindate)[:10]
+
+    @property
+    def testdate_str(self) -> str:
+        return str(self.testdate)[:10]
+
+
+def _train_pipeline(
+    args: tuple[str, int] | tuple[str, int, dict[str, dict] | None], run_checkpoint: RunCheckpoint | None = None
+) -> dict[str, dict] | None:
     """Main function for loading-preprocessing-training of a given traindate + years_ahead.
 
     - it prepares the data into temporal train/test splits
     - it trains models on the data
     - it evaluates the model on the test set
     - it saves the outputs if it's a run that might be productionized (see settings.conf.data.production_dates)
+
+    If args has hyperparameters per algorithm as third element, it is a stability run with these hyperparameters (see
+    train_and_evaluate_models) and nothing is saved.
+
+    With run_checkpoint, a job that was completed before in this run is skipped and an incomplete one resumes at its
+    first incomplete unit.
+
+    Returns:
+        dict: the hyperparameters per algorithm, or None if the job is skipped
     """
-    traindate, years_ahead = args
+    with stage("train_job", traindate=str(args[0])[:10], years_ahead=args[1]):
+        job = _prepare_job(args, run_checkpoint)
+        if not job.done:
+            _save_job(job, _train_job(job))
+    return job.result
+
+
+def _prepare_job(
+    args: tuple[str, int] | tuple[str, int, dict[str, dict] | None], run_checkpoint: RunCheckpoint | None = None
+) -> TrainJob:
+    """Prepares the train_test_sets of a job of _train_pipeline, unless it is skipped or was completed before."""
+    traindate, years_ahead = args[:2]
+    hyperparameters = args[2] if len(args) > 2 else None
     traindate = pd.to_datetime(traindate)
     testdate = traindate + pd.offsets.DateOffset(years=years_ahead)
-    traindate_str = str(traindate)[:10]
-    testdate_str = str(testdate)[:10]
 
-    basic_logging = f"TRAINDATE {traindate_str} TESTDATE {testdate_str} YA {years_ahead}:"
+    basic_logging = f"TRAINDATE {str(traindate)[:10]} TESTDATE {str(testdate)[:10]} YA {years_ahead}:"
+    if hyperparameters is not None:
+        basic_logging = f"{basic_logging} (stability run)"
+    job = TrainJob(traindate, testdate, years_ahead, hyperparameters, basic_logging)
 
     if testdate > datetime.today():
         logger.info(f"{basic_logging} Testdate is in the future and therefore skipped.")
-        return None
+        job.done = True
+        return job
+
+    if run_checkpoint is not None:
+        job.checkpoint = run_checkpoint.job(f"{job.traindate_str}_{years_ahead}")
+        if job.checkpoint.completed("job"):
+            logger.info(f"{basic_logging} Completed before in this run and therefore skipped.")
+            job.done, job.result = True, job.checkpoint.load("job")
+            return job
 
     logger.info(f"{basic_logging} Preparing data..")
     preprocessor = DataPreprocessor(traindate=traindate, testdate=testdate, years_ahead=years_ahead)
-    train_test_sets, pipeline = preprocessor()
-
-    logger.info(f"{basic_logging} Training model..")
-    model_dict = train_and_evaluate_models(
-        train_test_sets=train_test_sets,
-        display_name=basic_logging,
-        traindate_str=traindate_str,
-        testdate_str=testdate_str,
-        years_ahead=years_ahead,
-    )
-
-    model_dict["train_test_sets"] = train_test_sets
-    model_dict["pipeline"] = pipeline
-    model_dict["traindate"] = traindate
-    model_dict["testdate"] = testdate
-    model_dict["years_ahead"] = years_ahead
-
-    if conf.data.production_dates[years_ahead] == traindate_str:
-        logger.info(f"{basic_logging} Saving potential models to productionize to {MODEL_DIR}/.")
-        os.makedirs(f"./{MODEL_DIR}/trained/", exist_ok=True)
-        model_path = Path(
-            f"./{MODEL_DIR}/trained/{azure.project_name}_traindate_{traindate_str}_testdate_{testdate_str}.pickle"
+    # The stage cache already holds the output of prepare, a checkpoint would store it a second time
+    prepare_checkpoint = None if USE_STAGE_CACHE else job.checkpoint
+    job.train_test_sets, job.pipeline = run_unit(prepare_checkpoint, "prepare", preprocessor)
+    return job
+
+
+def _train_job(job: TrainJob) -> dict:
+    """Trains and evaluates the models of a prepared job and returns them, see train_and_evaluate_models."""
+    logger.info(f"{job.basic_logging} Training model..")
+    with stage("train", traindate=job.traindate_str, years_ahead=job.years_ahead):
+        model_dict = train_and_evaluate_models(
+            train_test_sets=job.train_test_sets,
+            display_name=job.basic_logging,
+            traindate_str=job.traindate_str,
+            testdate_str=job.testdate_str,
+            years_ahead=job.years_ahead,
+            hyperparameters=job.hyperparameters,
+            checkpoint=job.checkpoint,
         )
-        save_to_pkl(model_dict, model_path)
-    else:
-        logger.info(f"{basic_logging} Run was only to assess stability over time, models are not saved.")
+    job.result = {model["algorithm"]: model["hyperparameters"] for model in model_dict["models"]}
+    search_cache = model_dict["search_cache"]
+    logger.info(f"{job.basic_logging} Search cache: {search_cache['hits']} hits, {search_cache['misses']} misses.")
+    return model_dict
+
+
+def _save_job(job: TrainJob, model_dict: dict) -> None:
+    """Saves the models of a trained job if it's a run that might be productionized and records it as completed."""
+    with stage("save_job", traindate=job.traindate_str, years_ahead=job.years_ahead) as span:
+        if job.hyperparameters is not None:
+            logger.info(f"{job.basic_logging} Run was only to assess stability over time, models are not saved.")
+        elif conf.data.production_dates[job.years_ahead] == job.traindate_str:
+            model_dict["train_test_sets"] = job.train_test_sets
+            model_dict["pipeline"] = job.pipeline
+            model_dict["traindate"] = job.traindate
+            model_dict["testdate"] = job.testdate
+            model_dict["years_ahead"] = job.years_ahead
+
+            logger.info(f"{job.basic_logging} Saving potential models to productionize to {MODEL_DIR}/.")
+            os.makedirs(f"./{MODEL_DIR}/trained/", exist_ok=True)
+            model_path = Path(
+                f"./{MODEL_DIR}/trained/{azure.project_name}_traindate_{job.traindate_str}_testdate_{job.testdate_str}.pickle"  # noqa: E501
+            )
+            save_to_pkl(model_dict, model_path)
+            span.set(bytes_written=model_path.stat().st_size)
+        else:
+            logger.info(f"{job.basic_logging} Run was only to assess stability over time, models are not saved.")
+
+        if job.checkpoint is not None:
+            job.checkpoint.finish(job.result)
+    job.train_test_sets = job.pipeline = None
+    return None
+
+
+def _train_hazard_pipeline(traindate: str, run_checkpoint: RunCheckpoint | None = None) -> None:
+    """Loading-preprocessing-training of the hazard model (see src.hazard) of a given traindate.
+
+    The model learns the hazards up to the largest years_ahead, it is evaluated on every years_ahead whose testdate is
+    in the past. It is saved if traindate is the production date of the most recent model (1 year ahead). With
+    run_checkpoint, it is skipped if it was completed before in this run.
+    """
+    traindate = pd.to_datetime(traindate)
+    traindate_str = str(traindate)[:10]
+    years_ahead_list = conf.data.test_date_years_ahead
+    horizons = [y for y in years_ahead_list if traindate + pd.offsets.DateOffset(years=y) <= datetime.today()]
+
+    basic_logging = f"TRAINDATE {traindate_str} HAZARD YA {horizons}:"
+
+    if traindate + pd.offsets.DateOffset(years=1) > datetime.today():
+        logger.info(f"{basic_logging} Testdate of 1 year ahead is in the future and therefore skipped.")
+        return None
+
+    checkpoint = run_checkpoint.job(f"{traindate_str}_hazard") if run_checkpoint is not None else None
+    if checkpoint is not None and checkpoint.completed("job"):
+        logger.info(f"{basic_logging} Completed before in this run and therefore skipped.")
+        return None
+
+    with stage("train_job", traindate=traindate_str, model="hazard"):
+        logger.info(f"{basic_logging} Preparing data..")
+        preprocessor = HazardPreprocessor(traindate=traindate, horizons=horizons, max_years=max(years_ahead_list))
+        train_test_sets, pipeline = preprocessor()
+
+        logger.info(f"{basic_logging} Training model..")
+        with stage("train", traindate=traindate_str, model="hazard"):
+            model_dict = train_and_evaluate_hazard_models(
+                train_test_sets=train_test_sets, display_name=basic_logging, traindate_str=traindate_str
+            )
+
+        model_dict["pipeline"] = pipeline
+        model_dict["traindate"] = traindate
+        model_dict["max_years"] = preprocessor.max_years
+
+        if conf.data.production_dates[min(years_ahead_list)] == traindate_str:
+            logger.info(f"{basic_logging} Saving potential models to productionize to {MODEL_DIR}/trained_hazard/.")
+            os.makedirs(f"./{MODEL_DIR}/trained_hazard/", exist_ok=True)
+            model_path = Path(
+                f"./{MODEL_DIR}/trained_hazard/{azure.project_name}_hazard_traindate_{traindate_str}.pickle"
+            )
+            save_to_pkl(model_dict, model_path)
+        else:
+            logger.info(f"{basic_logging} Run was only to assess stability over time, models are not saved.")
 
+    if checkpoint is not None:
+        checkpoint.finish(None)
     return None
 
 
@@ -1,23 +1,43 @@
+import atexit
 import datetime
 import logging
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 
-from azure.monitor.opentelemetry import configure_azure_monitor
-
 APPI_NAMESPACE = "datascience"
+LOG_DIR = "logs"
+# Processes started by a run (e.g. the train jobs with PARALLELIZE) inherit this variable and log to the same file
+LOG_FILE_ENV_VAR = "VHK_LOG_FILE"
+
+_listeners: dict[str, logging.handlers.QueueListener] = {}
 
 
 def setup_logging(project_afkorting: str):
-    """Initiazes the logger."""
+    """Initiazes the logger.
+
+    Log calls only put the record on a queue; a background listener thread writes it to the log file and the console
+    (and Application Insights, if configured), so logging does not block on disk or on the exporter. There is one log
+    file per run: processes started by the run (multiprocessing workers, spawned or forked) append to the file of the
+    process that started them. Calling setup_logging again (e.g. on a re-import) returns the same logger.
+    """
     logger = logging.getLogger(project_afkorting)
+    if project_afkorting in _listeners:
+        return logger
+
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    logpath = Path("logs") / f"run_{timestamp}.txt"
+
+    if os.environ.get(LOG_FILE_ENV_VAR):
+        logpath = Path(os.environ[LOG_FILE_ENV_VAR])
+    else:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        logpath = Path(LOG_DIR) / f"run_{timestamp}.txt"
+        os.environ[LOG_FILE_ENV_VAR] = str(logpath)
     logpath.parent.mkdir(exist_ok=True, parents=True)
 
-    file_handler = logging.FileHandler(logpath, mode="w")
+    file_handler = logging.FileHandler(logpath, mode="a")
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(logging.DEBUG)
     handlers = [file_handler, stream_handler]
@@ -28,7 +48,6 @@ def setup_logging(project_afkorting: str):
     )
     for handler in handlers:
         handler.setFormatter(formatter_other)
-        logger.addHandler(handler)
 
     try:
         conn_str = os.environ["APPLICATION_INSIGHTS_CONNECTION_STRING"]
@@ -37,9 +56,48 @@ def setup_logging(project_afkorting: str):
     except Exception as e:
         print(f"\n\n\n Azure handler failed for logger with error: {e}\n\n\n")
 
+    # configure_azure_monitor attaches its handler to the logger itself; it is moved behind the queue as well
+    handlers += logger.handlers
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    logger.addHandler(logging.handlers.QueueHandler(queue.SimpleQueue()))
+    _start_listener(project_afkorting, handlers)
+
     return logger
 
 
+def _start_listener(name: str, handlers: list[logging.Handler]) -> None:
+    """Starts the thread that hands the queued records of logger name to handlers."""
+    queue_handler = logging.getLogger(name).handlers[0]
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[name] = listener
+
+
+def _stop_listeners() -> None:
+    """Writes all queued records before the process exits."""
+    while _listeners:
+        _, listener = _listeners.popitem()
+        listener.stop()
+
+
+def _restart_listeners_in_child() -> None:
+    """A forked process has no listener threads and may have copied a queue mid-operation: give it new ones."""
+    import multiprocessing.util
+
+    for name, listener in list(_listeners.items()):
+        logging.getLogger(name).handlers[0].queue = queue.SimpleQueue()
+        _start_listener(name, list(listener.handlers))
+
+    # Forked multiprocessing workers exit with os._exit, which skips atexit but runs these finalizers
+    multiprocessing.util.Finalize(None, _stop_listeners, exitpriority=0)
+
+
+atexit.register(_stop_listeners)
+os.register_at_fork(after_in_child=_restart_listeners_in_child)
+
+
 def enable_appi_logging(name: str, conn_str) -> None:
     """Enable logging handler for Azure Application Insights.
 
@@ -58,6 +116,9 @@ def enable_appi_logging(name: str, conn_str) -> None:
     for k, v in opentelemetry_vars.items():
         os.environ[k] = v
 
+    # Imported here, as it is only needed (and slow to import) if a connection string is configured
+    from azure.monitor.opentelemetry import configure_azure_monitor
+
     configure_azure_monitor(connection_string=conn_str, logger_name=name)
 
 
@@ -1,4 +1,6 @@
+import inspect
 from datetime import datetime
+from pathlib import Path
 
 import pandas as pd
 from sklearn.compose import ColumnTransformer
@@ -18,7 +20,11 @@ from src.columns import (
     FEATURE_COLUMNS,
     NUM_COLUMNS,
 )
+from src.downsample import downsample_negatives
+from src.settings import NEGATIVE_SAMPLING_RATE, PREPARE_ENGINE
 from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl, save_to_pkl
+from src.utils.stage_cache import cached_stage
+from src.utils.tracing import stage
 
 FRAC = 1  # percentage van de data die je meeneemt (voor testen, zet bijv. op 0.01)
 
@@ -26,12 +32,33 @@ FRAC = 1  # percentage van de data die je meeneemt (voor testen, zet bijv. op 0.
 class DataPreprocessor:
     """Class to handle all data preparations."""
 
-    def __init__(self, traindate: datetime, testdate: datetime, years_ahead: int, expand_interval: int = 1):
-        """Initializes the class."""
+    # Name of the pickle in LEVEL.PREPARE the train_test_sets are saved to
+    train_test_sets_name = "train_test_sets"
+    # Attributes set by __init__ that the output of prepare depends on, part of the key in the stage cache
+    cache_arguments = ["traindate", "testdate", "years_ahead", "expand_interval", "engine", "negative_sampling_rate"]
+
+    def __init__(
+        self,
+        traindate: datetime,
+        testdate: datetime,
+        years_ahead: int,
+        expand_interval: int = 1,
+        engine: str = PREPARE_ENGINE,
+        negative_sampling_rate: float | None = NEGATIVE_SAMPLING_RATE,
+    ):
+        """Initializes the class. engine ("pandas" or "duckdb") runs the peildatum expansion, see settings.
+
+        If negative_sampling_rate is set, only that fraction of the negative rows of every contract is kept in the
+        train set, with weights in train_test_sets["w_train"], see src.downsample.
+        """
+        if engine not in ("pandas", "duckdb"):
+            raise ValueError(f"engine should be 'pandas' or 'duckdb', not '{engine}'")
         self.traindate = traindate
         self.testdate = testdate
         self.years_ahead = years_ahead
         self.expand_interval = expand_interval
+        self.engine = engine
+        self.negative_sampling_rate = negative_sampling_rate
 
         # Placeholder for variables to assign while preparing
         self.df = None
@@ -43,9 +70,25 @@ class DataPreprocessor:
 
     def __call__(self) -> tuple[dict | None, ColumnTransformer | None]:
         """Calls the prepare function and returns train_test_sets and preprocessing pipeline."""
+        with stage("prepare", traindate=str(self.traindate.date()), years_ahead=self.years_ahead):
+            self.train_test_sets, self.pipe = self._prepare_or_reuse()
+            self._save()
+        return self.train_test_sets, self.pipe
+
+    @cached_stage(LEVEL.PREPARE, code=["src.prepare_duckdb", "src.downsample", "src.columns"])
+    def _prepare_or_reuse(self) -> tuple[dict, ColumnTransformer]:
+        """Runs prepare, or returns its output from the stage cache if it ran on the same inputs before."""
         self.prepare()
         return self.train_test_sets, self.pipe
 
+    def cache_fingerprint(self) -> dict:
+        """Inputs of prepare for the key in the stage cache: df_combined, cache_arguments and the code of the class."""
+        return {
+            "df_combined": generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle"),
+            "arguments": {name: getattr(self, name) for name in self.cache_arguments},
+            "code": [Path(inspect.getfile(cls)) for cls in type(self).__mro__ if cls is not object],
+        }
+
     def prepare(self) -> None:
         """General data preparation function.
 
@@ -53,8 +96,32 @@ class DataPreprocessor:
             dict: containing X and y for train-test-sets
             pipe: fitted preprocessing pipeline
         """
+        self.load()
+
+        # Generate multiple peildatums and create peildatum based variables
+        self._expand_rows_with_variables()
+
+        with stage("transform") as span:
+            rows_in = len(self.df)
+            self._make_expanded_train_test_sets()
+            rows_out = sum(len(self.train_test_sets[name]) for name in ["X_train", "X_calibrate", "X_test"])
+            span.set(rows_in=rows_in, rows_out=rows_out)
+
+        return None
+
+    def _save(self) -> None:
+        """Saves train_test_sets to LEVEL.PREPARE, also when they come from the stage cache, for src/train.py."""
+        train_test_path = generate_data_dir_path(LEVEL.PREPARE, self.train_test_sets_name, suffix=".pickle")
+        with stage("save") as span:
+            save_to_pkl(self.train_test_sets, train_test_path)
+            span.set(bytes_written=train_test_path.stat().st_size)
+
+    def load(self) -> None:
+        """Loads df_combined into self.df, one row per contract: active contracts get no end date, see prepare."""
         df_combined_path = generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle")
-        self.df = load_from_pkl(df_combined_path)
+        with stage("load") as span:
+            self.df = load_from_pkl(df_combined_path)
+            span.set(rows_out=len(self.df), bytes_read=df_combined_path.stat().st_size)
         # We zetten actieve huurovereenkomsten op pd.NaT i.p.v. 2199-12-31
         self.df.loc[self.df[COL_HOVK_STATUS] == "Actief", COL_ENDDATE] = pd.NaT
 
@@ -63,18 +130,6 @@ class DataPreprocessor:
 
         # Sampling percentage van originele df (bijv. voor testen)
         self.df = self.df.sample(frac=FRAC, random_state=1)
-
-        # Generate multiple peildatums
-        self._expand_rows()
-
-        # Create peildatum based variables
-        self.df = create_peildatum_based_variables(df=self.df, years_ahead=self.years_ahead)
-
-        self._make_expanded_train_test_sets()
-
-        train_test_path = generate_data_dir_path(LEVEL.PREPARE, "train_test_sets", suffix=".pickle")
-        save_to_pkl(self.train_test_sets, train_test_path)
-
         return None
 
     def _vervang_lege_waardes_met_dummies(self) -> None:
@@ -89,6 +144,31 @@ class DataPreprocessor:
         self.df.loc[empty_indices, COL_ID_EENHEID] = eenheidcode_replacements
         return None
 
+    def _expand_rows_with_variables(self) -> None:
+        """Expands the rows for every peildatum (see _expand_rows) and creates the peildatum based variables.
+
+        With engine "duckdb" both steps run as one query in DuckDB (see src.prepare_duckdb), with the same result.
+        """
+        if self.engine == "duckdb":
+            from src.prepare_duckdb import expand_rows_with_variables
+
+            with stage("expand", engine=self.engine) as span:
+                rows_in = len(self.df)
+                dates = self._create_date_sequence(startdate=self.df[COL_STARTDATE].min())
+                self.df = expand_rows_with_variables(self.df, dates, years_ahead=self.years_ahead)
+                span.set(rows_in=rows_in, rows_out=len(self.df))
+            return None
+
+        with stage("expand", engine=self.engine) as span:
+            rows_in = len(self.df)
+            self._expand_rows()
+            span.set(rows_in=rows_in, rows_out=len(self.df))
+
+        with stage("peildatum_variables") as span:
+            self.df = create_peildatum_based_variables(df=self.df, years_ahead=self.years_ahead)
+            span.set(rows_in=len(self.df), rows_out=len(self.df))
+        return None
+
     def _expand_rows(self) -> None:
         """Expand rows for every peildatum between COL_STARTDATE up until traindate, every self.expand_interval years.
 
@@ -190,6 +270,11 @@ class DataPreprocessor:
         self.calibratieset = self.trainset[self.trainset.peildatum == max_peildatum]
         self.trainset = self.trainset[self.trainset.peildatum != max_peildatum]
 
+        # Optioneel: minder negatieve rijen per huurovereenkomst in de trainset, met gewichten (de calibratieset niet)
+        w_train = None
+        if self.negative_sampling_rate is not None:
+            self.trainset, w_train = downsample_negatives(self.trainset, self.negative_sampling_rate)
+
         # The testset is the dataset at peildatum==traindate, see the docstring above.
         peildatum_is_traindate = self.df["peildatum"] == self.traindate
         testset = self.df[peildatum_is_traindate]
@@ -218,6 +303,8 @@ class DataPreprocessor:
             "y_calibrate": y_calibrate,
             "y_test": y_test,
         }
+        if w_train is not None:
+            self.train_test_sets["w_train"] = w_train
 
         return None
 
@@ -254,10 +341,12 @@ class DataPreprocessor:
         return None
 
 
-def create_peildatum_based_variables(df: pd.DataFrame, years_ahead: int) -> pd.DataFrame:
+def create_peildatum_based_variables(df: pd.DataFrame, years_ahead: int | None = None) -> pd.DataFrame:
     """Creates new variables out of date columns that are calculated with peildatum.
 
-    This function is not part of the DataPrerocessor class as it is used for both training and prediction tasks.
+    This function is not part of the DataPrerocessor class as it is used for both training and prediction tasks. The
+    label COL_LABEL_EVENT is the only variable that depends on years_ahead. At predict time the label is not used, so
+    with years_ahead=None it is not calculated and the result can be shared by all horizons.
     """
     df1 = df.copy()
 
@@ -268,7 +357,8 @@ def create_peildatum_based_variables(df: pd.DataFrame, years_ahead: int) -> pd.D
     # If the peildatum is less than self.years_ahead years before the huurcontract einddatum, the label is
     # y=1, else it is y=0. So for example if we look 1 year ahead (365 days), and if einddatum = 1-1-2016,
     # then Y=0 if we "peil" (gauge) before 1-1-2015, and Y=1 if we peil after 1-1-2015.
-    df1[COL_LABEL_EVENT] = (df1[COL_ENDDATE] - df1["peildatum"]).dt.days < 365 * years_ahead
+    if years_ahead is not None:
+        df1[COL_LABEL_EVENT] = (df1[COL_ENDDATE] - df1["peildatum"]).dt.days < 365 * years_ahead
 
     df1.loc[:, "leeftijd_woning"] = df1["peildatum"].dt.year - df1["opleverdatum"].dt.year
     df1.loc[:, "min_leeftijd"] = df1["peildatum"].dt.year - df1["min_geboortedatum"].dt.year
@@ -0,0 +1,176 @@
+"""DuckDB engine for the peildatum expansion of prepare, selected with PREPARE_ENGINE = "duckdb".
+
+DataPreprocessor._expand_rows followed by create_peildatum_based_variables is a range join of the contracts against
+the calendar of peildatums, some filters and date arithmetic. In pandas this builds the full product of contracts and
+peildatums and copies it several times, on one thread. expand_rows_with_variables runs the same steps as one SQL query
+in DuckDB, which is vectorized, multi-threaded and only materializes the rows that are kept. Only the date columns are
+passed to DuckDB: the query returns, per kept row, the position of its contract and the derived columns, and the
+other columns are taken from the contracts at once. The result is the same DataFrame as the pandas engine returns,
+including row order and index, so the train, calibration and test sets are the same too.
+
+python -m src.prepare_duckdb --contracts 20000 compares both engines on synthetic contracts and times them;
+tests/test_prepare_duckdb.py checks that they give the same result.
+"""
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.columns import (
+    COL_ENDDATE,
+    COL_HOVK_STATUS,
+    COL_ID_HOVK,
+    COL_LABEL_DURATION,
+    COL_LABEL_EVENT,
+    COL_STARTDATE,
+)
+from src.my_logging import logger
+
+DAY_US = 86_400_000_000
+
+# Row index of the pandas engine: the position in the merge of the product of contracts and peildatums with the
+# contracts. Every contract l adds a block of len(kalender) * aantal rows (aantal = number of contracts with its id),
+# ordered by peildatum and then by the matching contract r.
+EXPAND_QUERY = f"""
+WITH contracten AS (
+    SELECT
+        *,
+        COUNT(*) OVER (PARTITION BY {COL_ID_HOVK}) AS aantal,
+        ROW_NUMBER() OVER (PARTITION BY {COL_ID_HOVK} ORDER BY rij) - 1 AS rang
+    FROM contracten_df
+),
+blokken AS (
+    SELECT *, (SUM(aantal) OVER (ORDER BY rij ROWS UNBOUNDED PRECEDING) - aantal)::BIGINT AS blokstart
+    FROM contracten
+),
+rijen AS (
+    SELECT
+        l.blokstart * (SELECT COUNT(*) FROM kalender) + k.datum_index * l.aantal + r.rang AS positie,
+        r.rij,
+        k.peildatum,
+        r.{COL_STARTDATE} AS startdatum,
+        date_trunc('day', r.{COL_ENDDATE})::TIMESTAMP_NS AS einddatum,
+        r.opleverdatum,
+        r.min_geboortedatum,
+        r.max_geboortedatum
+    FROM blokken l
+    CROSS JOIN kalender k
+    JOIN contracten r ON l.{COL_ID_HOVK} IS NOT DISTINCT FROM r.{COL_ID_HOVK}
+    -- Peildatums after the start and before the (not normalized) end of the contract
+    WHERE k.peildatum > r.{COL_STARTDATE} AND (k.peildatum < r.{COL_ENDDATE} OR r.{COL_ENDDATE} IS NULL)
+),
+dagen AS (
+    SELECT
+        *,
+        (month(peildatum) = 1 AND day(peildatum) = 1) AS is_1_januari,
+        floor((epoch_us(einddatum) - epoch_us(peildatum)) / {DAY_US})::BIGINT AS dagen_tot_einde
+    FROM rijen
+)
+SELECT
+    positie,
+    rij,
+    peildatum,
+    einddatum,
+    is_1_januari,
+    floor((epoch_us(peildatum) - epoch_us(startdatum)) / {DAY_US})::BIGINT AS {COL_LABEL_DURATION},
+    coalesce(dagen_tot_einde < 365 * $years_ahead, false) AS {COL_LABEL_EVENT},
+    (year(peildatum) - year(opleverdatum))::DOUBLE AS leeftijd_woning,
+    (year(peildatum) - year(min_geboortedatum))::DOUBLE AS min_leeftijd,
+    (year(peildatum) - year(max_geboortedatum))::DOUBLE AS max_leeftijd
+FROM dagen
+-- Every peildatum in the last 12 months of the contract and the 1st of January of every year
+WHERE dagen_tot_einde <= 365 OR is_1_januari
+ORDER BY positie
+"""
+DATE_COLUMNS = [COL_STARTDATE, COL_ENDDATE, "opleverdatum", "min_geboortedatum", "max_geboortedatum"]
+
+
+def expand_rows_with_variables(df: pd.DataFrame, peildatums: list[datetime], years_ahead: int | None) -> pd.DataFrame:
+    """DataPreprocessor._expand_rows followed by create_peildatum_based_variables, as one query in DuckDB.
+
+    Args:
+        df (pd.DataFrame): contracts, as self.df of DataPreprocessor before _expand_rows
+        peildatums (list[datetime]): peildatums to expand every contract to, see DataPreprocessor._create_date_sequence
+        years_ahead (int, optional): horizon of COL_LABEL_EVENT, which is not calculated if None
+
+    Returns:
+        pd.DataFrame: a row per contract and peildatum with the peildatum based variables, as the pandas engine
+    """
+    import duckdb
+
+    contracten_df = df[[COL_ID_HOVK] + DATE_COLUMNS].assign(rij=np.arange(len(df)))
+    kalender = pd.DataFrame({"peildatum": pd.to_datetime(peildatums), "datum_index": np.arange(len(peildatums))})
+
+    with duckdb.connect() as con:
+        con.register("contracten_df", contracten_df)
+        con.register("kalender", kalender)
+        result = con.execute(EXPAND_QUERY, {"years_ahead": years_ahead or 0}).df()
+
+    expanded = df.take(result["rij"].to_numpy())
+    expanded.index = pd.RangeIndex(len(result)) if result.empty else pd.Index(result["positie"].to_numpy())
+    expanded.insert(0, COL_ID_HOVK, expanded.pop(COL_ID_HOVK))
+    expanded.insert(1, "peildatum", result["peildatum"].to_numpy())
+    expanded[COL_ENDDATE] = result["einddatum"].to_numpy()
+    expanded["is_1_januari"] = result["is_1_januari"].to_numpy()
+    expanded[COL_LABEL_DURATION] = result[COL_LABEL_DURATION].to_numpy(dtype="int64")
+    if years_ahead is not None:
+        expanded[COL_LABEL_EVENT] = result[COL_LABEL_EVENT].to_numpy()
+    for col in ["leeftijd_woning", "min_leeftijd", "max_leeftijd"]:
+        # As in pandas: a difference of .dt.year (int32) is only float if a date is missing
+        values = result[col].to_numpy()
+        expanded[col] = values if np.isnan(values).any() else values.astype("int32")
+    return expanded
+
+
+def compare_engines(df_combined: pd.DataFrame, traindate: datetime, years_ahead: int) -> dict[str, float]:
+    """Prepares df_combined with both engines, checks that the results are equal and returns the time of each.
+
+    Raises:
+        AssertionError: if the expanded rows or the train, calibration or test sets differ
+    """
+    from src.prepare import DataPreprocessor
+
+    results, durations = {}, {}
+    for engine in ["pandas", "duckdb"]:
+        preprocessor = DataPreprocessor(traindate=traindate, testdate=traindate, years_ahead=years_ahead, engine=engine)
+        preprocessor.df = df_combined.copy()
+        preprocessor.df.loc[preprocessor.df[COL_HOVK_STATUS] == "Actief", COL_ENDDATE] = pd.NaT
+        t0 = time.perf_counter()
+        preprocessor._expand_rows_with_variables()
+        durations[engine] = time.perf_counter() - t0
+        expanded = preprocessor.df
+        preprocessor._make_expanded_train_test_sets()
+        results[engine] = expanded, preprocessor.train_test_sets
+        logger.info(f"Engine {engine}: {len(expanded)} expanded rows in {durations[engine]:.2f}s")
+
+    (expanded_pandas, sets_pandas), (expanded_duckdb, sets_duckdb) = results["pandas"], results["duckdb"]
+    pd.testing.assert_frame_equal(expanded_duckdb, expanded_pandas)
+    for name, value in sets_pandas.items():
+        if isinstance(value, pd.DataFrame):
+            pd.testing.assert_frame_equal(sets_duckdb[name], value, obj=name)
+        else:
+            pd.testing.assert_series_equal(sets_duckdb[name], value, obj=name)
+    logger.info(f"Both engines give the same expanded rows and train, calibration and test sets ({traindate:%Y-%m-%d})")
+    return durations
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contracts", help="number of synthetic contracts", type=int, default=20_000)
+    parser.add_argument("--years-ahead", help="horizon of the label", type=int, default=1)
+    parser.add_argument("--seed", help="random seed of the synthetic contracts", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from src.utils.synthetic import make_synthetic_contracts
+
+    args = get_args()
+    traindate = datetime(datetime.today().year - args.years_ahead - 1, 1, 1)
+    durations = compare_engines(
+        make_synthetic_contracts(args.contracts, seed=args.seed), traindate=traindate, years_ahead=args.years_ahead
+    )
+    logger.info(f"DuckDB is {durations['pandas'] / durations['duckdb']:.1f}x as fast as pandas")
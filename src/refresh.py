@@ -0,0 +1,280 @@
+"""Incremental refresh of an XGBoost model: continued boosting on the months labelled since its previous (re)fit.
+
+A production model of years_ahead y (see pick_model_to_productionize) is trained on the peildatums up to its traindate
+minus y years and calibrated on the contracts active at its traindate. When new months of data arrive, the labels of
+more peildatums become known: the verhuizingen within y years after a peildatum are known once it is y years ago. A
+refresh as of today uses these as follows:
+- calibration peildatum: the first day of the current month, y years ago (the most recent peildatum with known labels)
+- boosting: every month after the last peildatum the booster was trained on, up to the calibration peildatum minus y
+  years, becomes a snapshot of the contracts active on its 1st. As in the production refit, the labels the booster
+  learns from are known before the calibration peildatum: otherwise it would learn the verhuizingen of the calibration
+  snapshot from the same contracts a month earlier. The booster continues on these rows for REFRESH_BOOST_ROUNDS
+  rounds (xgb_model of XGBClassifier.fit), with the hyperparameters and the fitted pipeline of the production model
+- the continued booster is calibrated on the snapshot of the calibration peildatum, with the calibration method of the
+  production model
+
+Monthly snapshots instead of the expanded rows of prepare are used, because in the expansion only the 1st of January
+is a peildatum for every contract: the other months only have rows of contracts that ended, which would all be
+positives. Every REFRESH_FULL_RETRAIN_DAYS days the refreshed model is compared with a full retrain (same
+hyperparameters, fitted from scratch on the expanded rows up to the calibration peildatum minus y years, as the
+production refit does): if its ROC AUC on the calibration snapshot is more than REFRESH_DRIFT_TOLERANCE lower, the full
+retrain replaces it. The state (models, pipeline and dates) is a pickle per years_ahead in MODEL_DIR/refresh, its
+model and pipeline have the format of the models in Azure ML.
+
+python src/refresh.py --years-ahead 1 --init models/trained/<model>.pickle --calibration-method sigmoid
+python src/refresh.py --years-ahead 1 [--full-retrain]
+"""
+import argparse
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.frozen import FrozenEstimator
+from sklearn.metrics import brier_score_loss, roc_auc_score
+from xgboost import XGBClassifier
+
+from src.columns import COL_ENDDATE, COL_LABEL_EVENT, COL_STARTDATE, FEATURE_COLUMNS
+from src.my_logging import logger
+from src.prepare import DataPreprocessor, create_peildatum_based_variables
+from src.settings import (
+    MODEL_DIR,
+    RANDOM_SEED,
+    REFRESH_BOOST_ROUNDS,
+    REFRESH_DRIFT_TOLERANCE,
+    REFRESH_FULL_RETRAIN_DAYS,
+    azure,
+)
+from src.train import fit_with_hyperparameters
+from src.utils.io import load_from_pkl, save_to_pkl
+from src.utils.tracing import stage
+
+
+class IncrementalRefresher:
+    """Refreshes the XGBoost model of years_ahead by continued boosting, with a full retrain as drift guard."""
+
+    def __init__(
+        self,
+        years_ahead: int,
+        state_path: str | Path | None = None,
+        rounds: int = REFRESH_BOOST_ROUNDS,
+        full_retrain_days: int = REFRESH_FULL_RETRAIN_DAYS,
+        drift_tolerance: float = REFRESH_DRIFT_TOLERANCE,
+    ):
+        """Refreshes the model in state_path, by default in MODEL_DIR/refresh/ (a pickle per years_ahead)."""
+        self.years_ahead = years_ahead
+        if state_path is None:
+            state_path = Path(MODEL_DIR) / "refresh" / f"{azure.project_name}_{years_ahead}_years_ahead.pickle"
+        self.state_path = Path(state_path)
+        self.rounds = rounds
+        self.full_retrain_days = full_retrain_days
+        self.drift_tolerance = drift_tolerance
+
+    def initialize(self, model_dict: dict, calibration_method: str) -> dict:
+        """Starts the refresh state from a train run (see _train_pipeline) and its XGBoost model of calibration_method.
+
+        The booster is the production refit of that model, trained on the peildatums up to the traindate minus
+        years_ahead years. The train run counts as the last full retrain.
+
+        Raises:
+            ValueError: for calibration_method "no calibration", whose model in the train run is not the production
+                refit but the model fitted on the train set only (see train_and_evaluate_models)
+        """
+        if calibration_method not in ["sigmoid", "isotonic"]:
+            raise ValueError(
+                f"Can only refresh a sigmoid or isotonic calibrated model, whose booster is the production refit, "
+                f"not {calibration_method!r}"
+            )
+        if model_dict["years_ahead"] != self.years_ahead:
+            raise ValueError(f"The model predicts {model_dict['years_ahead']} years ahead, not {self.years_ahead}")
+        selected = next(
+            model
+            for model in model_dict["models"]
+            if model["algorithm"] == "XGBoostClassifier" and model["calibration_method"] == calibration_method
+        )
+        model = selected["model"]
+        booster = model.estimator.estimator if isinstance(model, CalibratedClassifierCV) else model
+        traindate = pd.Timestamp(model_dict["traindate"])
+        state = {
+            "model": model,
+            "booster": booster,
+            "pipeline": model_dict["pipeline"],
+            "hyperparameters": selected["hyperparameters"],
+            "calibration_method": calibration_method,
+            "boosted_until": traindate - pd.DateOffset(years=self.years_ahead),
+            "calibration_peildatum": traindate,
+            "last_full_retrain": pd.Timestamp(datetime.now()),
+        }
+        self._write_state(state)
+        logger.info(
+            f"Refresh state of {self.years_ahead} year(s) ahead initialized from traindate {traindate:%Y-%m-%d}"
+        )
+        return state
+
+    def refresh(self, preprocessor: DataPreprocessor, full_retrain: bool = False, now: datetime | None = None) -> dict:
+        """Refreshes the model with the contracts of preprocessor (after preprocessor.load) as of now.
+
+        Args:
+            preprocessor (DataPreprocessor): loaded contracts in preprocessor.df, also used to expand for a full retrain
+            full_retrain (bool): compare with a full retrain, even if it is not scheduled
+            now (datetime, optional): moment of the refresh, by default the current time
+
+        Returns:
+            dict: the new state, with the ROC AUC and Brier score on the calibration snapshot in "metrics"
+        """
+        now = pd.Timestamp(now if now is not None else datetime.now())
+        state = load_from_pkl(self.state_path)
+        calibration_peildatum = now.normalize().replace(day=1) - pd.DateOffset(years=self.years_ahead)
+        peildatums = pd.date_range(
+            state["boosted_until"] + pd.DateOffset(months=1),
+            calibration_peildatum - pd.DateOffset(years=self.years_ahead),
+            freq="MS",
+        )
+        if calibration_peildatum <= state["calibration_peildatum"]:
+            logger.info(f"No new labelled months since calibration peildatum {state['calibration_peildatum']:%Y-%m-%d}")
+            return state
+
+        contracts = preprocessor.df
+        X_calibrate, y_calibrate = self._transform(
+            state, snapshots(contracts, [calibration_peildatum], self.years_ahead)
+        )
+
+        t0 = time.perf_counter()
+        new_state = dict(state, calibration_peildatum=calibration_peildatum)
+        with stage("refresh", years_ahead=self.years_ahead, mode="incremental") as span:
+            boost_rows = snapshots(contracts, peildatums, self.years_ahead, survivorship_filter=True)
+            X_boost, y_boost = self._transform(state, boost_rows)
+            booster = state["booster"]
+            if len(X_boost):
+                booster = XGBClassifier(**state["hyperparameters"], random_state=RANDOM_SEED)
+                booster.set_params(n_estimators=self.rounds)
+                booster.fit(X_boost, y_boost, xgb_model=state["booster"].get_booster())
+                new_state.update(booster=booster, boosted_until=peildatums[-1])
+            new_state["model"] = self._calibrate(booster, state["calibration_method"], X_calibrate, y_calibrate)
+            span.set(rows_in=len(X_boost), rounds=self.rounds)
+        new_state["metrics"] = {"incremental": evaluate(new_state["model"], X_calibrate, y_calibrate)}
+        logger.info(
+            f"Boosted {self.rounds} rounds on {len(peildatums)} months ({len(X_boost)} rows) up to "
+            f"{new_state['boosted_until']:%Y-%m-%d} in {time.perf_counter() - t0:.1f}s, calibrated on "
+            f"{calibration_peildatum:%Y-%m-%d}: {new_state['metrics']['incremental']}"
+        )
+
+        days = (now - state["last_full_retrain"]).days
+        if full_retrain or days >= self.full_retrain_days:
+            new_state = self._compare_full_retrain(new_state, preprocessor, X_calibrate, y_calibrate, now)
+
+        self._write_state(new_state)
+        return new_state
+
+    def _compare_full_retrain(
+        self,
+        state: dict,
+        preprocessor: DataPreprocessor,
+        X_calibrate: pd.DataFrame,
+        y_calibrate: pd.Series,
+        now: pd.Timestamp,
+    ) -> dict:
+        """Fits the model from scratch and keeps it instead of the refreshed model if that one drifted."""
+        train_until = state["calibration_peildatum"] - pd.DateOffset(years=self.years_ahead)
+        with stage("refresh", years_ahead=self.years_ahead, mode="full") as span:
+            full = DataPreprocessor(
+                traindate=state["calibration_peildatum"],
+                testdate=state["calibration_peildatum"] + pd.DateOffset(years=self.years_ahead),
+                years_ahead=self.years_ahead,
+                engine=preprocessor.engine,
+            )
+            full.df = preprocessor.df
+            full._expand_rows_with_variables()
+            trainset = full.df.loc[lambda x: (x["peildatum"] <= train_until) & (x[COL_STARTDATE] <= full.traindate)]
+            trainset = trainset.query("startjaar_huurovereenkomst >= 2002")
+            X_train, y_train = self._transform(state, trainset)
+            booster = fit_with_hyperparameters("XGBoostClassifier", state["hyperparameters"], X_train, y_train)
+            model = self._calibrate(booster, state["calibration_method"], X_calibrate, y_calibrate)
+            span.set(rows_in=len(X_train))
+
+        metrics = evaluate(model, X_calibrate, y_calibrate)
+        state["metrics"]["full"] = metrics
+        drift = metrics["roc_auc"] - state["metrics"]["incremental"]["roc_auc"]
+        state["last_full_retrain"] = now
+        if drift > self.drift_tolerance:
+            logger.warning(
+                f"Refreshed model has a ROC AUC {drift:.3f} lower than a full retrain ({metrics}), which replaces it"
+            )
+            state.update(model=model, booster=booster, boosted_until=train_until)
+        else:
+            logger.info(f"Full retrain {metrics}: the refreshed model is within {self.drift_tolerance} ROC AUC")
+        return state
+
+    def _transform(self, state: dict, df: pd.DataFrame) -> tuple[pd.DataFrame, pd.Series]:
+        pipeline = state["pipeline"]
+        X = pd.DataFrame(pipeline.transform(df[FEATURE_COLUMNS]), columns=pipeline.get_feature_names_out())
+        return X, df[COL_LABEL_EVENT].reset_index(drop=True)
+
+    @staticmethod
+    def _calibrate(booster: XGBClassifier, calibration_method: str, X: pd.DataFrame, y: pd.Series):
+        return CalibratedClassifierCV(
+            estimator=FrozenEstimator(booster), method=calibration_method, ensemble=False
+        ).fit(X, y)
+
+    def _write_state(self, state: dict) -> None:
+        save_to_pkl(state, self.state_path)
+
+
+def snapshots(
+    contracts: pd.DataFrame, peildatums: list, years_ahead: int, survivorship_filter: bool = False
+) -> pd.DataFrame:
+    """The contracts active on every peildatum, with the peildatum based variables and the label of years_ahead.
+
+    Active as in DataPreprocessor._expand_rows: started before and not ended on the peildatum. With
+    survivorship_filter only contracts that started from 2002 are used, as in the train set.
+    """
+    start, end = contracts[COL_STARTDATE], contracts[COL_ENDDATE]
+    if survivorship_filter:
+        contracts = contracts.loc[contracts["startjaar_huurovereenkomst"] >= 2002]
+        start, end = contracts[COL_STARTDATE], contracts[COL_ENDDATE]
+    rows = []
+    for peildatum in peildatums:
+        is_active = ((start < peildatum) & ((end > peildatum) | end.isna())).to_numpy()
+        rows.append(contracts.loc[is_active].assign(peildatum=peildatum))
+    if not rows:
+        return create_peildatum_based_variables(contracts.iloc[:0].assign(peildatum=pd.NaT), years_ahead=years_ahead)
+    df = pd.concat(rows, ignore_index=True)
+    df[COL_ENDDATE] = df[COL_ENDDATE].dt.normalize()
+    return create_peildatum_based_variables(df, years_ahead=years_ahead)
+
+
+def evaluate(model, X: pd.DataFrame, y: pd.Series) -> dict[str, float]:
+    """ROC AUC and Brier score of model on X, y."""
+    proba = model.predict_proba(X)[:, 1]
+    return {
+        "roc_auc": round(roc_auc_score(y_true=y, y_score=proba), 3),
+        "brier_score": round(brier_score_loss(y_true=y, y_proba=proba), 3),
+    }
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--years-ahead", help="horizon of the model to refresh", type=int, required=True)
+    parser.add_argument("--init", help="start from this train run pickle (see main_train) instead of the state")
+    parser.add_argument(
+        "--calibration-method",
+        help="calibration method of the XGBoost model to start from",
+        choices=["sigmoid", "isotonic"],
+    )
+    parser.add_argument(
+        "--full-retrain", help="compare with a full retrain, even if not scheduled", action="store_true"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    refresher = IncrementalRefresher(years_ahead=args.years_ahead)
+    if args.init:
+        refresher.initialize(load_from_pkl(args.init), calibration_method=args.calibration_method)
+    now = datetime.now()
+    preprocessor = DataPreprocessor(traindate=now, testdate=now, years_ahead=args.years_ahead)
+    preprocessor.load()
+    refresher.refresh(preprocessor, full_retrain=args.full_retrain, now=now)
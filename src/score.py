@@ -0,0 +1,203 @@
+import hashlib
+import pickle
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.columns import COL_HOVK_STATUS, COL_ID_EENHEID, COL_ID_HOVK, FEATURE_COLUMNS
+from src.compiled_scorer import compile_model, compile_transformer, feature_columns
+from src.my_logging import logger
+from src.prepare import create_peildatum_based_variables
+from src.settings import USE_COMPILED_SCORER
+from src.utils.parquet_output import OutputWriter
+
+OUTPUT_COLUMNS = [
+    COL_ID_HOVK,
+    COL_ID_EENHEID,
+    "verhuiskans",
+    "aantal_jaar_vooruit",
+    "voorspellingslabel",
+    "modelnaam",
+    "modelversie",
+    "timestamp",
+]
+
+
+def split_predict_set(df_combined: pd.DataFrame, peildatum: datetime) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Splits the latest data into active contracts (with peildatum features) and terminated ('Opgezegd') contracts.
+
+    The peildatum based variables are computed only once for the active portfolio: apart from the label, which is not
+    used at predict time, they do not depend on years_ahead and can be shared by all horizons.
+    """
+    is_actief = (df_combined[COL_HOVK_STATUS] == "Actief").to_numpy()
+    is_opgezegd = (df_combined[COL_HOVK_STATUS] == "Opgezegd").to_numpy()
+
+    df_actief = df_combined.loc[is_actief].reset_index(drop=True)
+    df_actief["peildatum"] = peildatum
+    df_actief = create_peildatum_based_variables(df=df_actief)
+
+    df_opgezegd = df_combined.loc[is_opgezegd, [COL_ID_HOVK, COL_ID_EENHEID]].reset_index(drop=True)
+
+    return df_actief, df_opgezegd
+
+
+def score_horizons(
+    df_actief: pd.DataFrame, df_opgezegd: pd.DataFrame, models: dict[int, dict], timestamp: str
+) -> pd.DataFrame:
+    """Scores all horizons and assembles the long output DataFrame in a single allocation.
+
+    Args:
+        df_actief (pd.DataFrame): active contracts with peildatum based variables, see split_predict_set
+        df_opgezegd (pd.DataFrame): terminated contracts, these get a verhuiskans of 1.0 for every horizon
+        models (dict[int, dict]): per years_ahead a dict with keys model, pipeline, version_name and version_number
+        timestamp (str): timestamp that is written on every row of the output
+
+    Returns:
+        pd.DataFrame: verhuiskansen of all horizons stacked below each other, in the order of models
+    """
+    predictions = HorizonScorer(models).predict(df_actief)
+    return assemble_output(df_actief, df_opgezegd, predictions, models=models, timestamp=timestamp)
+
+
+def score_in_chunks(
+    df_combined: pd.DataFrame,
+    models: dict[int, dict],
+    peildatum: datetime,
+    timestamp: str,
+    path: str | Path,
+    chunk_size: int,
+) -> Path:
+    """Streaming variant of split_predict_set + score_horizons that writes the output to a Parquet dataset.
+
+    The active contracts are processed in chunks of chunk_size rows through feature derivation, transform and
+    prediction, and every chunk is appended to the dataset (see OutputWriter) as separate row groups. Derived
+    features, model inputs and outputs therefore never exist for more than one chunk at a time.
+
+    Returns:
+        Path: folder of the written Parquet dataset
+    """
+    scorer = HorizonScorer(models)
+    empty = pd.DataFrame({COL_ID_HOVK: pd.Series(dtype=object), COL_ID_EENHEID: pd.Series(dtype=object)})
+
+    actief_positions = np.flatnonzero((df_combined[COL_HOVK_STATUS] == "Actief").to_numpy())
+    logger.info(f"Scoring {len(actief_positions)} active contracts in chunks of {chunk_size} rows..")
+
+    with OutputWriter(path) as writer:
+        for start in range(0, len(actief_positions), chunk_size):
+            stop = start + chunk_size
+            df_actief = df_combined.iloc[actief_positions[start:stop]].reset_index(drop=True)
+            df_actief["peildatum"] = peildatum
+            df_actief = create_peildatum_based_variables(df=df_actief)
+
+            writer.write(
+                assemble_output(df_actief, empty, scorer.predict(df_actief), models=models, timestamp=timestamp)
+            )
+
+        # Opgezegde huurovereenkomsten krijgen verhuiskans van 1.0, for all horizons in one last chunk
+        is_opgezegd = (df_combined[COL_HOVK_STATUS] == "Opgezegd").to_numpy()
+        df_opgezegd = df_combined.loc[is_opgezegd, [COL_ID_HOVK, COL_ID_EENHEID]].reset_index(drop=True)
+        writer.write(assemble_output(empty, df_opgezegd, predictions={}, models=models, timestamp=timestamp))
+
+    return writer.path
+
+
+def assemble_output(
+    df_actief: pd.DataFrame,
+    df_opgezegd: pd.DataFrame,
+    predictions: dict[int, np.ndarray],
+    models: dict[int, dict],
+    timestamp: str,
+) -> pd.DataFrame:
+    """Builds the long output DataFrame of all horizons, writing every column exactly once."""
+    horizons = list(models.keys())
+    n_actief, n_opgezegd = len(df_actief), len(df_opgezegd)
+    n_rows = n_actief + n_opgezegd
+
+    # Every horizon writes its probabilities directly into its own slice of one preallocated array
+    verhuiskans = np.empty(len(horizons) * n_rows, dtype=np.float64)
+    for i, years_ahead in enumerate(horizons):
+        start = i * n_rows
+        split, stop = start + n_actief, start + n_rows
+        if n_actief:
+            verhuiskans[start:split] = predictions[years_ahead]
+        # Opgezegde huurovereenkomsten krijgen verhuiskans van 1.0
+        verhuiskans[split:stop] = 1.0
+
+    ids_hovk = np.concatenate([df_actief[COL_ID_HOVK].to_numpy(), df_opgezegd[COL_ID_HOVK].to_numpy()])
+    ids_eenheid = np.concatenate([df_actief[COL_ID_EENHEID].to_numpy(), df_opgezegd[COL_ID_EENHEID].to_numpy()])
+
+    def per_horizon(values: list) -> np.ndarray:
+        return np.repeat(np.array(values, dtype=object), n_rows)
+
+    output = pd.DataFrame(
+        {
+            COL_ID_HOVK: np.tile(ids_hovk, len(horizons)),
+            COL_ID_EENHEID: np.tile(ids_eenheid, len(horizons)),
+            "verhuiskans": verhuiskans,
+            "aantal_jaar_vooruit": np.repeat(np.array(horizons, dtype=np.int64), n_rows),
+            "voorspellingslabel": per_horizon([f"binnen {years_ahead} jaar" for years_ahead in horizons]),
+            "modelnaam": per_horizon([models[years_ahead]["version_name"] for years_ahead in horizons]),
+            "modelversie": per_horizon([models[years_ahead]["version_number"] for years_ahead in horizons]),
+            "timestamp": np.full(len(horizons) * n_rows, timestamp, dtype=object),
+        },
+        columns=OUTPUT_COLUMNS,
+        copy=False,
+    )
+    return output
+
+
+class HorizonScorer:
+    """Scores active contracts for all horizons, transforming them once per distinct fitted pipeline.
+
+    Pipelines are grouped (and compiled, if USE_COMPILED_SCORER) once at initialization, so the same scorer can be
+    reused for every chunk of a streaming predict run.
+    """
+
+    def __init__(self, models: dict[int, dict]):
+        """Groups the horizons by the content of their fitted pipeline."""
+        groups: dict[str, list[int]] = {}
+        for years_ahead, model_dict in models.items():
+            groups.setdefault(pipeline_fingerprint(model_dict["pipeline"]), []).append(years_ahead)
+
+        self.groups = []
+        for horizons in groups.values():
+            pipeline = models[horizons[0]]["pipeline"]
+            horizon_models = {years_ahead: models[years_ahead]["model"] for years_ahead in horizons}
+            if USE_COMPILED_SCORER:
+                pipeline = compile_transformer(pipeline)
+                horizon_models = {years_ahead: compile_model(model) for years_ahead, model in horizon_models.items()}
+            self.groups.append((pipeline, horizon_models))
+
+    def predict(self, df_actief: pd.DataFrame) -> dict[int, np.ndarray]:
+        """Returns per years_ahead the verhuiskans of every row in df_actief."""
+        return self.predict_transformed(self.transform(df_actief))
+
+    def transform(self, df_actief: pd.DataFrame) -> list:
+        """Returns the model input of df_actief for every distinct pipeline (in the order of self.groups)."""
+        inputs = []
+        for pipeline, horizon_models in self.groups:
+            logger.debug(f"Transforming {len(df_actief)} active contracts for horizon(s) {list(horizon_models)}..")
+            if USE_COMPILED_SCORER:
+                inputs.append(pipeline.transform(feature_columns(df_actief)))
+            else:
+                X = pipeline.transform(df_actief[FEATURE_COLUMNS])
+                inputs.append(pd.DataFrame(X, columns=pipeline.get_feature_names_out()))
+        return inputs
+
+    def predict_transformed(self, inputs: list) -> dict[int, np.ndarray]:
+        """Returns per years_ahead the verhuiskans, given the model inputs from transform (or a subset of its rows)."""
+        predictions = {}
+        for X, (_, horizon_models) in zip(inputs, self.groups):
+            for years_ahead, model in horizon_models.items():
+                if USE_COMPILED_SCORER:
+                    predictions[years_ahead] = model.predict_proba(X)
+                else:
+                    predictions[years_ahead] = model.predict_proba(X)[:, 1]
+        return predictions
+
+
+def pipeline_fingerprint(pipeline: object) -> str:
+    """Content hash of a fitted pipeline, so identical pipelines loaded from different pickles are recognized."""
+    return hashlib.sha256(pickle.dumps(pipeline, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
@@ -0,0 +1,194 @@
+import json
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from src.columns import COL_ID_EENHEID, COL_ID_HOVK
+from src.load import load_data_assets
+from src.my_logging import logger
+from src.score import HorizonScorer, split_predict_set
+from src.settings import (
+    PRODUCTIONIZED_MODELS,
+    SERVE_HOST,
+    SERVE_MAX_BATCH_SIZE,
+    SERVE_PORT,
+)
+from src.utils.aml_models import get_models_from_AML
+from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl
+
+
+class ScoringService:
+    """Keeps models and the contract feature table in memory to score single contracts on demand.
+
+    At startup the peildatum based variables of all active contracts are computed and transformed once by every
+    distinct pipeline, and the result is indexed by bk_huurovereenkomst and bk_eenheid. A request then only looks up
+    its rows and runs the models on them. Like the batch predict job, the service uses the data and peildatum of the
+    day it was started, so it should be restarted daily after load_data_assets has refreshed the data.
+    """
+
+    def __init__(self, df_combined: pd.DataFrame, models: dict[int, dict], max_batch_size: int = SERVE_MAX_BATCH_SIZE):
+        """Builds the in-memory feature table.
+
+        Args:
+            df_combined (pd.DataFrame): latest data, as saved by load_data_assets(for_predict=True)
+            models (dict[int, dict]): per years_ahead a dict with keys model, pipeline, version_name and version_number
+            max_batch_size (int): maximum number of IDs per request
+        """
+        self.models = models
+        self.max_batch_size = max_batch_size
+        self.peildatum = datetime.today()
+
+        df_actief, df_opgezegd = split_predict_set(df_combined, peildatum=self.peildatum)
+        self.scorer = HorizonScorer(models)
+        self.inputs = self.scorer.transform(df_actief)
+
+        # Positions >= n_actief refer to df_opgezegd, which get a verhuiskans of 1.0
+        self.n_actief = len(df_actief)
+        self.ids_hovk = np.concatenate([df_actief[COL_ID_HOVK].to_numpy(), df_opgezegd[COL_ID_HOVK].to_numpy()])
+        self.ids_eenheid = np.concatenate(
+            [df_actief[COL_ID_EENHEID].to_numpy(), df_opgezegd[COL_ID_EENHEID].to_numpy()]
+        )
+
+        self.index_hovk = {id_hovk: position for position, id_hovk in enumerate(self.ids_hovk)}
+        self.index_eenheid = {}
+        for position, id_eenheid in enumerate(self.ids_eenheid):
+            self.index_eenheid.setdefault(id_eenheid, []).append(position)
+
+        logger.info(
+            f"Scoring service ready with {len(self.ids_hovk)} huurovereenkomsten, peildatum {self.peildatum:%Y-%m-%d}"
+        )
+
+    @classmethod
+    def from_production(cls) -> "ScoringService":
+        """Loads the latest data and all PRODUCTIONIZED_MODELS, as the batch predict job does."""
+        load_data_assets(for_predict=True)
+        df_combined = load_from_pkl(generate_data_dir_path(LEVEL.LOAD, "df_combined", suffix=".pickle"))
+
+        model_dicts = get_models_from_AML(PRODUCTIONIZED_MODELS)
+        models = {ya: {**model_dicts[ya], **info} for ya, info in PRODUCTIONIZED_MODELS.items()}
+        return cls(df_combined, models)
+
+    def score(self, ids_hovk: list[str] = (), ids_eenheid: list[str] = ()) -> dict:
+        """Returns the verhuiskans of all horizons for the requested huurovereenkomsten and/or eenheden.
+
+        Raises:
+            ValueError: if more than max_batch_size IDs are requested
+        """
+        if len(ids_hovk) + len(ids_eenheid) > self.max_batch_size:
+            raise ValueError(f"At most {self.max_batch_size} IDs can be requested at once")
+
+        positions, not_found = [], []
+        for id_hovk in ids_hovk:
+            if id_hovk in self.index_hovk:
+                positions.append(self.index_hovk[id_hovk])
+            else:
+                not_found.append(id_hovk)
+        for id_eenheid in ids_eenheid:
+            if id_eenheid in self.index_eenheid:
+                positions.extend(self.index_eenheid[id_eenheid])
+            else:
+                not_found.append(id_eenheid)
+
+        positions = np.unique(np.array(positions, dtype=np.int64))
+        actief_positions = positions[positions < self.n_actief]
+        predictions = {}
+        if len(actief_positions):
+            predictions = self.scorer.predict_transformed([_take_rows(X, actief_positions) for X in self.inputs])
+
+        verhuiskansen = []
+        for years_ahead, model_dict in self.models.items():
+            proba = np.ones(len(positions), dtype=np.float64)
+            proba[: len(actief_positions)] = predictions.get(years_ahead, [])
+            for position, verhuiskans in zip(positions, proba):
+                verhuiskansen.append(
+                    {
+                        COL_ID_HOVK: self.ids_hovk[position],
+                        COL_ID_EENHEID: self.ids_eenheid[position],
+                        "verhuiskans": float(verhuiskans),
+                        "aantal_jaar_vooruit": years_ahead,
+                        "voorspellingslabel": f"binnen {years_ahead} jaar",
+                        "modelnaam": model_dict["version_name"],
+                        "modelversie": model_dict["version_number"],
+                    }
+                )
+
+        return {"peildatum": f"{self.peildatum:%Y-%m-%d}", "verhuiskansen": verhuiskansen, "niet_gevonden": not_found}
+
+
+def _take_rows(X: np.ndarray | pd.DataFrame, positions: np.ndarray) -> np.ndarray | pd.DataFrame:
+    return X.iloc[positions] if isinstance(X, pd.DataFrame) else X[positions]
+
+
+def make_handler(service: ScoringService) -> type[BaseHTTPRequestHandler]:
+    """Creates the HTTP request handler for a ScoringService.
+
+    Endpoints:
+        GET  /health
+        GET  /verhuiskans?bk_huurovereenkomst=...&bk_eenheid=...  (parameters may be repeated)
+        POST /verhuiskans  with JSON body {"bk_huurovereenkomst": [...], "bk_eenheid": [...]}
+    """
+
+    class ScoringRequestHandler(BaseHTTPRequestHandler):
+        # Keep-alive, so clients don't pay for a new TCP connection on every request. Headers and body are written
+        # separately, so Nagle's algorithm would delay every response by ~40 ms on a kept-alive connection.
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/health":
+                self._respond(200, {"status": "ok", "huurovereenkomsten": len(service.ids_hovk)})
+            elif url.path == "/verhuiskans":
+                query = parse_qs(url.query)
+                self._score(query.get(COL_ID_HOVK, []), query.get(COL_ID_EENHEID, []))
+            else:
+                self._respond(404, {"error": f"Unknown path {url.path}"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/verhuiskans":
+                self._respond(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except json.JSONDecodeError as e:
+                self._respond(400, {"error": f"Invalid JSON: {e}"})
+                return
+            self._score(body.get(COL_ID_HOVK, []), body.get(COL_ID_EENHEID, []))
+
+        def _score(self, ids_hovk: list[str], ids_eenheid: list[str]) -> None:
+            if not ids_hovk and not ids_eenheid:
+                self._respond(400, {"error": f"Provide {COL_ID_HOVK} and/or {COL_ID_EENHEID}"})
+                return
+            try:
+                result = service.score(ids_hovk=ids_hovk, ids_eenheid=ids_eenheid)
+            except ValueError as e:
+                self._respond(400, {"error": str(e)})
+                return
+            self._respond(200 if result["verhuiskansen"] else 404, result)
+
+        def _respond(self, status: int, content: dict) -> None:
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    return ScoringRequestHandler
+
+
+def create_server(service: ScoringService, host: str = SERVE_HOST, port: int = SERVE_PORT) -> ThreadingHTTPServer:
+    """Creates (but does not start) the HTTP server for a ScoringService. Use port=0 for a random free port."""
+    return ThreadingHTTPServer((host, port), make_handler(service))
+
+
+if __name__ == "__main__":
+    server = create_server(ScoringService.from_production())
+    logger.info(f"Serving verhuiskansen on http://{server.server_address[0]}:{server.server_address[1]}")
+    server.serve_forever()
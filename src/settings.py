@@ -3,7 +3,6 @@ from datetime import datetime
 
 from dotenv import load_dotenv
 from omegaconf import OmegaConf
-from sklearn.model_selection import StratifiedKFold
 
 from src.utils import get_env_var
 
@@ -18,17 +17,89 @@ PRODUCTIONIZED_MODELS = {
 
 DATA_DIR = "data"
 MODEL_DIR = "models"
+# Maximum number of downloaded models kept in the local model cache (see src.utils.model_cache)
+MODEL_CACHE_MAX_ENTRIES = 6
+# The outputs of the load and prepare stages of training are stored by the hash of their inputs, code and settings in
+# DATA_DIR/stage_cache and reused by the next run with the same inputs (see src.utils.stage_cache). If they take more
+# than STAGE_CACHE_MAX_BYTES, the least recently used ones are evicted. Predict never uses the stage cache
+USE_STAGE_CACHE = True
+STAGE_CACHE_MAX_BYTES = 20 * 1024**3
 OUTPUTS_DIR = "outputs"
 
 LOAD_DATA_FROM_AML = True
 LOG_EXPERIMENT_TO_AIM = False
 ANALYZE_ALGORITHM = False
 PARALLELIZE = False
+# If not PARALLELIZE, the next train job is prepared and the previous one saved in the background while a job trains
+# (see main_train._run_jobs_pipelined). Opt-in: this keeps up to three jobs in memory, so the compute needs at least
+# three times the peak RSS of a single train_job stage in the log (a compute sized for one job runs out of memory)
+PIPELINE_TRAIN_JOBS = False
+# Engine of the peildatum expansion in prepare: "pandas" or "duckdb" (multi-threaded SQL, see src.prepare_duckdb)
+PREPARE_ENGINE = "pandas"
+# Score with the DataFrame-free compiled scorer (see src.compiled_scorer) instead of the sklearn pipeline and model.
+# Only set this after python -m src.compiled_scorer has checked the productionized models against the sklearn path
+USE_COMPILED_SCORER = False
+# If set, predict streams the active contracts in chunks of this many rows to a parquet file (bounded memory)
+PREDICT_CHUNK_SIZE = None
+
+# Every traced stage (see src.utils.tracing) is sent to these exporters: "console" (log), "file" (json lines in
+# TRACE_DIR, or the directory in the VHK_TRACE_DIR environment variable) and/or "azure" (OpenTelemetry spans and
+# metrics to Application Insights, if configured)
+TRACE_EXPORTERS = ["console", "file", "azure"]
+TRACE_DIR = os.environ.get("VHK_TRACE_DIR", "logs")
+# Every TRACE_RSS_INTERVAL seconds the resident memory is sampled, for the peak RSS of every open traced stage
+TRACE_RSS_INTERVAL = 0.05
+# With environment variable MEMORY_PROFILE=1 every traced stage is memory profiled (see src.utils.memory_profile):
+# peak memory and the top allocation sites, in a report per train job / predict run in MEMORY_PROFILE_DIR
+MEMORY_PROFILE = os.environ.get("MEMORY_PROFILE", "0").lower() in ("1", "true")
+MEMORY_PROFILE_DIR = "logs"
+MEMORY_PROFILE_TOP = 10
+MEMORY_PROFILE_FRAMES = 25
+MEMORY_PROFILE_INTERVAL = 0.05
+# Environment variable CPU_PROFILE selects traced stages to CPU profile (see src.utils.cpu_profile), as comma-separated
+# names or paths with wildcards, e.g. CPU_PROFILE=search,expand. CPU_PROFILER is "sampling" (flame graphs) or "cprofile"
+CPU_PROFILE = [pattern.strip() for pattern in os.environ.get("CPU_PROFILE", "").split(",") if pattern.strip()]
+CPU_PROFILER = "sampling"
+CPU_PROFILE_INTERVAL = 0.005
+CPU_PROFILE_DIR = "logs"
+
+# Benchmarks (src/benchmark.py) are compared against this baseline; more than the threshold slower is a regression
+BENCHMARK_BASELINE_PATH = "reports/benchmark_baseline.json"
+BENCHMARK_REGRESSION_THRESHOLD = 0.2
+
+# Single-contract scoring service (src/serve.py)
+SERVE_HOST = "0.0.0.0"
+SERVE_PORT = 8080
+SERVE_MAX_BATCH_SIZE = 100
 
 RANDOM_SEED = 42
-CROSS_VAL_SETTING = StratifiedKFold(n_splits=5)
+# CROSS_VAL_SETTING = StratifiedKFold(n_splits=5), created on first use so sklearn is not imported with settings
 ALGORITHMS = ["XGBoostClassifier", "RandomForestClassifier"]
 CALIBRATION_METHODS = ["no calibration", "sigmoid", "isotonic"]
+# If set, only this fraction of the negative peildatum rows of every contract is kept in the train set (not in the
+# calibration and test sets), weighted so every contract keeps its weight (see src/downsample.py for the report)
+NEGATIVE_SAMPLING_RATE = None
+# Stability runs (the train jobs that are not in conf.data.production_dates) reuse the hyperparameters of the production
+# job of the same years_ahead: no hyperparameter search, production refit or calibration plots, only the test metrics
+STABILITY_RUNS_REUSE_HYPERPARAMETERS = False
+# Checkpoint every train job and its units (prepare, search, calibration, evaluation, refit) in data/train/checkpoints,
+# so a rerun of run_train_jobs after a crash or preemption resumes where it stopped (see src.utils.checkpoint)
+RESUME_TRAIN_RUNS = True
+# Checkpoints of other train runs (e.g. with other jobs or settings) are removed once nothing was written to them for
+# this many days; until then they may still be running or be resumed
+CHECKPOINT_MAX_AGE_DAYS = 14
+# Incremental refresh of an XGBoost model (src/refresh.py): REFRESH_BOOST_ROUNDS more boosting rounds on the months
+# labelled since the previous refresh. Every REFRESH_FULL_RETRAIN_DAYS days it is compared with a full retrain, which
+# replaces it if its ROC AUC is more than REFRESH_DRIFT_TOLERANCE higher
+REFRESH_BOOST_ROUNDS = 50
+REFRESH_FULL_RETRAIN_DAYS = 90
+REFRESH_DRIFT_TOLERANCE = 0.01
+# Cache the cross-validated scores of hyperparameter candidates in data/train/search_cache (see
+# src/utils/search_cache.py), so a rerun of an identical search fits nothing. At most SEARCH_CACHE_MAX_ENTRIES are kept
+USE_SEARCH_CACHE = True
+SEARCH_CACHE_MAX_ENTRIES = 2000
+# Also train the discrete-time hazard model (src/hazard.py): one model for all horizons, evaluated per horizon
+TRAIN_HAZARD_MODEL = False
 
 # Obtain secrets
 RGNAME = os.environ.get("RESOURCE_GROUP")
@@ -39,8 +110,21 @@ WORKSPACE_NAME = os.environ.get("AML_WORKSPACE_NAME")
 DATASTORENAME_PRD = "datalake"
 DATASTORENAME_DEV = "datalakedev"
 INPUT_PATH = "input/verhuiskans"
+# Extract vhk_alle_queries_v2 from the warehouse (WAREHOUSE_CONNECTION_STRING, needs pyodbc) instead of the AML data
+# asset. Only contracts that changed since the previous extraction are queried, see src/extract.py; every
+# EXTRACT_FULL_REFRESH_DAYS days everything is queried again
+EXTRACT_FROM_WAREHOUSE = False
+EXTRACT_FULL_REFRESH_DAYS = 7
 OUTPUT_SUBFOLDER_LATEST_VERHUISKANS = "output/verhuiskans/latest"
 OUTPUT_SUBFOLDER_AUDITTRAIL = "output/verhuiskans/audittrail"
+# The audittrail only stores verhuiskansen that changed more than AUDITTRAIL_TOLERANCE since the previous run, and a
+# full snapshot every AUDITTRAIL_SNAPSHOT_INTERVAL_DAYS days, see src/utils/audittrail.py
+AUDITTRAIL_TOLERANCE = 0.005
+AUDITTRAIL_SNAPSHOT_INTERVAL_DAYS = 28
+# Uploads to the datalake run in parallel background threads, failed uploads are retried with exponential backoff
+UPLOAD_MAX_WORKERS = 8
+UPLOAD_MAX_RETRIES = 3
+UPLOAD_BACKOFF_SECONDS = 2
 
 # Create configs for azure related task and training-related tasks.
 # conf will be logged to the aim experiment tracking server, whereas azure will only be used locally.
@@ -83,5 +167,15 @@ conf.data.production_dates = {
 
 conf.model = {}
 
-conf.aim_repo = f"aim://{os.environ['AIM_LOGGING_URL']}"
+# Resolved from the environment on access, so AIM_LOGGING_URL is only required when logging to aim
+conf.aim_repo = "aim://${oc.env:AIM_LOGGING_URL}"
 conf.aim_experiment = "verhuiskans"
+
+
+def __getattr__(name: str):
+    """Creates the settings that need heavy imports only when they are used (PEP 562)."""
+    if name == "CROSS_VAL_SETTING":
+        from sklearn.model_selection import StratifiedKFold
+
+        return StratifiedKFold(n_splits=5)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,232 @@
+-- Basistabel van vhk_alle_queries_v2.sql voor de incrementele extractie (src/extract.py).
+-- Verschillen met vhk_alle_queries_v2.sql:
+-- - alles wat van GETDATE() afhangt (survival_hovk_einddatum en de filters daarop) wordt lokaal afgeleid,
+--   zodat een rij alleen verandert als de data in het warehouse verandert. Alleen de extractiedatum (de laatste
+--   parameter) wordt gebruikt, om toekomstige geboortedatums weg te filteren
+-- - de huurovereenkomsten komen uit de CTE contracten: alle huurovereenkomsten (full refresh) of alleen de
+--   gewijzigde sinds de watermark (vhk_gewijzigde_huurovereenkomsten.sql)
+-- - standaard SQL (geen [haken], GETDATE(), CONVERT of CONCAT), zodat de query ook op SQLite/DuckDB draait
+WITH contracten AS (
+{contracten}
+)
+SELECT
+        hovk.d_huurovereenkomst
+    ,   hovk.bk_huurovereenkomst
+    ,   hovk.survival_hovk_begindatum
+    ,   hovk.huurovereenkomst_einddatum
+    ,   hovk.huurovereenkomst_statusnaam
+    ,   hovk.debiteur_type
+    ,   eenh.bk_eenheid
+    ,   eenh.eenheidnaam
+    ,   eenh.eenheiddetailsoortnaam
+    ,   eenh.aantal_kamers
+    ,   eenh.woningtype
+    ,   eenh.opleverjaar
+    ,   eenh.opleverjaarcategorie
+    ,   eenh.gemeentenaam
+    ,   eenh.cbs_wijknaam
+    ,   eenh.cbs_buurtnaam
+    ,   eenh.etagenummer
+    ,   eenh.daebnaam
+    ,   eenh.vestigingsnaam
+    ,   eenh.lift_aanwezig_indicator
+    ,   eenh.gebruiksoppervlak
+    ,   contrpers.min_geboortedatum
+    ,   contrpers.max_geboortedatum
+    ,   contrpers.percentage_man
+    ,   contrpers.aantal_contractant_medebewoner
+    ,   aanvhuur.aanvangshuurbedrag
+    ,   aanvhuur.huurklasse_code_aanvang
+FROM
+    (
+        -- BEDOELING: zie vhk_alle_queries_v2.sql. Hier alleen de ruwe einddatum, survival_hovk_einddatum wordt
+        -- lokaal bepaald.
+        SELECT
+                fh.d_huurovereenkomst
+            ,   fh.d_eenheid
+            ,   dh.bk_huurovereenkomst
+            ,   CASE
+                    WHEN fh."d_dag!huurovereenkomst_begindatum" = '2999-12-31' THEN '2199-12-31'
+                    ELSE fh."d_dag!huurovereenkomst_begindatum"
+                END AS survival_hovk_begindatum
+            ,   fh."d_dag!huurovereenkomst_einddatum" AS huurovereenkomst_einddatum
+            ,   dh.huurovereenkomst_statusnaam
+            ,   CASE WHEN dd.debiteur_type IN ('(Onbekend)', '(Leeg)') THEN NULL ELSE dd.debiteur_type END AS debiteur_type
+        FROM dm_gold.f_huurovereenkomst fh
+
+        INNER JOIN contracten
+        ON contracten.d_huurovereenkomst = fh.d_huurovereenkomst
+
+        INNER JOIN dm_gold.d_huurovereenkomst dh
+        ON dh.id = fh.d_huurovereenkomst
+
+        INNER JOIN dm_gold.d_eenheid de
+        ON de.id = fh.d_eenheid
+
+        INNER JOIN dm_gold.d_debiteur dd
+        ON dd.id = fh.d_debiteur
+
+        WHERE
+            -- alleen laatste snapshot
+            fh.d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst)
+            -- alleen woningen (geen parkeerplekken, BOG, MOG, etc.)
+            AND ((de.eenheidsoortnaam = 'Woningen') OR (de.eenheidsoortnaam='Woonruimte' AND de.woonvormnaam='Woningen'))
+            -- geen voorlopige huurovereenkomsten
+            AND dh.huurovereenkomst_statusnaam != 'Voorlopig'
+            -- {VOORLOPIG} geen hovk met te oude einddatum om betrouwbaar te kunnen zijn
+            AND NOT (fh."d_dag!huurovereenkomst_einddatum" < '2002-01-01')
+            -- survival_hovk_einddatum >= '2023-01-01' (zie vhk_alle_queries_v2.sql) kan alleen als de einddatum
+            -- dat ook is: de survival einddatum is de einddatum of vandaag
+            AND NOT (fh."d_dag!huurovereenkomst_einddatum" < '2023-01-01')
+    ) AS hovk
+
+LEFT JOIN
+    (
+        -- BEDOELING: zie vhk_alle_queries_v2.sql. opleverdatum wordt lokaal uit opleverjaar afgeleid.
+        SELECT
+                fe.d_eenheid
+            ,   de.bk_eenheid
+            ,   de.eenheidnaam
+            ,   de.eenheiddetailsoortnaam
+            ,   de.aantal_kamers
+            ,   de.woningtype
+            ,   CASE
+                    WHEN de.opleverjaar BETWEEN 1000 AND 2500
+                    THEN de.opleverjaar
+                    ELSE NULL
+                END AS opleverjaar
+            ,   CASE
+                    WHEN de.opleverjaar = 0 THEN NULL
+                    WHEN de.opleverjaar < 1900 THEN '<1900'
+                    WHEN de.opleverjaar BETWEEN 1900 AND 1919 THEN '1900-1919'
+                    WHEN de.opleverjaar BETWEEN 1920 AND 1939 THEN '1920-1939'
+                    WHEN de.opleverjaar BETWEEN 1940 AND 1959 THEN '1940-1959'
+                    WHEN de.opleverjaar BETWEEN 1960 AND 1969 THEN '1960-1969'
+                    WHEN de.opleverjaar BETWEEN 1970 AND 1979 THEN '1970-1979'
+                    WHEN de.opleverjaar BETWEEN 1980 AND 1989 THEN '1980-1989'
+                    WHEN de.opleverjaar BETWEEN 1990 AND 1999 THEN '1990-1999'
+                    WHEN de.opleverjaar BETWEEN 2000 AND 2009 THEN '2000-2009'
+                    WHEN de.opleverjaar >= 2010 THEN '>=2010'
+                    ELSE NULL
+                END AS opleverjaarcategorie
+            ,   de.gemeentenaam
+            ,   de.cbs_wijknaam
+            ,   de.cbs_buurtnaam
+            ,   de.etagenummer
+            ,   CASE
+                    WHEN dd.daebnaam IN ('DAEB', 'Daeb') THEN 'Daeb'
+                    WHEN dd.daebnaam IN ('NIETDAEB', 'Niet Daeb') THEN 'Niet Daeb'
+                    ELSE NULL
+                END AS daebnaam
+            ,   CASE
+                    WHEN dv.vestigingsnaam IN ('(Onbekend)', '(Leeg)') THEN NULL
+                    ELSE dv.vestigingsnaam
+                END AS vestigingsnaam
+            ,   CASE
+                    WHEN de.lift_aanwezig_indicator = 'Ja' THEN 1
+                    ELSE 0
+                END AS lift_aanwezig_indicator
+            ,   CASE
+                    WHEN CAST(ROUND(de.gebruiksoppervlak, 0) AS INT) = 0 THEN NULL
+                    ELSE CAST(ROUND(de.gebruiksoppervlak, 0) AS INT)
+                END AS gebruiksoppervlak
+
+        FROM dm_gold.f_eenheid fe
+
+        INNER JOIN dm_gold.d_eenheid de
+        ON de.id = fe.d_eenheid
+
+        INNER JOIN dm_gold.d_daeb dd
+        ON dd.id = fe.d_daeb
+
+        INNER JOIN dm_gold.d_vestiging dv
+        ON dv.id = fe.d_vestiging
+
+        WHERE
+            -- alleen laatste snapshot
+            fe.d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_eenheid)
+            -- alleen woningen (geen parkeerplekken, BOG, MOG, etc.)
+            AND ((de.eenheidsoortnaam = 'Woningen') OR (de.eenheidsoortnaam='Woonruimte' AND de.woonvormnaam='Woningen'))
+
+    ) AS eenh ON hovk.d_eenheid = eenh.d_eenheid
+
+LEFT JOIN
+    (
+        -- BEDOELING: zie vhk_alle_queries_v2.sql
+        SELECT
+                c.d_huurovereenkomst
+            ,   MIN(c.geboortedatum) AS min_geboortedatum
+            ,   MAX(c.geboortedatum) AS max_geboortedatum
+            ,   AVG(c.man_ind) AS percentage_man
+            ,   COUNT(*) AS aantal_contractant_medebewoner
+
+        FROM
+        (
+            SELECT
+                    fch.d_huurovereenkomst
+                ,   fh."d_dag!huurovereenkomst_begindatum"
+                ,   CASE
+                        WHEN (
+                            -- geen waarden die eigenlijk NULL moeten zijn
+                            dr.geboortedatum NOT IN ('2999-12-31', '1900-01-01')
+                            -- geen toekomstige geboortedatum (parameter: extractiedatum)
+                            AND dr.geboortedatum < ?
+                            -- hovk_begindatum moet later zijn dan geboortedatum
+                            AND fh."d_dag!huurovereenkomst_begindatum" > dr.geboortedatum
+                            )
+                        THEN dr.geboortedatum
+                    ELSE NULL END AS geboortedatum
+                ,   CASE WHEN dr.geslachtsnaam IN ('Man','Mannelijk') THEN 1.0 ELSE 0.0 END AS man_ind
+
+            FROM dm_gold.f_contactpersoon_huurovereenkomst fch
+
+            INNER JOIN contracten
+            ON contracten.d_huurovereenkomst = fch.d_huurovereenkomst
+
+            INNER JOIN dm_gold.f_huurovereenkomst fh
+            ON fch.d_huurovereenkomst = fh.d_huurovereenkomst
+            AND fch.d_dag = fh.d_dag
+
+            INNER JOIN dm_gold.d_relatie dr
+            ON dr.id = fch.d_relatie
+
+            INNER JOIN dm_gold.d_relatierol_huurovereenkomst drh
+            ON drh.id = fch.d_relatierol_huurovereenkomst
+
+            WHERE
+                -- filtert lege of onbekende relatie(rol) weg
+                (fch.d_relatie > 0 AND fch.d_relatierol_huurovereenkomst > 0)
+                -- alleen contractant, medebewoner
+                AND drh.relatierolnaam IN ('Contractant', 'Medebewoner')
+                -- contractpersoon moet bekend zijn bij start huurovereenkomst
+                AND fch."d_dag!begindatum" = fh."d_dag!huurovereenkomst_begindatum"
+        ) AS c
+
+        GROUP BY
+                c.d_huurovereenkomst
+
+    ) AS contrpers ON hovk.d_huurovereenkomst = contrpers.d_huurovereenkomst
+
+LEFT JOIN
+    (
+        -- BEDOELING: zie vhk_alle_queries_v2.sql
+        SELECT
+                fh.d_huurovereenkomst
+            ,   fh.aanvangshuurbedrag
+            ,   dha.huurklasse_code AS huurklasse_code_aanvang
+
+        FROM dm_gold.f_huurovereenkomst fh
+
+        INNER JOIN contracten
+        ON contracten.d_huurovereenkomst = fh.d_huurovereenkomst
+
+        INNER JOIN dm_gold.d_huurovereenkomst dh
+        ON dh.id = fh.d_huurovereenkomst
+
+        INNER JOIN dm_gold.d_huurklasse dha
+        ON dha.id = fh."d_huurklasse!aanvangshuur"
+
+        WHERE
+            fh.d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst)
+
+    ) AS aanvhuur ON hovk.d_huurovereenkomst = aanvhuur.d_huurovereenkomst
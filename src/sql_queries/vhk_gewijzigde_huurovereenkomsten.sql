@@ -0,0 +1,49 @@
+-- Huurovereenkomsten waarvan de rij in de laatste snapshot van f_huurovereenkomst nieuw is of verschilt van de rij in
+-- de snapshot van de watermark (parameter: d_dag van de vorige extractie), bijv. door een nieuwe einddatum, plus de
+-- huurovereenkomsten die sindsdien uit f_huurovereenkomst verdwenen zijn. Wordt als CTE contracten in
+-- vhk_alle_queries_v2_basis.sql gebruikt (src/extract.py).
+-- Wijzigingen die alleen in dimensies of andere feiten zitten (statusnaam, eenheid, contactpersonen) worden hier niet
+-- gezien; die komen mee bij de periodieke full refresh.
+SELECT gewijzigd.d_huurovereenkomst
+FROM
+    (
+        SELECT
+                d_huurovereenkomst
+            ,   d_eenheid
+            ,   d_debiteur
+            ,   "d_dag!huurovereenkomst_begindatum"
+            ,   "d_dag!huurovereenkomst_einddatum"
+            ,   "d_huurklasse!aanvangshuur"
+            ,   aanvangshuurbedrag
+        FROM dm_gold.f_huurovereenkomst
+        WHERE d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst)
+
+        EXCEPT
+
+        SELECT
+                d_huurovereenkomst
+            ,   d_eenheid
+            ,   d_debiteur
+            ,   "d_dag!huurovereenkomst_begindatum"
+            ,   "d_dag!huurovereenkomst_einddatum"
+            ,   "d_huurklasse!aanvangshuur"
+            ,   aanvangshuurbedrag
+        FROM dm_gold.f_huurovereenkomst
+        WHERE d_dag = ?
+    ) AS gewijzigd
+
+UNION
+
+SELECT verdwenen.d_huurovereenkomst
+FROM
+    (
+        SELECT d_huurovereenkomst
+        FROM dm_gold.f_huurovereenkomst
+        WHERE d_dag = ?
+
+        EXCEPT
+
+        SELECT d_huurovereenkomst
+        FROM dm_gold.f_huurovereenkomst
+        WHERE d_dag = (SELECT MAX(d_dag) FROM dm_gold.f_huurovereenkomst)
+    ) AS verdwenen
@@ -4,6 +4,7 @@ from io import BytesIO
 
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 from aim import Image, Run, Text
 from sklearn.calibration import CalibratedClassifierCV, CalibrationDisplay
 from sklearn.ensemble import RandomForestClassifier
@@ -20,9 +21,18 @@ from src.settings import (
     OUTPUTS_DIR,
     PARALLELIZE,
     RANDOM_SEED,
+    SEARCH_CACHE_MAX_ENTRIES,
+    USE_SEARCH_CACHE,
     conf,
 )
+from src.utils.checkpoint import JobCheckpoint, run_unit
 from src.utils.io import LEVEL, generate_data_dir_path, load_from_pkl
+from src.utils.search_cache import (
+    CachedSearchResult,
+    SearchCache,
+    cached_randomized_search,
+)
+from src.utils.tracing import stage
 
 
 def train_and_evaluate_models(
@@ -32,6 +42,8 @@ def train_and_evaluate_models(
     testdate_str: int,
     years_ahead: int,
     number_of_experiments=5,
+    hyperparameters: dict[str, dict] | None = None,
+    checkpoint: JobCheckpoint | None = None,
 ) -> dict:
     """Train and evaluate models.
 
@@ -44,53 +56,57 @@ def train_and_evaluate_models(
     * We have decided we wish to manually select the best model based on the calibration plot and
         ROC AUC + Brier score metrics. By storing them all, we can
         select ourselves which model to productionize.
+
+    With hyperparameters (per algorithm, e.g. those of the production run of the same years_ahead) this is a
+    stability run: step 1 fits a single model per algorithm with these hyperparameters instead of searching (there is
+    no cross-validated ROC AUC), and step 4 and the calibration plots are skipped. The test metrics are the same as in
+    a full run, the returned models are those fitted on the train set.
+
+    If train_test_sets has weights w_train (NEGATIVE_SAMPLING_RATE), they are passed to every fit on the train set,
+    also in the search and the production refit (where the calibration rows get weight 1).
+
+    With a checkpoint, the search (or fit) per algorithm and the calibration, evaluation, refit and logging per
+    calibration method are checkpointed units: if the job is resumed, the units completed before are not run again.
     """
+    stability_run = hyperparameters is not None
     # 0. Setting things up..
     X_train, y_train = train_test_sets["X_train"], train_test_sets["y_train"]
+    # Weights of the train rows if the negative rows were downsampled (see src.downsample), else None
+    w_train = train_test_sets.get("w_train")
     X_calibrate, y_calibrate = train_test_sets["X_calibrate"], train_test_sets["y_calibrate"]
     X_test, y_test = train_test_sets["X_test"], train_test_sets["y_test"]
 
     results = []
-    _, ax = plt.subplots(figsize=(10, 10))
-    colors = plt.get_cmap("Dark2")
-    color_index = 0
+    search_cache = {"hits": 0, "misses": 0}
+    if not stability_run:
+        _, ax = plt.subplots(figsize=(10, 10))
+        colors = plt.get_cmap("Dark2")
+        color_index = 0
 
     # 1. Looping over ALGORITHMS
     for algorithm in ALGORITHMS:
-        if algorithm == "RandomForestClassifier":
-            model = RandomForestClassifier(random_state=RANDOM_SEED)
-            param_dist = {
-                "n_estimators": [100, 200, 300],
-                "max_depth": [5, 10, 15, None],
-                "min_samples_split": [2, 5, 10],
-                "min_samples_leaf": [1, 2, 4],
-                "bootstrap": [True, False],
-            }
-        if algorithm == "XGBoostClassifier":
-            model = XGBClassifier(random_state=RANDOM_SEED)
-            param_dist = {
-                "n_estimators": [100, 200, 300],
-                "max_depth": [3, 5, 7],
-                "learning_rate": [0.01, 0.1, 0.3],
-                "subsample": [0.7, 0.8, 1.0],
-                "colsample_bytree": [0.7, 0.8, 1.0],
-                "gamma": [0, 0.1, 0.2],
-            }
-
-        # Randomized search optimizing for ROC AUC. Optimization for Brier score comes in the calibration step.
-        search = RandomizedSearchCV(
-            estimator=model,
-            param_distributions=param_dist,
-            n_iter=number_of_experiments,
-            cv=CROSS_VAL_SETTING,
-            scoring="roc_auc",
-            verbose=0,
-            random_state=RANDOM_SEED,
-            n_jobs=1 if PARALLELIZE else -1,
-        )
-
-        search.fit(X_train, y_train)
-        best_model, best_params, cv_roc_auc = search.best_estimator_, search.best_params_, search.best_score_
+        if stability_run:
+
+            def fit():
+                with stage("fit", algorithm=algorithm) as span:
+                    model = fit_with_hyperparameters(algorithm, hyperparameters[algorithm], X_train, y_train, w_train)
+                    span.set(rows_in=len(X_train))
+                return model, hyperparameters[algorithm], None, 0, 0
+
+            unit = fit
+        else:
+
+            def search():
+                search = search_hyperparameters(
+                    algorithm, X_train, y_train, number_of_experiments=number_of_experiments, sample_weight=w_train
+                )
+                hits, misses = getattr(search, "cache_hits", 0), getattr(search, "cache_misses", 0)
+                return search.best_estimator_, search.best_params_, search.best_score_, hits, misses
+
+            unit = search
+        best_model, best_params, cv_roc_auc, hits, misses = run_unit(checkpoint, f"{algorithm}/{unit.__name__}", unit)
+        search_cache["hits"] += hits
+        search_cache["misses"] += misses
 
         # 2. Loop over all CALIBRATION_METHODS with the model best hyperparameters for ranking (= ROC_AUC)
         for calibration_method in CALIBRATION_METHODS:
@@ -99,60 +115,80 @@ def train_and_evaluate_models(
             if calibration_method == "no calibration":
                 calibrated_model = best_model
             else:
-                calibrated_model = CalibratedClassifierCV(
-                    estimator=FrozenEstimator(best_model),
-                    method=calibration_method,
-                    ensemble=False,
-                )
-                # Fit the calibrated model on validation data
-                calibrated_model.fit(X_calibrate, y_calibrate)
+
+                def calibrate():
+                    calibrated_model = CalibratedClassifierCV(
+                        estimator=FrozenEstimator(best_model),
+                        method=calibration_method,
+                        ensemble=False,
+                    )
+                    # Fit the calibrated model on validation data
+                    with stage("calibrate", algorithm=algorithm, calibration_method=calibration_method) as span:
+                        calibrated_model.fit(X_calibrate, y_calibrate)
+                        span.set(rows_in=len(X_calibrate))
+                    return calibrated_model
+
+                calibrated_model = run_unit(checkpoint, f"{algorithm}/{calibration_method}/calibrate", calibrate)
 
             # 3. Evaluation of performance
-            cv_calibrated_brier_score = brier_score_loss(
-                y_true=y_calibrate, y_proba=calibrated_model.predict_proba(X_calibrate)[:, 1]
-            )
+            def evaluate():
+                cv_calibrated_brier_score = brier_score_loss(
+                    y_true=y_calibrate, y_proba=calibrated_model.predict_proba(X_calibrate)[:, 1]
+                )
+                # Assess performance on test set
+                pos_class_proba = calibrated_model.predict_proba(X_test)[:, 1]
+                test_roc_auc = round(roc_auc_score(y_true=y_test, y_score=pos_class_proba), 3)
+                test_brier_score = round(brier_score_loss(y_true=y_test, y_proba=pos_class_proba), 3)
+                return cv_calibrated_brier_score, pos_class_proba, test_roc_auc, test_brier_score
 
-            # Assess performance on test set, plot it in calibration line
-            pos_class_proba = calibrated_model.predict_proba(X_test)[:, 1]
-
-            display_kwargs = {"marker": "o", "markersize": 0.2, "linewidth": 0.3}
-            CalibrationDisplay.from_predictions(
-                y_true=y_test,
-                y_prob=pos_class_proba,
-                n_bins=40,
-                strategy="quantile",
-                name=f"{algorithm}_{calibration_method}_AUC_{cv_roc_auc}_Brier_{cv_calibrated_brier_score}",  # noqa: E501
-                ax=ax,
-                color=colors(color_index),
-                **display_kwargs,
+            cv_calibrated_brier_score, pos_class_proba, test_roc_auc, test_brier_score = run_unit(
+                checkpoint, f"{algorithm}/{calibration_method}/evaluate", evaluate
             )
-            color_index += 1
 
-            # Evaluate on test set
-            test_roc_auc = round(roc_auc_score(y_true=y_test, y_score=pos_class_proba), 3)
-            test_brier_score = round(brier_score_loss(y_true=y_test, y_proba=pos_class_proba), 3)
+            # Plot the performance on the test set in calibration line
+            if not stability_run:
+                display_kwargs = {"marker": "o", "markersize": 0.2, "linewidth": 0.3}
+                CalibrationDisplay.from_predictions(
+                    y_true=y_test,
+                    y_prob=pos_class_proba,
+                    n_bins=40,
+                    strategy="quantile",
+                    name=f"{algorithm}_{calibration_method}_AUC_{cv_roc_auc}_Brier_{cv_calibrated_brier_score}",  # noqa: E501
+                    ax=ax,
+                    color=colors(color_index),
+                    **display_kwargs,
+                )
+                color_index += 1
 
             # 4. Make model production-ready (meaning: train it on latest data)
             # The original train + calibration datasets will be used for training
-            X_train_prd = np.concatenate((X_train, X_calibrate), axis=0)
-            y_train_prd = np.concatenate((y_train, y_calibrate), axis=0)
-
-            if algorithm == "RandomForestClassifier":
-                best_model = RandomForestClassifier(**best_params, random_state=RANDOM_SEED)
-            if algorithm == "XGBoostClassifier":
-                best_model = XGBClassifier(**best_params, random_state=RANDOM_SEED)
-            best_model.fit(X_train_prd, y_train_prd)
-
-            # If valid calibration method is selected, it will be done one the original test dataset
-            if calibration_method != "no calibration":
-                X_calibrate_prd = X_test
-                y_calibrate_prd = y_test
-                calibrated_model = CalibratedClassifierCV(
-                    estimator=FrozenEstimator(best_model),
-                    method=calibration_method,
-                    ensemble=False,
-                )
-                calibrated_model.fit(X_calibrate_prd, y_calibrate_prd)
+            if not stability_run:
+
+                def refit():
+                    X_train_prd = np.concatenate((X_train, X_calibrate), axis=0)
+                    y_train_prd = np.concatenate((y_train, y_calibrate), axis=0)
+                    w_train_prd = None if w_train is None else np.concatenate((w_train, np.ones(len(y_calibrate))))
+
+                    with stage("refit", algorithm=algorithm, calibration_method=calibration_method) as span:
+                        prd_model = fit_with_hyperparameters(
+                            algorithm, best_params, X_train_prd, y_train_prd, w_train_prd
+                        )
+                        prd_calibrated_model = calibrated_model
+
+                        # If valid calibration method is selected, it will be done one the original test dataset
+                        if calibration_method != "no calibration":
+                            X_calibrate_prd = X_test
+                            y_calibrate_prd = y_test
+                            prd_calibrated_model = CalibratedClassifierCV(
+                                estimator=FrozenEstimator(prd_model),
+                                method=calibration_method,
+                                ensemble=False,
+                            )
+                            prd_calibrated_model.fit(X_calibrate_prd, y_calibrate_prd)
+                        span.set(rows_in=len(X_train_prd))
+                    return prd_calibrated_model
+
+                calibrated_model = run_unit(checkpoint, f"{algorithm}/{calibration_method}/refit", refit)
 
             # 5. Store result to results
             results.append(
@@ -167,49 +203,59 @@ def train_and_evaluate_models(
                     "model": calibrated_model,
                 }
             )
-            # Log the results
-            summary = f"""
-                {display_name}
-                Cross-validated results
-                Algorithm: {algorithm}
-                Calibration method: {calibration_method}
-                CV_ROC_AUC: {cv_roc_auc}
-                CV_Brier Score: {cv_calibrated_brier_score}
-                Test_ROC_AUC: {test_roc_auc}
-                Test_Brier Score: {test_brier_score}
-            """
-
-            # Log results to aim
-            aim_run = Run(repo=conf.aim_repo, experiment=conf.aim_experiment)
-
-            aim_run["traindate"] = traindate_str
-            aim_run["testdate"] = testdate_str
-            aim_run["years_ahead"] = years_ahead
-            model_params = copy.deepcopy(best_params)
-            model_params["type"] = algorithm
-            model_params["calibration_method"] = calibration_method
-            aim_run["model"] = model_params
-            aim_run.track(cv_roc_auc, name="AUC", context={"subset": "train"})
-            aim_run.track(test_roc_auc, name="AUC", context={"subset": "test"})
-            aim_run.track(cv_calibrated_brier_score, name="Brier", context={"subset": "train"})
-            aim_run.track(test_brier_score, name="Brier", context={"subset": "test"})
-
-            ax.legend()
-            plt.title(display_name)
-            output_filepath = f"{OUTPUTS_DIR}/calibrationplots_{algorithm}_{calibration_method}.png"
-            plt.savefig(output_filepath, dpi=300, format="png")
-            aim_run.track(
-                Image(output_filepath, format="png"),
-                name="calibration_plot_test",
-                context={"subset": "test"},
-            )
-            # Get current git-commit
-            commit_hash = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf-8").strip()
-            aim_run["commit_hash"] = commit_hash
 
-            aim_run.track(Text(summary), name="summary", context={"subset": "train"})
+            # Log the results, once per run (also when the job is resumed from a checkpoint)
+            def log():
+                summary = f"""
+                    {display_name}
+                    Cross-validated results
+                    Algorithm: {algorithm}
+                    Calibration method: {calibration_method}
+                    CV_ROC_AUC: {cv_roc_auc}
+                    CV_Brier Score: {cv_calibrated_brier_score}
+                    Test_ROC_AUC: {test_roc_auc}
+                    Test_Brier Score: {test_brier_score}
+                """
+
+                # Log results to aim
+                aim_run = Run(repo=conf.aim_repo, experiment=conf.aim_experiment)
+
+                aim_run["traindate"] = traindate_str
+                aim_run["testdate"] = testdate_str
+                aim_run["years_ahead"] = years_ahead
+                aim_run["stability_run"] = stability_run
+                model_params = copy.deepcopy(best_params)
+                model_params["type"] = algorithm
+                model_params["calibration_method"] = calibration_method
+                aim_run["model"] = model_params
+                if cv_roc_auc is not None:
+                    aim_run.track(cv_roc_auc, name="AUC", context={"subset": "train"})
+                aim_run.track(test_roc_auc, name="AUC", context={"subset": "test"})
+                aim_run.track(cv_calibrated_brier_score, name="Brier", context={"subset": "train"})
+                aim_run.track(test_brier_score, name="Brier", context={"subset": "test"})
+
+                if not stability_run:
+                    ax.legend()
+                    plt.title(display_name)
+                    output_filepath = f"{OUTPUTS_DIR}/calibrationplots_{algorithm}_{calibration_method}.png"
+                    plt.savefig(output_filepath, dpi=300, format="png")
+                    aim_run.track(
+                        Image(output_filepath, format="png"),
+                        name="calibration_plot_test",
+                        context={"subset": "test"},
+                    )
+                # Get current git-commit
+                commit_hash = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf-8").strip()
+                aim_run["commit_hash"] = commit_hash
+
+                aim_run.track(Text(summary), name="summary", context={"subset": "train"})
 
-            logger.info(summary)
+                logger.info(summary)
+
+            run_unit(checkpoint, f"{algorithm}/{calibration_method}/log", log)
+
+    if stability_run:
+        return {"models": results, "calibration_plot": None, "search_cache": search_cache}
 
     # Create calibration plot for all models in the ALGORITHMS/CALIBRATION_METHODS loops, also save it as a variable.
     ax.legend()
@@ -223,11 +269,108 @@ def train_and_evaluate_models(
     plt.close()
 
     # 6. Save results
-    output = {"models": results, "calibration_plot": plot_buffer}
+    output = {"models": results, "calibration_plot": plot_buffer, "search_cache": search_cache}
 
     return output
 
 
+def fit_with_hyperparameters(
+    algorithm: str,
+    hyperparameters: dict,
+    X: pd.DataFrame | np.ndarray,
+    y: pd.Series | np.ndarray,
+    sample_weight: pd.Series | np.ndarray | None = None,
+) -> RandomForestClassifier | XGBClassifier:
+    """Fits a model of algorithm (one of ALGORITHMS) with the given hyperparameters (and weights of the rows)."""
+    if algorithm == "RandomForestClassifier":
+        model = RandomForestClassifier(**hyperparameters, random_state=RANDOM_SEED)
+    if algorithm == "XGBoostClassifier":
+        model = XGBClassifier(**hyperparameters, random_state=RANDOM_SEED)
+    return model.fit(X, y, sample_weight=None if sample_weight is None else np.asarray(sample_weight))
+
+
+def get_model_and_param_dist(algorithm: str) -> tuple[RandomForestClassifier | XGBClassifier, dict]:
+    """Returns an unfitted model of algorithm (one of ALGORITHMS) and the hyperparameters to search over."""
+    if algorithm == "RandomForestClassifier":
+        model = RandomForestClassifier(random_state=RANDOM_SEED)
+        param_dist = {
+            "n_estimators": [100, 200, 300],
+            "max_depth": [5, 10, 15, None],
+            "min_samples_split": [2, 5, 10],
+            "min_samples_leaf": [1, 2, 4],
+            "bootstrap": [True, False],
+        }
+    if algorithm == "XGBoostClassifier":
+        model = XGBClassifier(random_state=RANDOM_SEED)
+        param_dist = {
+            "n_estimators": [100, 200, 300],
+            "max_depth": [3, 5, 7],
+            "learning_rate": [0.01, 0.1, 0.3],
+            "subsample": [0.7, 0.8, 1.0],
+            "colsample_bytree": [0.7, 0.8, 1.0],
+            "gamma": [0, 0.1, 0.2],
+        }
+    return model, param_dist
+
+
+def search_hyperparameters(
+    algorithm: str,
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    number_of_experiments: int = 5,
+    sample_weight: pd.Series | np.ndarray | None = None,
+    use_cache: bool | None = None,
+) -> RandomizedSearchCV | CachedSearchResult:
+    """Randomized search over the hyperparameters of algorithm, optimizing for ROC AUC.
+
+    Optimization for Brier score comes in the calibration step, see train_and_evaluate_models. If use_cache (by
+    default USE_SEARCH_CACHE), the cross-validated scores of the candidates are cached (see src.utils.search_cache), so
+    only new candidates are fitted; the result has cache_hits and cache_misses. sample_weight is passed to every fit,
+    the cross-validated ROC AUC is not weighted.
+    """
+    fit_params = {} if sample_weight is None else {"sample_weight": np.asarray(sample_weight)}
+    model, param_dist = get_model_and_param_dist(algorithm)
+    if USE_SEARCH_CACHE if use_cache is None else use_cache:
+        with stage("search", algorithm=algorithm) as span:
+            search = cached_randomized_search(
+                estimator=model,
+                param_distributions=param_dist,
+                X=X_train,
+                y=y_train,
+                n_iter=number_of_experiments,
+                cv=CROSS_VAL_SETTING,
+                scoring="roc_auc",
+                random_state=RANDOM_SEED,
+                n_jobs=1 if PARALLELIZE else -1,
+                fit_params=fit_params,
+                cache=SearchCache(generate_data_dir_path(LEVEL.TRAIN, "search_cache"), SEARCH_CACHE_MAX_ENTRIES),
+            )
+            span.set(
+                rows_in=len(X_train),
+                candidates=number_of_experiments,
+                cache_hits=search.cache_hits,
+                cache_misses=search.cache_misses,
+            )
+        logger.info(f"Search cache {algorithm}: {search.cache_hits} hits, {search.cache_misses} misses")
+        return search
+
+    search = RandomizedSearchCV(
+        estimator=model,
+        param_distributions=param_dist,
+        n_iter=number_of_experiments,
+        cv=CROSS_VAL_SETTING,
+        scoring="roc_auc",
+        verbose=0,
+        random_state=RANDOM_SEED,
+        n_jobs=1 if PARALLELIZE else -1,
+    )
+
+    with stage("search", algorithm=algorithm) as span:
+        search.fit(X_train, y_train, **fit_params)
+        span.set(rows_in=len(X_train), candidates=number_of_experiments)
+    return search
+
+
 if __name__ == "__main__":
     train_test_path = generate_data_dir_path(LEVEL.PREPARE, "train_test_sets", suffix=".pickle")
     train_test_sets = load_from_pkl(train_test_path)
@@ -124,9 +124,9 @@ def timeit(units: str = "s", method: Callable = logging.info) -> Callable:
     def timeit_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            t0 = time.time()
+            t0 = time.perf_counter()
             res = func(*args, **kwargs)
-            t1 = time.time()
+            t1 = time.perf_counter()
             if units == "ms":
                 diff = f"{(t1 - t0) * 1000:.0f} ms"
             else:
@@ -153,7 +153,8 @@ class Timer:
 
     def __init__(self):
         """Initializes the time function."""
-        self.time = time.time()
+        # perf_counter is monotonic and high-resolution, unlike time.time(), which jumps with clock adjustments
+        self.time = time.perf_counter()
 
     def __call__(self, msg: str = None, update: bool = True, method: Callable = print) -> None:
         """Logs the time elapsed since the last checkpoint.
@@ -166,7 +167,7 @@ class Timer:
         Returns:
             None
         """
-        new_time = time.time()
+        new_time = time.perf_counter()
         diff = new_time - self.time
 
         # update last timestamp
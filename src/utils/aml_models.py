@@ -1,14 +1,23 @@
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-
-from azure.ai.ml import MLClient
-from azure.ai.ml.constants import AssetTypes
-from azure.ai.ml.entities import Model
-from azure.identity import DefaultAzureCredential
+from typing import TYPE_CHECKING
 
 from src.my_logging import logger
-from src.settings import MODEL_DIR, RGNAME, SUBSCRIPTIONID, WORKSPACE_NAME, azure
+from src.settings import (
+    MODEL_CACHE_MAX_ENTRIES,
+    MODEL_DIR,
+    RGNAME,
+    SUBSCRIPTIONID,
+    WORKSPACE_NAME,
+    azure,
+)
 from src.utils.io import load_from_pkl
+from src.utils.model_cache import ModelCache
+
+if TYPE_CHECKING:
+    from azure.ai.ml import MLClient
 
 
 def upload_model_to_AML(model_path: str, tags: dict, properties: dict) -> None:
@@ -17,6 +26,10 @@ def upload_model_to_AML(model_path: str, tags: dict, properties: dict) -> None:
     - de gefitte preprocessing pipeline om te komen van ruwe features tot een inputset voor prediction
     """
     logger.info("Uploading model to Azure Machine Learning")
+    from azure.ai.ml import MLClient
+    from azure.ai.ml.constants import AssetTypes
+    from azure.ai.ml.entities import Model
+    from azure.identity import DefaultAzureCredential
 
     # Send model_dict to AML Models section
     credential = DefaultAzureCredential()
@@ -41,14 +54,61 @@ def get_model_from_AML(version_name: str, version_number: str) -> object:
     - het voorspellend algoritme
     - de gefitte preprocessing pipeline om te komen van ruwe features tot een inputset voor prediction
     """
-    logger.info(f"Downloading model {version_name} (version {version_number}) from Azure Machine Learning")
-    credential = DefaultAzureCredential()
-    ml_client = MLClient(
-        subscription_id=SUBSCRIPTIONID, resource_group_name=RGNAME, workspace_name=WORKSPACE_NAME, credential=credential
-    )
+    models = get_models_from_AML({version_name: {"version_name": version_name, "version_number": version_number}})
+    return models[version_name]
+
+
+def get_models_from_AML(models_info: dict) -> dict:
+    """Haalt meerdere modellen op, bijv. PRODUCTIONIZED_MODELS, met een lokale cache.
+
+    Modellen die al in de lokale cache staan worden niet opnieuw gedownload. Ontbrekende modellen worden gelijktijdig
+    gedownload uit Azure Machine Learning en daarna aan de cache toegevoegd.
 
-    models = ml_client.models.list(name=azure.project_name)
-    model_info = next(model for model in models if model.tags["version_name"] == version_name)
+    Args:
+        models_info (dict): key = bijv. years_ahead, value = dict met version_name en version_number
+
+    Returns:
+        dict: per key de model_dict met het voorspellend algoritme en de gefitte preprocessing pipeline
+    """
+    cache = ModelCache(Path(MODEL_DIR) / "cache", max_entries=MODEL_CACHE_MAX_ENTRIES)
+
+    paths = {key: cache.get(info["version_name"], info["version_number"]) for key, info in models_info.items()}
+    misses = [key for key, path in paths.items() if path is None]
+    logger.info(f"Model cache: {len(paths) - len(misses)} hit(s), {len(misses)} miss(es)")
+
+    if misses:
+        # Only imported when a model has to be downloaded, as the Azure ML SDK is slow to import
+        from azure.ai.ml import MLClient
+        from azure.identity import DefaultAzureCredential
+
+        credential = DefaultAzureCredential()
+        ml_client = MLClient(
+            subscription_id=SUBSCRIPTIONID,
+            resource_group_name=RGNAME,
+            workspace_name=WORKSPACE_NAME,
+            credential=credential,
+        )
+        with ThreadPoolExecutor(max_workers=len(misses)) as executor:
+            futures = {
+                key: executor.submit(
+                    _download_model_to_cache,
+                    ml_client,
+                    cache,
+                    models_info[key]["version_name"],
+                    models_info[key]["version_number"],
+                )
+                for key in misses
+            }
+            for key, future in futures.items():
+                paths[key] = future.result()
+
+    return {key: load_from_pkl(path) for key, path in paths.items()}
+
+
+def _download_model_to_cache(ml_client: "MLClient", cache: ModelCache, version_name: str, version_number: str) -> Path:
+    """Downloads a single pinned model version from Azure Machine Learning and stores it in the cache."""
+    logger.info(f"Downloading model {version_name} (version {version_number}) from Azure Machine Learning")
+    model_info = ml_client.models.get(name=azure.project_name, version=version_number)
 
     name = model_info.tags["version_name"]
     version = model_info.version
@@ -56,10 +116,12 @@ def get_model_from_AML(version_name: str, version_number: str) -> object:
 
     assert (version == version_number) & (name == version_name), "Model name and version don't match!"
 
-    download_path = Path(f"{MODEL_DIR}/from_aml")
+    # Every download gets its own folder, because AML always downloads into download_path/<model name>
+    download_path = Path(f"{MODEL_DIR}/from_aml/{version_name}-{version_number}")
     os.makedirs(download_path, exist_ok=True)
     ml_client.models.download(name=azure.project_name, version=version, download_path=download_path)
 
-    model_dict = load_from_pkl(os.path.join(download_path, azure.project_name, filename))
+    cached_path = cache.put(version_name, version_number, download_path / azure.project_name / filename)
+    shutil.rmtree(download_path, ignore_errors=True)
 
-    return model_dict
+    return cached_path
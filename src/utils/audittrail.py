@@ -0,0 +1,172 @@
+import re
+from concurrent.futures import Future
+from datetime import date, datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from fsspec import AbstractFileSystem
+
+from src.columns import COL_ID_EENHEID, COL_ID_HOVK
+from src.my_logging import logger
+from src.settings import AUDITTRAIL_SNAPSHOT_INTERVAL_DAYS, AUDITTRAIL_TOLERANCE
+from src.utils.parquet_output import (
+    AUDITTRAIL_SCHEMA,
+    PARTITION_COLUMN,
+    OutputWriter,
+    read_outputs,
+)
+from src.utils.upload_manager import UploadManager
+
+ENTRY_PATTERN = re.compile(r"^(\d{8})_(snapshot|delta)$")
+KEY_COLUMNS = [COL_ID_HOVK, PARTITION_COLUMN]
+COMPARED_COLUMNS = [COL_ID_EENHEID, "modelnaam", "modelversie"]
+
+
+class AuditTrail:
+    """Audit trail of the daily outputs that only stores what changed since the previous run.
+
+    Every run adds a folder <YYYYMMDD>_snapshot or <YYYYMMDD>_delta to root, written with OutputWriter:
+    - a snapshot holds the complete output of that day
+    - a delta holds the rows that are new, whose verhuiskans changed more than tolerance or whose eenheid or model
+      changed since the previous run, plus a tombstone (verwijderd = True) for every row that disappeared
+
+    A snapshot is written on the first run and whenever the last snapshot is snapshot_interval_days or more old, so
+    rebuilding a day never needs more deltas than that. Unchanged rows are not rewritten, so a rebuilt day contains
+    for these rows the verhuiskans and timestamp of the run that last wrote them, which differs at most tolerance from
+    that day's verhuiskans. Deltas are computed against the rebuilt previous state (not the previous actual output),
+    so small daily changes cannot add up to more than tolerance unnoticed.
+    """
+
+    def __init__(
+        self,
+        filesystem: AbstractFileSystem,
+        root: str,
+        tolerance: float = AUDITTRAIL_TOLERANCE,
+        snapshot_interval_days: int = AUDITTRAIL_SNAPSHOT_INTERVAL_DAYS,
+        uploads: UploadManager | None = None,
+    ):
+        """Opens the audit trail in folder root on filesystem (any fsspec filesystem).
+
+        New entries are uploaded in the background by uploads (by default a new UploadManager): call its wait() to
+        make sure they arrived.
+        """
+        self.fs = filesystem
+        self.uploads = uploads if uploads is not None else UploadManager()
+        self.root = root.rstrip("/")
+        self.tolerance = tolerance
+        self.snapshot_interval_days = snapshot_interval_days
+
+    def entries(self) -> list[tuple[date, str]]:
+        """Returns (date, 'snapshot' or 'delta') of every entry, sorted by date."""
+        if not self.fs.exists(self.root):
+            return []
+        entries = []
+        for path in self.fs.ls(self.root, detail=False):
+            match = ENTRY_PATTERN.match(path.rstrip("/").rsplit("/", 1)[-1])
+            if match:
+                entries.append((datetime.strptime(match[1], "%Y%m%d").date(), match[2]))
+        return sorted(entries)
+
+    def write(self, local_path: str | Path, day: date) -> str:
+        """Adds the outputs of day, written locally by OutputWriter in local_path, to the audit trail.
+
+        An existing entry of day (from an earlier run on the same day) is replaced.
+
+        Returns:
+            str: kind of entry that was written, 'snapshot' or 'delta'
+
+        Raises:
+            ValueError: if a key (bk_huurovereenkomst, aantal_jaar_vooruit) is missing or not unique in the outputs
+        """
+        current = read_outputs(local_path)
+        check_keys(current)
+
+        for entry_day, kind in self.entries():
+            if entry_day == day:
+                self.fs.rm(self._path(entry_day, kind), recursive=True)
+
+        chain = self._chain([entry for entry in self.entries() if entry[0] < day])
+        if not chain or (day - chain[0][0]).days >= self.snapshot_interval_days:
+            self._upload(local_path, day, "snapshot")
+            return "snapshot"
+
+        delta = compute_delta(self._rebuild(chain), current, tolerance=self.tolerance)
+        logger.info(f"Audit trail delta of {day}: {len(delta)} of {len(current)} rows changed or removed")
+
+        # Written next to local_path rather than in a temporary folder, as it is uploaded in the background
+        delta_path = Path(local_path).with_name(f"{Path(local_path).name}_delta")
+        with OutputWriter(delta_path, schema=AUDITTRAIL_SCHEMA) as writer:
+            writer.write(delta)
+        self._upload(writer.path, day, "delta")
+        return "delta"
+
+    def read(self, as_of: date) -> pd.DataFrame:
+        """Rebuilds the complete output of as_of (or of the last run before as_of) from a snapshot and its deltas."""
+        chain = self._chain([entry for entry in self.entries() if entry[0] <= as_of])
+        if not chain:
+            raise ValueError(f"No audit trail snapshot on or before {as_of} in {self.root}")
+        return self._rebuild(chain)
+
+    @staticmethod
+    def _chain(entries: list[tuple[date, str]]) -> list[tuple[date, str]]:
+        """Returns the last snapshot in entries and all deltas after it."""
+        snapshots = [i for i, (_, kind) in enumerate(entries) if kind == "snapshot"]
+        if not snapshots:
+            return []
+        last_snapshot = snapshots[-1]
+        return entries[last_snapshot:]
+
+    def _rebuild(self, chain: list[tuple[date, str]]) -> pd.DataFrame:
+        parts = []
+        for day, kind in chain:
+            df = read_outputs(self._path(day, kind), filesystem=self.fs)
+            if "verwijderd" not in df.columns:
+                df["verwijderd"] = False
+            parts.append(df)
+
+        # Entries are concatenated in date order, so the last row of every key holds its state on the last date
+        df = pd.concat(parts, ignore_index=True).drop_duplicates(KEY_COLUMNS, keep="last")
+        return df.loc[~df["verwijderd"].astype(bool)].drop(columns="verwijderd").reset_index(drop=True)
+
+    def _path(self, day: date, kind: str) -> str:
+        return f"{self.root}/{day:%Y%m%d}_{kind}"
+
+    def _upload(self, local_path: str | Path, day: date, kind: str) -> list[Future]:
+        logger.info(f"Uploading audit trail {kind} of {day} to {self.root}")
+        return self.uploads.upload_folder(local_path, self._path(day, kind), self.fs)
+
+
+def check_keys(df: pd.DataFrame) -> None:
+    """Raises a ValueError if a row of df misses a KEY_COLUMNS value or if a key occurs more than once.
+
+    Deltas are matched to the previous state and rebuilt by key, so a missing or repeated key would silently lose rows.
+    """
+    missing = df[KEY_COLUMNS].isna().any(axis=1)
+    if missing.any():
+        raise ValueError(f"{missing.sum()} output row(s) without {' or '.join(KEY_COLUMNS)}, cannot audit them by key")
+    duplicated = df.duplicated(KEY_COLUMNS, keep=False)
+    if duplicated.any():
+        examples = df.loc[duplicated, KEY_COLUMNS].drop_duplicates().head(5).to_dict("records")
+        raise ValueError(f"{duplicated.sum()} output rows share a key ({', '.join(KEY_COLUMNS)}), e.g. {examples}")
+
+
+def compute_delta(previous: pd.DataFrame, current: pd.DataFrame, tolerance: float) -> pd.DataFrame:
+    """Returns the rows of current that are new or changed compared to previous, plus tombstones for removed rows.
+
+    A row is changed if its verhuiskans differs more than tolerance or if its eenheid, modelnaam or modelversie
+    differs. Tombstones have verwijderd = True and keep the eenheid and model of their last state.
+    """
+    merged = previous.merge(current, on=KEY_COLUMNS, how="outer", suffixes=("_vorige", ""), indicator=True)
+    is_removed = (merged["_merge"] == "left_only").to_numpy()
+    is_new = (merged["_merge"] == "right_only").to_numpy()
+
+    is_changed = np.abs(merged["verhuiskans"].to_numpy() - merged["verhuiskans_vorige"].to_numpy()) > tolerance
+    for col in COMPARED_COLUMNS:
+        is_changed |= merged[col].to_numpy(dtype=object) != merged[f"{col}_vorige"].to_numpy(dtype=object)
+
+    changed = merged.loc[(is_new | is_changed) & ~is_removed, list(current.columns)].assign(verwijderd=False)
+    tombstones = merged.loc[is_removed, KEY_COLUMNS + [f"{col}_vorige" for col in COMPARED_COLUMNS]]
+    tombstones.columns = KEY_COLUMNS + COMPARED_COLUMNS
+
+    return pd.concat([changed, tombstones.assign(verwijderd=True)], ignore_index=True)
@@ -0,0 +1,124 @@
+import json
+import os
+import pickle
+import shutil
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from src.my_logging import logger
+from src.settings import CHECKPOINT_MAX_AGE_DAYS
+
+
+class RunCheckpoint:
+    """Checkpoints of a train run (see main_train.run_train_jobs): a JobCheckpoint per train job in run_dir.
+
+    The name of run_dir identifies the run (e.g. a hash of its jobs, settings, code and data), so a rerun of a crashed
+    or preempted run finds the checkpoints of the previous attempt and a changed run starts over. The checkpoints of
+    other runs are left alone, since they may still be running or be resumed, until they are older than
+    CHECKPOINT_MAX_AGE_DAYS.
+    """
+
+    def __init__(self, run_dir: str | Path):
+        """Initializes the checkpoints in run_dir and removes the stale ones of other runs in its parent directory."""
+        self.run_dir = Path(run_dir)
+        self.remove_stale(self.run_dir.parent, keep=self.run_dir)
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def remove_stale(checkpoints_dir: str | Path, keep: Path | None = None) -> None:
+        """Removes the checkpoints of runs in checkpoints_dir, except keep, unused for CHECKPOINT_MAX_AGE_DAYS."""
+        checkpoints_dir = Path(checkpoints_dir)
+        if not checkpoints_dir.exists():
+            return
+        cutoff = time.time() - CHECKPOINT_MAX_AGE_DAYS * 24 * 3600
+        for other in checkpoints_dir.iterdir():
+            if not other.is_dir() or other == keep:
+                continue
+            try:
+                last_written = max([path.stat().st_mtime for path in other.rglob("*")], default=other.stat().st_mtime)
+            except FileNotFoundError:  # a file was replaced by a run that is writing to it
+                continue
+            if last_written < cutoff:
+                logger.info(
+                    f"Removing the checkpoints of train run {other.name}, unused for {CHECKPOINT_MAX_AGE_DAYS} days"
+                )
+                shutil.rmtree(other, ignore_errors=True)
+
+    def job(self, name: str) -> "JobCheckpoint":
+        """Returns the checkpoint of the job with this name, e.g. '2023-01-01_1'."""
+        return JobCheckpoint(self.run_dir / name)
+
+    def remove(self) -> None:
+        """Removes all checkpoints, once the run is completed."""
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+
+class JobCheckpoint:
+    """Outputs and status of the units of a train job (prepare, search, calibration, refit, evaluation, ...).
+
+    The output of a completed unit is pickled in job_dir, atomically, and only then is the unit recorded as completed
+    in status.json. A unit that was interrupted halfway is therefore run again.
+    """
+
+    def __init__(self, job_dir: str | Path):
+        """Initializes the checkpoint in job_dir."""
+        self.job_dir = Path(job_dir)
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self.status_path = self.job_dir / "status.json"
+
+    def run(self, unit: str, func: Callable[[], Any]) -> Any:
+        """Returns the output of unit: from the checkpoint if it was completed before, otherwise that of func()."""
+        if self.completed(unit):
+            logger.info(f"Checkpoint {self.job_dir.name}: {unit} was completed before and is skipped")
+            return self.load(unit)
+        value = func()
+        self._save(unit, value)
+        return value
+
+    def completed(self, unit: str) -> bool:
+        """Whether unit was completed."""
+        return unit in self._read_status()
+
+    def load(self, unit: str) -> Any:
+        """Returns the output of a completed unit."""
+        with open(self.job_dir / self._read_status()[unit], "rb") as f:
+            return pickle.load(f)
+
+    def finish(self, value: Any) -> None:
+        """Records the job as completed with output value (unit 'job') and removes the outputs of its other units."""
+        self._save("job", value)
+        status = self._read_status()
+        for unit in [unit for unit in status if unit != "job"]:
+            (self.job_dir / status.pop(unit)).unlink(missing_ok=True)
+        self._write_status(status)
+
+    def _save(self, unit: str, value: Any) -> None:
+        filename = f"{unit.replace('/', '__').replace(' ', '_')}.pickle"
+        tmp_path = self.job_dir / f".{filename}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.job_dir / filename)
+
+        status = self._read_status()
+        status[unit] = filename
+        self._write_status(status)
+
+    def _read_status(self) -> dict[str, str]:
+        if not self.status_path.exists():
+            return {}
+        with open(self.status_path, "r") as f:
+            return json.load(f)
+
+    def _write_status(self, status: dict[str, str]) -> None:
+        tmp_path = self.status_path.with_name(f".{self.status_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self.status_path)
+
+
+def run_unit(checkpoint: JobCheckpoint | None, unit: str, func: Callable[[], Any]) -> Any:
+    """checkpoint.run(unit, func), or just func() without checkpoint."""
+    if checkpoint is None:
+        return func()
+    return checkpoint.run(unit, func)
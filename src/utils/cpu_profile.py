@@ -0,0 +1,226 @@
+"""CPU profiling of selected traced stages of the pipeline (see src.utils.tracing), switched on with CPU_PROFILE.
+
+CPU_PROFILE is a comma-separated list of stage names or paths, with wildcards, e.g. CPU_PROFILE=search,expand or
+CPU_PROFILE="train_job/*" (see settings). Functions can be profiled by decorating them with traced. A profiled stage
+is profiled with the CPU_PROFILER:
+- "sampling": a background thread samples the call stack of the stage every CPU_PROFILE_INTERVAL seconds. Writes
+  the collapsed stacks (the input format of flamegraph.pl and speedscope) and a flame graph as svg
+- "cprofile": the deterministic cProfile profiler. Writes a .prof file (e.g. for snakeviz), with more overhead
+
+The files are written to CPU_PROFILE_DIR per stage, named after the stage and the attributes of the stages it is part
+of (e.g. the traindate and years_ahead of its train job). Stages inside a profiled stage are part of its profile.
+Without CPU_PROFILE the profiler is not created at all, so there is no overhead.
+
+Note that only the thread that runs the stage is profiled: work that joblib does in other processes (e.g. the cross
+validation of RandomizedSearchCV with n_jobs=-1) shows up as waiting. Set PARALLELIZE to profile it in-process.
+"""
+import cProfile
+import fnmatch
+import html
+import io
+import os
+import pstats
+import sys
+import threading
+import zlib
+from collections import Counter
+from pathlib import Path
+
+from src.my_logging import logger
+from src.settings import (
+    CPU_PROFILE,
+    CPU_PROFILE_DIR,
+    CPU_PROFILE_INTERVAL,
+    CPU_PROFILER,
+)
+from src.utils import get_timestamp
+from src.utils.tracing import Span, SpanExporter
+
+REPO_DIR = str(Path(__file__).resolve().parents[2])
+TOP_FUNCTIONS = 15
+
+
+class CpuProfiler(SpanExporter):
+    """Span exporter that CPU profiles the stages that match one of patterns."""
+
+    def __init__(
+        self,
+        patterns: list[str] = CPU_PROFILE,
+        profiler: str = CPU_PROFILER,
+        interval: float = CPU_PROFILE_INTERVAL,
+        output_dir: str | Path = CPU_PROFILE_DIR,
+    ):
+        if profiler not in ("sampling", "cprofile"):
+            raise ValueError(f"CPU_PROFILER should be 'sampling' or 'cprofile', not '{profiler}'")
+        self.patterns = patterns
+        self.profiler = profiler
+        self.interval = interval
+        self.output_dir = Path(output_dir)
+        self.open_attributes = {}
+        self.active = None
+        logger.warning(f"CPU profiling ({profiler}) of stages {patterns} is on, profiles are written to {output_dir}")
+
+    def start(self, span: Span) -> None:
+        self.open_attributes[span.path] = span.attributes
+        if self.active is not None or not self._matches(span):
+            return
+
+        if self.profiler == "sampling":
+            profile = StackSampler(threading.get_ident(), self.interval)
+            profile.start()
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+        self.active = (id(span), profile)
+
+    def end(self, span: Span) -> None:
+        if self.active is not None and self.active[0] == id(span):
+            profile = self.active[1]
+            self.active = None
+            if isinstance(profile, StackSampler):
+                profile.stop()
+                self._save_stacks(span, profile.stacks)
+            else:
+                profile.disable()
+                self._save_cprofile(span, profile)
+        self.open_attributes.pop(span.path, None)
+
+    def _matches(self, span: Span) -> bool:
+        return any(
+            fnmatch.fnmatch(span.path, pattern) or fnmatch.fnmatch(span.name, pattern) for pattern in self.patterns
+        )
+
+    def _output_path(self, span: Span, suffix: str) -> Path:
+        """Path in output_dir named after the stage, the attributes of its parents and itself and a timestamp."""
+        values = [str(value) for attributes in self.open_attributes.values() for value in attributes.values()]
+        name = "_".join([span.path.replace("/", "-")] + values).replace(" ", "_")
+        path = self.output_dir / f"cpu_{name}_{get_timestamp()}{suffix}"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _save_stacks(self, span: Span, stacks: Counter) -> None:
+        if not stacks:
+            logger.info(f"No CPU samples of stage {span.path}, it took {span.duration:.3f}s")
+            return
+
+        collapsed_path = self._output_path(span, ".collapsed")
+        with open(collapsed_path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+        svg_path = collapsed_path.with_suffix(".svg")
+        with open(svg_path, "w") as f:
+            f.write(flamegraph_svg(stacks, title=f"{span.path} ({span.duration:.1f}s)"))
+
+        total = sum(stacks.values())
+        self_samples = Counter()
+        for stack, count in stacks.items():
+            self_samples[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"  {count / total:6.1%}  {function}" for function, count in self_samples.most_common(TOP_FUNCTIONS)]
+        logger.info(
+            f"CPU profile of stage {span.path}: {total} samples, saved to {svg_path} and {collapsed_path}. "
+            "Functions with most samples:\n" + "\n".join(lines)
+        )
+
+    def _save_cprofile(self, span: Span, profile: cProfile.Profile) -> None:
+        prof_path = self._output_path(span, ".prof")
+        profile.dump_stats(prof_path)
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        logger.info(f"CPU profile of stage {span.path} saved to {prof_path}:\n{stream.getvalue()}")
+
+
+class StackSampler(threading.Thread):
+    """Background thread that counts the call stacks of thread thread_id, sampled every interval seconds."""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        # Event.wait uses the monotonic clock
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+def flamegraph_svg(stacks: Counter, title: str, width: int = 1200, row_height: int = 16) -> str:
+    """Renders collapsed stacks as a flame graph: the width of every function is its share of the samples.
+
+    Hovering over a function shows its name, number of samples and percentage.
+    """
+    tree = {"name": "all", "value": 0, "children": {}}
+    for stack, count in stacks.items():
+        tree["value"] += count
+        node = tree
+        for name in stack.split(";"):
+            node = node["children"].setdefault(name, {"name": name, "value": 0, "children": {}})
+            node["value"] += count
+
+    rects, depth = [], 0
+    total = tree["value"]
+
+    def layout(node: dict, x: float, level: int) -> None:
+        nonlocal depth
+        depth = max(depth, level)
+        rects.append((node, x, level))
+        for child in sorted(node["children"].values(), key=lambda child: child["name"]):
+            layout(child, x, level + 1)
+            x += child["value"] / total * width
+
+    layout(tree, 0.0, 0)
+
+    height = (depth + 1) * row_height + 2 * row_height
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" font-family="monospace" '
+        f'font-size="{row_height - 5}">',
+        f'<text x="{width / 2}" y="{row_height}" text-anchor="middle">{html.escape(title)}</text>',
+    ]
+    for node, x, level in rects:
+        rect_width = node["value"] / total * width
+        if rect_width < 0.1:
+            continue
+        # The root is at the bottom; every function sits on top of the function that called it
+        y = height - (level + 1) * row_height
+        name = html.escape(node["name"])
+        parts.append(
+            f'<g><title>{name} ({node["value"]} samples, {node["value"] / total:.1%})</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{rect_width:.1f}" height="{row_height - 1}" '
+            f'fill="{_color(node["name"])}"/>'
+        )
+        # Roughly 7 pixels per character at this font size
+        max_chars = int(rect_width / 7)
+        if max_chars >= 3:
+            shown_chars = max_chars - 2
+            label = name if len(node["name"]) <= max_chars else html.escape(node["name"][:shown_chars]) + ".."
+            parts.append(f'<text x="{x + 2:.1f}" y="{y + row_height - 4}">{label}</text>')
+        parts.append("</g>")
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def _frame_name(code) -> str:
+    filename = code.co_filename
+    if filename.startswith(REPO_DIR):
+        filename = os.path.relpath(filename, REPO_DIR)
+    elif "site-packages/" in filename:
+        filename = filename.split("site-packages/", 1)[1]
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def _color(name: str) -> str:
+    """Warm color that is the same for every function of a file, so functions of one module look alike."""
+    module = name.rsplit("(", 1)[-1].split(":", 1)[0]
+    hue = zlib.crc32(module.encode()) % 60
+    return f"hsl({hue}, 80%, 60%)"
@@ -0,0 +1,96 @@
+"""Import-time report of an entry point, based on python -X importtime. Example:
+
+python -m src.utils.importtime src.main_predict --repeat 5 --top 15
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from src.my_logging import logger
+from src.utils import get_timestamp
+
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def measure_import_time(module: str) -> dict:
+    """Imports module in a fresh interpreter with -X importtime and parses its report.
+
+    Returns:
+        dict: total import time and the self time per imported top-level package, in seconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        check=True,
+    )
+
+    total, packages = 0, {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), match[3], match[4]
+        if len(indent) == 1:
+            # Imports at the outermost level (one space of indentation) add up to the total
+            total += cumulative_us
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    return {"total": total / 1e6, "packages": {package: us / 1e6 for package, us in packages.items()}}
+
+
+def import_time_report(module: str, repeat: int = 5, top: int = 15, output_dir: str | None = None) -> dict:
+    """Measures the cold import time of module repeat times and reports the median, overall and per package.
+
+    The first measurement is discarded, as it includes filling the bytecode and file system caches.
+    """
+    measurements = [measure_import_time(module) for _ in range(repeat + 1)][1:]
+    packages = {package for measurement in measurements for package in measurement["packages"]}
+    per_package = {
+        package: float(np.median([measurement["packages"].get(package, 0.0) for measurement in measurements]))
+        for package in packages
+    }
+
+    report = {
+        "module": module,
+        "python": sys.version.split()[0],
+        "repeat": repeat,
+        "total_seconds": float(np.median([measurement["total"] for measurement in measurements])),
+        "packages_seconds": dict(sorted(per_package.items(), key=lambda item: -item[1])[:top]),
+    }
+
+    logger.info(f"Import time of {module}: {report['total_seconds']:.2f}s (median of {repeat})")
+    for package, seconds in report["packages_seconds"].items():
+        logger.info(f"  {package:<30} {seconds:6.3f}s")
+
+    if output_dir is not None:
+        output_path = Path(output_dir) / f"importtime_{module}_{get_timestamp()}.json"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_path, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Import time report saved to {output_path}")
+
+    return report
+
+
+def get_args() -> argparse.Namespace:
+    """Parses arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("module", help="module to import, e.g. src.main_predict", type=str)
+    parser.add_argument("--repeat", help="number of measurements", type=int, default=5)
+    parser.add_argument("--top", help="number of packages to report", type=int, default=15)
+    parser.add_argument("--output-dir", help="folder to save the report as json", type=str, default="reports")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    import_time_report(args.module, repeat=args.repeat, top=args.top, output_dir=args.output_dir)
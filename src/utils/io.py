@@ -95,8 +95,11 @@ def _save_to_pkl(var, filepath: str | Path, **kwargs: int) -> None:
     allowed_suffixes = [".pickle"]
     suffix = Path(filepath).suffix
     if suffix == ".pickle":
-        with open(filepath, "wb") as fp:
+        # Write to a temporary file first, so a concurrent job never reads a partially written pickle
+        tmp_path = Path(filepath).with_name(f".{Path(filepath).name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as fp:
             pickle.dump(var, fp, **kwargs)
+        os.replace(tmp_path, filepath)
     else:
         raise ValueError(f'suffix {suffix} is not supported (only {", ".join(allowed_suffixes)})')
 
@@ -0,0 +1,209 @@
+"""Memory profiling of the traced stages of the pipeline (see src.utils.tracing), switched on with MEMORY_PROFILE=1.
+
+For every stage the profiler records:
+- the peak of the memory traced by tracemalloc (Python, numpy and pandas allocations) during the stage
+- the peak resident memory (RSS) of the process during the stage, sampled in a background thread, which includes
+  native allocations such as those of XGBoost
+- the top allocation sites at the peak of the stage (from the snapshot the sampler takes whenever traced memory
+  reaches a new high) and the top sites of the memory allocated in the stage that is still alive at its end. Sites
+  are the lines in src/ that caused the allocation (e.g. the merge in _expand_rows), not pandas or numpy internals
+
+Every top-level stage (e.g. a train job, or a predict run) gets its own report in MEMORY_PROFILE_DIR. Tracing every
+allocation makes the code considerably slower and uses extra memory, so only profile when looking for a memory issue.
+"""
+import linecache
+import os
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+from src.my_logging import logger
+from src.settings import (
+    MEMORY_PROFILE_DIR,
+    MEMORY_PROFILE_FRAMES,
+    MEMORY_PROFILE_INTERVAL,
+    MEMORY_PROFILE_TOP,
+)
+from src.utils import get_timestamp
+from src.utils.tracing import Span, SpanExporter, current_rss_mb
+
+SRC_DIR = str(Path(__file__).resolve().parents[1])
+REPO_DIR = str(Path(__file__).resolve().parents[2])
+# A new peak snapshot is taken when traced memory grows this much above the previous one
+PEAK_SNAPSHOT_GROWTH = 1.25
+# Allocations that grew less are left out of the top allocation sites
+MIN_SITE_BYTES = 10_000
+
+
+class MemoryProfiler(SpanExporter):
+    """Span exporter that measures the memory of every stage and writes a report per top-level stage.
+
+    The measurements are also set as metrics of the span (peak_traced_mb, peak_stage_rss_mb, net_allocated_mb), so
+    the other exporters log and export them too.
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path = MEMORY_PROFILE_DIR,
+        top: int = MEMORY_PROFILE_TOP,
+        frames: int = MEMORY_PROFILE_FRAMES,
+        interval: float = MEMORY_PROFILE_INTERVAL,
+    ):
+        self.output_dir = Path(output_dir)
+        self.top = top
+        self.lock = threading.Lock()
+        self.open_stages = {}
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        self.sampler = MemorySampler(interval)
+        self.sampler.start()
+        logger.warning(f"Memory profiling is on, reports are written to {self.output_dir}. This slows down the run.")
+
+    def start(self, span: Span) -> None:
+        with self.lock:
+            self._update_peaks()
+            traced, _ = tracemalloc.get_traced_memory()
+            if "/" in span.path:
+                parent_path = span.path.rsplit("/", 1)[0]
+                parent = next(stage for stage in self.open_stages.values() if stage["path"] == parent_path)
+                report_path = parent["report_path"]
+            else:
+                report_path = self.output_dir / f"memory_{_report_name(span)}_{get_timestamp()}.txt"
+
+            self.open_stages[id(span)] = {
+                "path": span.path,
+                "report_path": report_path,
+                "snapshot": tracemalloc.take_snapshot(),
+                "traced_start_mb": traced / 1e6,
+                "peak_traced_mb": traced / 1e6,
+                "rss_start_mb": current_rss_mb(),
+                "peak_rss_mb": current_rss_mb(),
+                "peak_snapshot": None,
+            }
+
+    def end(self, span: Span) -> None:
+        with self.lock:
+            self._update_peaks()
+            stage = self.open_stages.pop(id(span))
+            traced, _ = tracemalloc.get_traced_memory()
+            hotspots = {"retained": allocation_hotspots(tracemalloc.take_snapshot(), stage["snapshot"], top=self.top)}
+            if stage["peak_snapshot"] is not None:
+                hotspots["at peak"] = allocation_hotspots(stage["peak_snapshot"], stage["snapshot"], top=self.top)
+
+        span.set(
+            peak_traced_mb=round(stage["peak_traced_mb"], 1),
+            peak_stage_rss_mb=round(stage["peak_rss_mb"], 1),
+            net_allocated_mb=round(traced / 1e6 - stage["traced_start_mb"], 1),
+        )
+        self._write_report(span, stage, hotspots)
+
+    def _update_peaks(self) -> None:
+        """Adds the peaks since the previous start or end of a stage to all open stages and resets them."""
+        _, peak_traced = tracemalloc.get_traced_memory()
+        peak_rss, peak_snapshot = self.sampler.reset_peak()
+        for stage in self.open_stages.values():
+            if peak_snapshot is not None and peak_traced / 1e6 > stage["peak_traced_mb"]:
+                stage["peak_snapshot"] = peak_snapshot
+            stage["peak_traced_mb"] = max(stage["peak_traced_mb"], peak_traced / 1e6)
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], peak_rss)
+        tracemalloc.reset_peak()
+
+    def _write_report(self, span: Span, stage: dict, hotspots: dict[str, list[dict]]) -> None:
+        attributes = ", ".join(f"{key}={value}" for key, value in span.attributes.items())
+        lines = [
+            f"Stage {span.path}" + (f" ({attributes})" if attributes else "") + f": {span.duration:.1f}s",
+            f"  peak traced {stage['peak_traced_mb']:.0f} MB (start {stage['traced_start_mb']:.0f} MB), "
+            f"peak RSS {stage['peak_rss_mb']:.0f} MB (start {stage['rss_start_mb']:.0f} MB), "
+            f"net allocated {span.metrics['net_allocated_mb']:+.0f} MB",
+        ]
+        for kind, sites in sorted(hotspots.items()):
+            if not sites:
+                continue
+            lines.append(f"  Top allocation sites {kind}:")
+            for site in sites:
+                lines.append(f"  {site['size_mb']:+10.1f} MB  {site['site']}  {site['code']}")
+
+        # Nested stages end before their parent, so the report lists every stage after the stages inside it
+        path = stage["report_path"]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write("\n".join(lines) + "\n\n")
+        if "/" not in span.path:
+            logger.info(f"Memory profile of {span.path} saved to {path}")
+
+
+class MemorySampler(threading.Thread):
+    """Background thread that samples the memory of the process, to find its peak between two resets.
+
+    Keeps the peak resident memory and a tracemalloc snapshot of the highest traced memory since the last reset.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="memory-sampler", daemon=True)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peak_rss = current_rss_mb()
+        self.peak_snapshot = None
+        self.snapshot_traced = tracemalloc.get_traced_memory()[0]
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            rss = current_rss_mb()
+            traced, _ = tracemalloc.get_traced_memory()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss, rss)
+                if traced > self.snapshot_traced * PEAK_SNAPSHOT_GROWTH:
+                    self.peak_snapshot, self.snapshot_traced = tracemalloc.take_snapshot(), traced
+
+    def reset_peak(self) -> tuple[float, tracemalloc.Snapshot | None]:
+        """Returns the peak RSS in MB and the snapshot at the peak of traced memory (if any) since the last reset."""
+        rss = current_rss_mb()
+        with self.lock:
+            peak_rss, peak_snapshot = max(self.peak_rss, rss), self.peak_snapshot
+            self.peak_rss, self.peak_snapshot = rss, None
+            self.snapshot_traced = tracemalloc.get_traced_memory()[0]
+        return peak_rss, peak_snapshot
+
+
+def allocation_hotspots(snapshot: tracemalloc.Snapshot, baseline: tracemalloc.Snapshot, top: int) -> list[dict]:
+    """Returns the top allocation sites that grew most between baseline and snapshot.
+
+    The growth of every allocation is attributed to the most recent frame of its traceback in src/, so allocations
+    inside pandas, numpy or sklearn are counted at the line of the pipeline that called them.
+    """
+    # Leave out the memory of the profiler itself
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    snapshot, baseline = snapshot.filter_traces(filters), baseline.filter_traces(filters)
+
+    sites = {}
+    for stat in snapshot.compare_to(baseline, "traceback"):
+        if stat.size_diff < MIN_SITE_BYTES:
+            continue
+        frame = _site(stat.traceback)
+        sites[frame] = sites.get(frame, 0) + stat.size_diff
+
+    hotspots = []
+    for (filename, lineno), size in sorted(sites.items(), key=lambda item: -item[1])[:top]:
+        path = os.path.relpath(filename, REPO_DIR) if filename.startswith(REPO_DIR) else filename
+        hotspots.append(
+            {
+                "site": f"{path}:{lineno}",
+                "code": linecache.getline(filename, lineno).strip(),
+                "size_mb": size / 1e6,
+            }
+        )
+    return hotspots
+
+
+def _site(traceback: tracemalloc.Traceback) -> tuple[str, int]:
+    """Most recent frame of traceback in src/ (or the most recent frame, if none is)."""
+    for frame in reversed(traceback):
+        if frame.filename.startswith(SRC_DIR) and not frame.filename.endswith(("tracing.py", "memory_profile.py")):
+            return frame.filename, frame.lineno
+    return traceback[-1].filename, traceback[-1].lineno
+
+
+def _report_name(span: Span) -> str:
+    return "_".join([span.name] + [str(value).replace(" ", "_") for value in span.attributes.values()])
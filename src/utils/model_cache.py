@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+from src.my_logging import logger
+
+
+class ModelCache:
+    """Local, version-pinned cache for models downloaded from Azure Machine Learning.
+
+    A model version in Azure ML never changes, so once downloaded it can be reused by every next run. Each entry is
+    stored together with its SHA-256 checksum in index.json and is verified before it is handed out. If the cache
+    holds more than max_entries models, the least recently used ones are evicted.
+    """
+
+    def __init__(self, cache_dir: str | Path, max_entries: int):
+        """Initializes the cache in cache_dir."""
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get(self, version_name: str, version_number: str) -> Optional[Path]:
+        """Returns the path of a cached model, or None on a cache miss or a checksum mismatch."""
+        key = self._key(version_name, version_number)
+        with self._lock:
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+
+            path = self.cache_dir / entry["filename"]
+            if not path.exists() or _sha256(path) != entry["sha256"]:
+                logger.warning(f"Cached model {key} is missing or corrupt and will be downloaded again")
+                self._remove(index, key)
+                self._write_index(index)
+                return None
+
+            entry["last_used"] = time.time()
+            self._write_index(index)
+        return path
+
+    def put(self, version_name: str, version_number: str, source_path: str | Path) -> Path:
+        """Copies a downloaded model into the cache and evicts least recently used models if needed."""
+        key = self._key(version_name, version_number)
+        path = self.cache_dir / f"{key}{Path(source_path).suffix}"
+
+        # Copy to a temporary file first, so an interrupted copy never ends up as a valid cache entry
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        shutil.copyfile(source_path, tmp_path)
+        checksum = _sha256(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            index = self._read_index()
+            index[key] = {
+                "filename": path.name,
+                "sha256": checksum,
+                "size": path.stat().st_size,
+                "last_used": time.time(),
+            }
+            self._evict(index)
+            self._write_index(index)
+        return path
+
+    def _evict(self, index: dict) -> None:
+        """Removes the least recently used entries until at most max_entries remain."""
+        for key in sorted(index, key=lambda k: index[k]["last_used"])[: max(len(index) - self.max_entries, 0)]:
+            logger.info(f"Evicting model {key} from the local model cache")
+            self._remove(index, key)
+
+    def _remove(self, index: dict, key: str) -> None:
+        entry = index.pop(key)
+        (self.cache_dir / entry["filename"]).unlink(missing_ok=True)
+
+    def _read_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def _write_index(self, index: dict) -> None:
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _key(version_name: str, version_number: str) -> str:
+        return f"{version_name}-{version_number}"
+
+
+def _sha256(path: str | Path, chunk_size: int = 1 << 20) -> str:
+    """SHA-256 checksum of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
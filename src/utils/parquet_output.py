@@ -0,0 +1,101 @@
+import re
+import shutil
+from pathlib import Path
+
+import fsspec
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fsspec import AbstractFileSystem
+
+from src.columns import COL_ID_EENHEID, COL_ID_HOVK
+
+OUTPUT_SCHEMA = pa.schema(
+    [
+        (COL_ID_HOVK, pa.string()),
+        (COL_ID_EENHEID, pa.string()),
+        ("verhuiskans", pa.float32()),
+        ("voorspellingslabel", pa.dictionary(pa.int8(), pa.string())),
+        ("modelnaam", pa.dictionary(pa.int8(), pa.string())),
+        ("modelversie", pa.dictionary(pa.int8(), pa.string())),
+        ("timestamp", pa.dictionary(pa.int8(), pa.string())),
+    ]
+)
+# Audittrail deltas mark removed rows with verwijderd = True, see src/utils/audittrail.py
+AUDITTRAIL_SCHEMA = OUTPUT_SCHEMA.append(pa.field("verwijderd", pa.bool_()))
+PARTITION_COLUMN = "aantal_jaar_vooruit"
+PARTITION_PATTERN = re.compile(rf"{PARTITION_COLUMN}=(\d+)/")
+
+
+class OutputWriter:
+    """Writes outputs as a Parquet dataset partitioned by aantal_jaar_vooruit (aantal_jaar_vooruit=<n>/part-0.parquet).
+
+    The low-cardinality string columns are dictionary encoded and verhuiskans is stored as float32. Outputs can be
+    written at once or chunk by chunk (see score_in_chunks): every partition file is kept open and every write adds
+    a row group to it. The dataset is written once locally and then uploaded as is to every datalake destination.
+    """
+
+    def __init__(self, path: str | Path, schema: pa.Schema = OUTPUT_SCHEMA):
+        """Starts a new, empty dataset in folder path. An existing dataset in that folder is removed."""
+        self.path = Path(path)
+        self.schema = schema
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        self.writers: dict[int, pq.ParquetWriter] = {}
+
+    def write(self, output: pd.DataFrame) -> None:
+        """Encodes output once and appends its rows to the partition file of every horizon."""
+        horizons = output[PARTITION_COLUMN].to_numpy()
+        table = pa.Table.from_pandas(output, schema=self.schema, preserve_index=False)
+        for years_ahead in pd.unique(horizons):
+            partition = table.filter(pa.array(horizons == years_ahead))
+            self._writer(int(years_ahead)).write_table(partition)
+
+    def _writer(self, years_ahead: int) -> pq.ParquetWriter:
+        if years_ahead not in self.writers:
+            partition_path = self.path / f"{PARTITION_COLUMN}={years_ahead}"
+            partition_path.mkdir()
+            self.writers[years_ahead] = pq.ParquetWriter(
+                partition_path / "part-0.parquet",
+                self.schema,
+                compression="snappy",
+                use_dictionary=["voorspellingslabel", "modelnaam", "modelversie", "timestamp"],
+            )
+        return self.writers[years_ahead]
+
+    def close(self) -> Path:
+        """Closes all partition files and returns the folder of the dataset."""
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        return self.path
+
+    def __enter__(self) -> "OutputWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_outputs(path: str | Path, filesystem: AbstractFileSystem | None = None) -> pd.DataFrame:
+    """Reads a dataset written by OutputWriter, locally or from filesystem, including aantal_jaar_vooruit.
+
+    The files are listed and opened through the fsspec filesystem itself, so this works the same for every
+    filesystem and does not depend on how it formats the paths it lists.
+    """
+    filesystem = filesystem if filesystem is not None else fsspec.filesystem("file")
+    tables = []
+    for file in sorted(filesystem.find(str(path))):
+        match = PARTITION_PATTERN.search(file)
+        if match is None or not file.endswith(".parquet"):
+            continue
+        with filesystem.open(file, "rb") as f:
+            table = pq.read_table(f)
+        partition = pa.array(np.full(len(table), int(match[1]), dtype=np.int32))
+        tables.append(table.append_column(PARTITION_COLUMN, partition))
+
+    if not tables:
+        return pd.DataFrame(columns=[*OUTPUT_SCHEMA.names, PARTITION_COLUMN])
+    return pa.concat_tables(tables, promote_options="default").to_pandas()
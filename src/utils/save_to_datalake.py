@@ -1,11 +1,11 @@
+import functools
 import os
-from datetime import datetime
+import tempfile
+from datetime import date, datetime
 from pathlib import Path
 
 import pandas as pd
-from azureml.core import Workspace
-from azureml.core.authentication import MsiAuthentication
-from azureml.fsspec import AzureMachineLearningFileSystem
+from fsspec import AbstractFileSystem
 
 from src.my_logging import logger
 from src.settings import (
@@ -18,66 +18,130 @@ from src.settings import (
     SUBSCRIPTIONID,
     WORKSPACE_NAME,
 )
+from src.utils import get_timestamp
+from src.utils.audittrail import AuditTrail
+from src.utils.parquet_output import OutputWriter, read_outputs
+from src.utils.upload_manager import UploadManager
 
+# Every run uploads the latest outputs to a new version folder in LATEST_FOLDER. The file LATEST_POINTER in it holds the
+# name of the version to read, see upload_outputs_to_datalake
+LATEST_FOLDER = f"{OUTPUT_SUBFOLDER_LATEST_VERHUISKANS}/latest_verhuiskansen"
+LATEST_POINTER = "_latest"
 
-def save_outputs_to_datalake(df: pd.DataFrame) -> None:
-    """Saves outputs both as latest parquet and timestamped in an audittrail folder."""
 
-    _save_and_upload_as_parquet(
-        output=df,
-        local_path=OUTPUTS_DIR,
-        filename="latest_verhuiskansen",
-        datalake_path=OUTPUT_SUBFOLDER_LATEST_VERHUISKANS,
-        env="prd" if os.environ.get("OTAP") == "P" else "dev",
-    )
+def save_outputs_to_datalake(
+    df: pd.DataFrame, filesystem: AbstractFileSystem | None = None, uploads: UploadManager | None = None
+) -> UploadManager:
+    """Saves outputs both as latest parquet and in the audittrail, see upload_outputs_to_datalake.
 
-    _save_and_upload_as_parquet(
-        output=df,
-        local_path=OUTPUTS_DIR,
-        filename=f"""{datetime.now().strftime("%Y%m%d")}_verhuiskansen""",
-        datalake_path=OUTPUT_SUBFOLDER_AUDITTRAIL,
-        env="prd" if os.environ.get("OTAP") == "P" else "dev",
-    )
+    The outputs are encoded and written only once, see OutputWriter.
+    """
+    logger.info(f"Saving outputs in folder {OUTPUTS_DIR}")
+    with OutputWriter(Path(OUTPUTS_DIR) / "verhuiskansen") as writer:
+        writer.write(df)
 
-    return None
+    return upload_outputs_to_datalake(writer.path, filesystem=filesystem, uploads=uploads)
 
 
-def _save_and_upload_as_parquet(
-    output: pd.DataFrame, local_path: str, filename: str, datalake_path: str, env: str
-) -> None:
-    """Saves file as parquet and uploads it to datalake."""
-    # Save df locally as parquet
-    filename = f"{filename}.parquet"
+def upload_outputs_to_datalake(
+    local_path: str | Path, filesystem: AbstractFileSystem | None = None, uploads: UploadManager | None = None
+) -> UploadManager:
+    """Uploads a dataset written by OutputWriter both as latest parquet and to the audittrail.
 
-    logger.info(f"Saving {filename} in folder {local_path}")
-    Path(local_path).mkdir(parents=True, exist_ok=True)
+    The latest outputs are uploaded to a new version folder in LATEST_FOLDER. Only once all files arrived, the pointer
+    file LATEST_POINTER is replaced by one with the name of the new version (see _point_latest_to). Consumers that read
+    the version in the pointer (see read_latest) therefore never read a mix of old and new partitions, or partitions of
+    horizons that are no longer predicted. The audittrail only stores the changes since the previous run, see
+    AuditTrail. The files are uploaded in the background: call wait() on the returned UploadManager before the process
+    ends to make sure they all arrived and the pointer is replaced.
 
-    output.to_parquet(
-        path=Path(local_path) / filename,
-        engine="auto",
-        compression="snappy",
-        index=None,
-        partition_cols=None,
-        storage_options=None,
-    )
+    Args:
+        local_path (str | Path): folder of the dataset
+        filesystem (AbstractFileSystem | None): fsspec filesystem to upload to, e.g. fsspec.filesystem("file") to
+            test locally. By default the datastore of the environment (OTAP) is used.
+        uploads (UploadManager | None): upload manager to submit the uploads to, by default a new one
 
-    logger.info(f"Uploading {filename} to {env} datalake folder {datalake_path}")
+    Returns:
+        UploadManager: the upload manager with the pending uploads
+    """
+    env = "prd" if os.environ.get("OTAP") == "P" else "dev"
+    fs = filesystem if filesystem is not None else _fs_helper(env)
+    uploads = uploads if uploads is not None else UploadManager()
+
+    version = get_timestamp("%Y%m%d_%H%M%S_%f")
+    logger.info(f"Uploading outputs to {env} datalake folder {LATEST_FOLDER}/{version}")
+    uploads.upload_folder(local_path, f"{LATEST_FOLDER}/{version}", fs)
+    uploads.on_success(functools.partial(_point_latest_to, fs, version))
+
+    # Computing the audittrail delta overlaps with the upload of the latest outputs
+    AuditTrail(fs, OUTPUT_SUBFOLDER_AUDITTRAIL, uploads=uploads).write(local_path, day=datetime.now().date())
+    return uploads
+
+
+def read_latest(filesystem: AbstractFileSystem | None = None) -> pd.DataFrame:
+    """Reads the latest outputs: the version in the pointer file of LATEST_FOLDER, see upload_outputs_to_datalake."""
+    env = "prd" if os.environ.get("OTAP") == "P" else "dev"
+    fs = filesystem if filesystem is not None else _fs_helper(env)
+    version = _read_latest_pointer(fs)
+    if version is None:
+        raise FileNotFoundError(f"No pointer to the latest outputs in {LATEST_FOLDER}")
+    return read_outputs(f"{LATEST_FOLDER}/{version}", filesystem=fs)
+
+
+def _point_latest_to(fs: AbstractFileSystem, version: str) -> None:
+    """Replaces the pointer file of LATEST_FOLDER by one with version, and removes the versions that are not read.
+
+    The pointer is a single small file, so replacing it is one atomic write of a blob. Consumers that read the pointer
+    just before may still be reading the previous version, which is therefore only removed by the next run. Everything
+    else is removed: older versions, versions of failed uploads and the outputs of before the versioning (the single
+    file latest_verhuiskansen.parquet, the partitions directly in LATEST_FOLDER and its staging folder
+    latest_verhuiskansen_upload), so consumers cannot keep reading them by mistake.
+    """
+    previous = _read_latest_pointer(fs)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pointer = Path(tmp_dir) / LATEST_POINTER
+        pointer.write_text(version)
+        fs.upload(
+            lpath=str(pointer), rpath=f"{LATEST_FOLDER}/", recursive=False, **{"overwrite": "MERGE_WITH_OVERWRITE"}
+        )
+    logger.info(f"The latest outputs are now {LATEST_FOLDER}/{version}")
 
-    fs = _fs_helper(datalake_path, env)
-    fs.upload(
-        lpath=str(Path(local_path) / filename),
-        rpath=datalake_path,
-        recursive=False,
-        **{"overwrite": "MERGE_WITH_OVERWRITE"},
-    )
-    return None
+    for path in fs.ls(LATEST_FOLDER, detail=False):
+        if path.rstrip("/").rsplit("/", 1)[-1] not in [LATEST_POINTER, version, previous]:
+            fs.rm(path, recursive=True)
+    for old in [f"{LATEST_FOLDER}.parquet", f"{LATEST_FOLDER}_upload"]:
+        if fs.exists(old):
+            fs.rm(old, recursive=True)
+
+
+def _read_latest_pointer(fs: AbstractFileSystem) -> str | None:
+    """Returns the version in the pointer file of LATEST_FOLDER, or None if there is none yet."""
+    pointer = f"{LATEST_FOLDER}/{LATEST_POINTER}"
+    if not fs.exists(pointer):
+        return None
+    with fs.open(pointer, "rb") as f:
+        return f.read().decode().strip()
 
 
-def _fs_helper(paths: str, environment: str = "dev") -> AzureMachineLearningFileSystem:
+def read_audittrail(as_of: date, filesystem: AbstractFileSystem | None = None) -> pd.DataFrame:
+    """Rebuilds the complete outputs of the predict run of as_of (or the last run before it) from the audittrail."""
+    env = "prd" if os.environ.get("OTAP") == "P" else "dev"
+    fs = filesystem if filesystem is not None else _fs_helper(env)
+    return AuditTrail(fs, OUTPUT_SUBFOLDER_AUDITTRAIL).read(as_of)
+
+
+@functools.cache
+def _fs_helper(environment: str = "dev") -> AbstractFileSystem:
     """Helper to get filesystem in Datastores.
 
-    If environment is 'prd', the production datastore is used, otherwise the development datastore is used.
+    If environment is 'prd', the production datastore is used, otherwise the development datastore is used. The
+    filesystem is created (and authenticated) once per datastore and shared by all uploads, paths are relative to
+    the root of the datastore.
     """
+    from azureml.core import Workspace
+    from azureml.core.authentication import MsiAuthentication
+    from azureml.fsspec import AzureMachineLearningFileSystem
+
     datastorename = DATASTORENAME_PRD if environment == "prd" else DATASTORENAME_DEV
 
     try:
@@ -98,5 +162,5 @@ def _fs_helper(paths: str, environment: str = "dev") -> AzureMachineLearningFile
         )
 
     return AzureMachineLearningFileSystem(
-        f"azureml://subscriptions/{SUBSCRIPTIONID}/resourcegroups/{RGNAME}/workspaces/{WORKSPACE_NAME}/datastores/{datastorename}/paths/{paths}"  # noqa: E501
+        f"azureml://subscriptions/{SUBSCRIPTIONID}/resourcegroups/{RGNAME}/workspaces/{WORKSPACE_NAME}/datastores/{datastorename}/paths/"  # noqa: E501
     )
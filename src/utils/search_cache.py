@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, clone
+from sklearn.model_selection import GridSearchCV, ParameterSampler
+
+from src.my_logging import logger
+
+
+class SearchCache:
+    """Persistent cache of the cross-validated scores of hyperparameter candidates.
+
+    An entry is keyed by the fingerprint of the training data (X and y), the estimator (class, library version and base
+    parameters), the candidate parameters and the folds, so a rerun of an identical search after unrelated code changes
+    does not fit anything. The scores of all entries are stored in index.json; if it holds more than max_entries
+    candidates, the least recently used ones are evicted. Concurrent train jobs (PARALLELIZE) may lose each other's
+    new entries, which only costs a refit later.
+    """
+
+    def __init__(self, cache_dir: str | Path, max_entries: int):
+        """Initializes the cache in cache_dir."""
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """Returns the split scores of the keys that are in the cache."""
+        with self._lock:
+            index = self._read_index()
+            hits = {key: index[key]["scores"] for key in keys if key in index}
+            for key in hits:
+                index[key]["last_used"] = time.time()
+            if hits:
+                self._write_index(index)
+        return hits
+
+    def put_many(self, scores: dict[str, list[float]]) -> None:
+        """Stores the split scores per key and evicts least recently used entries if needed."""
+        with self._lock:
+            index = self._read_index()
+            now = time.time()
+            for key, split_scores in scores.items():
+                index[key] = {"scores": [float(score) for score in split_scores], "last_used": now}
+            self._evict(index)
+            self._write_index(index)
+
+    def _evict(self, index: dict) -> None:
+        """Removes the least recently used entries until at most max_entries remain."""
+        evicted = sorted(index, key=lambda k: index[k]["last_used"])[: max(len(index) - self.max_entries, 0)]
+        for key in evicted:
+            del index[key]
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} candidates from the search cache")
+
+    def _read_index(self) -> dict:
+        if not self.index_path.exists():
+            return {}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def _write_index(self, index: dict) -> None:
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+@dataclass
+class CachedSearchResult:
+    """Result of cached_randomized_search, with the attributes of RandomizedSearchCV that train uses."""
+
+    best_estimator_: BaseEstimator
+    best_params_: dict
+    best_score_: float
+    cache_hits: int
+    cache_misses: int
+
+
+def cached_randomized_search(
+    estimator: BaseEstimator,
+    param_distributions: dict,
+    X: pd.DataFrame,
+    y: pd.Series,
+    n_iter: int,
+    cv,
+    scoring: str,
+    random_state: int,
+    n_jobs: int,
+    cache: SearchCache,
+    fit_params: dict | None = None,
+) -> CachedSearchResult:
+    """RandomizedSearchCV(...).fit(X, y) that only cross-validates the candidates whose scores are not in cache.
+
+    The candidates are sampled as RandomizedSearchCV does (ParameterSampler with the same random_state), the missing
+    ones are cross-validated in one GridSearchCV over exactly these candidates and the best candidate (the first with
+    the highest mean score, as in RandomizedSearchCV; failed candidates, with NaN scores, rank last) is refitted on
+    X, y. cv has to split deterministically (e.g. StratifiedKFold without shuffle), because the folds are part of the
+    key through its repr. fit_params (e.g. sample_weight) are passed to every fit and are part of the key.
+
+    Raises:
+        ValueError: if every candidate failed
+    """
+    fit_params = fit_params or {}
+    candidates = list(ParameterSampler(param_distributions, n_iter=n_iter, random_state=random_state))
+    prefix = _search_fingerprint(estimator, X, y, cv, scoring, fit_params)
+    keys = [_sha256(prefix + json.dumps(candidate, sort_keys=True, default=str)) for candidate in candidates]
+
+    scores = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in scores]
+    if missing:
+        grid = GridSearchCV(
+            estimator=estimator,
+            param_grid=[{name: [value] for name, value in candidates[i].items()} for i in missing],
+            cv=cv,
+            scoring=scoring,
+            refit=False,
+            n_jobs=n_jobs,
+        )
+        grid.fit(X, y, **fit_params)
+        n_splits = cv.get_n_splits(X, y)
+        new_scores = {
+            keys[i]: [grid.cv_results_[f"split{split}_test_score"][j] for split in range(n_splits)]
+            for j, i in enumerate(missing)
+        }
+        cache.put_many(new_scores)
+        scores.update(new_scores)
+
+    mean_scores = [float(np.mean(scores[key])) for key in keys]
+    if all(np.isnan(mean_scores)):
+        raise ValueError(f"All {len(keys)} candidates of the search of {type(estimator).__name__} failed")
+    best = int(np.argmax(np.nan_to_num(mean_scores, nan=-np.inf)))
+    best_estimator = clone(estimator).set_params(**candidates[best]).fit(X, y, **fit_params)
+    return CachedSearchResult(
+        best_estimator_=best_estimator,
+        best_params_=candidates[best],
+        best_score_=mean_scores[best],
+        cache_hits=len(keys) - len(missing),
+        cache_misses=len(missing),
+    )
+
+
+def _search_fingerprint(
+    estimator: BaseEstimator, X: pd.DataFrame, y: pd.Series, cv, scoring: str, fit_params: dict
+) -> str:
+    """Fingerprint of everything but the candidate: the data and fit parameters, the estimator, folds and scoring."""
+    digest = hashlib.sha256()
+    X_values = np.ascontiguousarray(X.to_numpy() if isinstance(X, pd.DataFrame) else X)
+    digest.update(str((X_values.shape, X_values.dtype, list(getattr(X, "columns", [])))).encode())
+    digest.update(X_values.tobytes())
+    digest.update(np.ascontiguousarray(np.asarray(y)).tobytes())
+    for name in sorted(fit_params):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(np.asarray(fit_params[name])).tobytes())
+    module = type(estimator).__module__.split(".")[0]
+    version = getattr(__import__(module), "__version__", "")
+    estimator_id = f"{type(estimator).__module__}.{type(estimator).__qualname__}=={version}"
+    base_params = json.dumps(estimator.get_params(), sort_keys=True, default=str)
+    return f"{digest.hexdigest()}|{estimator_id}|{base_params}|{cv!r}|{scoring}|"
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
@@ -0,0 +1,283 @@
+"""Content-addressed cache of the outputs of the stages of the pipeline, see cached_stage.
+
+A stage decorated with cached_stage stores its output under a key that is the hash of its inputs (the arguments of the
+call), the source code it depends on, the settings it uses and the versions of the libraries. The next call with the
+same key returns the stored output instead of running the stage. So rerunning main_train after a change to
+src/train.py neither downloads nor prepares the data again, and train jobs with different inputs each get their own
+output instead of one file in the LEVEL directory that every job overwrites. The outputs are pickles in
+data/stage_cache/<level>/, written atomically; if together they take more than STAGE_CACHE_MAX_BYTES, the least
+recently used ones are evicted, across levels.
+"""
+import ast
+import hashlib
+import importlib.metadata
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import platform
+import threading
+import time
+from functools import cache, wraps
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import pandas as pd
+
+from src import settings
+from src.my_logging import logger
+from src.settings import DATA_DIR, STAGE_CACHE_MAX_BYTES, USE_STAGE_CACHE
+from src.utils.io import LEVEL
+from src.utils.tracing import stage
+
+_MISSING = object()
+
+# Libraries whose version changes the outputs of the stages or the pickles of them
+LIBRARIES = ["pandas", "numpy", "scikit-learn", "pyarrow", "duckdb", "xgboost"]
+
+
+class StageCache:
+    """Stage outputs by key, pickled in cache_dir/<level>/<key>.pickle.
+
+    The files are the entries: index.json only holds when every entry was last used (for the eviction) and the
+    fingerprints of input files by size and modification time (so an unchanged file is not hashed again). An update of
+    the index that is lost to a concurrent train job (PARALLELIZE) therefore only costs some LRU precision or a rehash.
+    """
+
+    def __init__(self, cache_dir: str | Path, max_bytes: int):
+        """Initializes the cache in cache_dir."""
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, level: LEVEL, key: str) -> Any:
+        """Returns the output stored under key, or _MISSING on a cache miss."""
+        path = self._path(level, key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return _MISSING
+
+        with self._lock:
+            index = self._read_index()
+            index["last_used"][key] = time.time()
+            self._write_index(index)
+        return value
+
+    def put(self, level: LEVEL, key: str, value: Any) -> Path:
+        """Stores value under key and evicts least recently used entries if the cache is over its budget."""
+        path = self._path(level, key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so an interrupted or concurrent write never ends up as a valid entry
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            index = self._read_index()
+            index["last_used"][key] = time.time()
+            self._evict(index)
+            self._write_index(index)
+        return path
+
+    def file_fingerprint(self, path: str | Path) -> str:
+        """Returns the SHA-256 checksum of a file, which is only calculated again if its size or mtime changed."""
+        stat = Path(path).stat()
+        name = str(Path(path).resolve())
+        with self._lock:
+            entry = self._read_index()["files"].get(name)
+        if entry is not None and (entry["size"], entry["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+            return entry["sha256"]
+
+        checksum = _sha256_file(path)
+        with self._lock:
+            index = self._read_index()
+            index["files"][name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": checksum}
+            self._write_index(index)
+        return checksum
+
+    def _evict(self, index: dict) -> None:
+        """Removes the least recently used entries until they take at most max_bytes."""
+        entries = []
+        for path in self.cache_dir.glob("*/*.pickle"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by a concurrent job
+                continue
+            entries.append((index["last_used"].get(path.stem, stat.st_mtime), stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.info(
+                f"Evicting {path.parent.name} output {path.stem[:12]} ({size / 1e6:.0f} MB) from the stage cache"
+            )
+            path.unlink(missing_ok=True)
+            total -= size
+        present = {path.stem for path in self.cache_dir.glob("*/*.pickle")}
+        index["last_used"] = {key: last_used for key, last_used in index["last_used"].items() if key in present}
+
+    def _path(self, level: LEVEL, key: str) -> Path:
+        return self.cache_dir / level.name.lower() / f"{key}.pickle"
+
+    def _read_index(self) -> dict:
+        if not self.index_path.exists():
+            return {"last_used": {}, "files": {}}
+        with open(self.index_path, "r") as f:
+            return json.load(f)
+
+    def _write_index(self, index: dict) -> None:
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+@cache
+def get_stage_cache() -> StageCache:
+    """Returns the stage cache of this process, in data/stage_cache."""
+    return StageCache(Path(DATA_DIR) / "stage_cache", STAGE_CACHE_MAX_BYTES)
+
+
+def cached_stage(level: LEVEL, code: Iterable[str] = (), settings_used: Iterable[str] = ()) -> Callable:
+    """Decorator that reuses the output of a stage function from the stage cache, see the module docstring.
+
+    The key of a call is the hash of:
+    - its arguments: files (Path) by their content, DataFrames and Series by their values, objects with a
+      cache_fingerprint method by its result and other objects by their pickle
+    - the source code of the module of the function and of the modules in code
+    - the values of the settings (names in src.settings) in settings_used
+    - the versions of Python and of the LIBRARIES
+
+    The output has to be picklable. func.__wrapped__ runs the stage without the cache, as does USE_STAGE_CACHE = False.
+
+    Args:
+        level (LEVEL): level of the output, the directory in the cache it is stored in
+        code (Iterable[str], optional): other modules the output depends on, e.g. ["src.columns"]
+        settings_used (Iterable[str], optional): names of the settings the output depends on
+    """
+    code, settings_used = list(code), list(settings_used)
+
+    def cached_stage_decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not USE_STAGE_CACHE:
+                return func(*args, **kwargs)
+
+            stage_cache = get_stage_cache()
+            with stage("stage_cache", stage=func.__qualname__) as span:
+                sources = [Path(inspect.getfile(func))] + [Path(importlib.util.find_spec(name).origin) for name in code]
+                key = stage_key(
+                    stage_cache,
+                    [
+                        func.__qualname__,
+                        sources,
+                        {name: getattr(settings, name) for name in settings_used},
+                        library_versions(),
+                        args,
+                        kwargs,
+                    ],
+                )
+                value = stage_cache.get(level, key)
+                span.set(hit=int(value is not _MISSING))
+            if value is not _MISSING:
+                logger.info(f"Stage {func.__qualname__}: reusing output {key[:12]} from the stage cache")
+                return value
+
+            value = func(*args, **kwargs)
+            stage_cache.put(level, key, value)
+            return value
+
+        return wrapper
+
+    return cached_stage_decorator
+
+
+@cache
+def library_versions() -> dict[str, str | None]:
+    """Returns the versions of Python and of the LIBRARIES, None for a library that is not installed."""
+    versions = {"python": platform.python_version()}
+    for name in LIBRARIES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def imported_source_files(module_name: str) -> list[Path]:
+    """Returns the source files of module_name and of every module of its package it imports, also indirectly.
+
+    The imports are read from the source code, so imports inside functions (e.g. of src.prepare_duckdb) count too.
+    """
+    package = module_name.split(".")[0]
+    files, todo = {}, [module_name]
+    while todo:
+        name = todo.pop()
+        if name in files:
+            continue
+        try:
+            spec = importlib.util.find_spec(name)
+        except (ModuleNotFoundError, ValueError):  # an attribute, e.g. src.settings.RANDOM_SEED
+            spec = None
+        if spec is None or spec.origin is None or not spec.origin.endswith(".py"):
+            files[name] = None
+            continue
+        files[name] = Path(spec.origin)
+        for node in ast.walk(ast.parse(files[name].read_text(encoding="utf-8"))):
+            if isinstance(node, ast.Import):
+                imported = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None and node.level == 0:
+                imported = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+            else:
+                continue
+            todo.extend(name for name in imported if name.split(".")[0] == package)
+    return sorted(path for path in files.values() if path is not None)
+
+
+def stage_key(stage_cache: StageCache, inputs: Any) -> str:
+    """Hash of inputs, see cached_stage for how every kind of input is hashed."""
+    digest = hashlib.sha256()
+    _update(digest, inputs, stage_cache)
+    return digest.hexdigest()
+
+
+def _update(digest, value: Any, stage_cache: StageCache) -> None:
+    if hasattr(value, "cache_fingerprint") and not isinstance(value, type):
+        _update(digest, value.cache_fingerprint(), stage_cache)
+    elif isinstance(value, Path):
+        digest.update(f"file:{stage_cache.file_fingerprint(value)}".encode())
+    elif isinstance(value, pd.DataFrame):
+        digest.update(f"frame:{list(value.columns)}:{value.dtypes.astype(str).tolist()}".encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, pd.Series):
+        digest.update(f"series:{value.name}:{value.dtype}".encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for name in sorted(value, key=repr):
+            _update(digest, name, stage_cache)
+            _update(digest, value[name], stage_cache)
+        digest.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"[")
+        for item in value:
+            _update(digest, item, stage_cache)
+        digest.update(b"]")
+    else:
+        digest.update(pickle.dumps(value, protocol=4))
+
+
+def _sha256_file(path: str | Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.frozen import FrozenEstimator
+from xgboost import XGBClassifier
+
+from src.columns import (
+    COL_ENDDATE,
+    COL_HOVK_STATUS,
+    COL_ID_EENHEID,
+    COL_ID_HOVK,
+    COL_LABEL_EVENT,
+    COL_STARTDATE,
+    FEATURE_COLUMNS,
+)
+from src.prepare import DataPreprocessor, create_peildatum_based_variables
+
+
+def make_synthetic_contracts(n: int, seed: int = 0, for_predict: bool = False) -> pd.DataFrame:
+    """Generates a synthetic df_combined with n huurovereenkomsten, as produced by load_data_assets.
+
+    The values are random and carry no information about real tenants. The data is only meant for local load tests
+    and benchmarks, so the structure (columns, dtypes, statuses, missing values, date ranges) resembles the real data.
+
+    Args:
+        n (int): number of huurovereenkomsten
+        seed (int): random seed
+        for_predict (bool): if True, part of the active contracts gets status 'Opgezegd' as in the predict data
+
+    Returns:
+        pd.DataFrame: synthetic df_combined
+    """
+    rng = np.random.default_rng(seed)
+    today = pd.Timestamp(datetime.today().date())
+
+    startdate = pd.Timestamp("2000-01-01") + pd.to_timedelta(
+        rng.integers(0, (today - pd.Timestamp("2000-01-01")).days, n), unit="D"
+    )
+    enddate = startdate + pd.to_timedelta(rng.exponential(3000, n).astype(int) + 30, unit="D")
+    is_actief = enddate >= today
+    # Active contracts have today as einddatum, see vhk_alle_queries_v2.sql
+    enddate = enddate.where(~is_actief, today)
+
+    status = np.where(is_actief, "Actief", "Beëindigd").astype(object)
+    if for_predict:
+        status[is_actief & (rng.random(n) < 0.03)] = "Opgezegd"
+
+    min_geboortedatum = pd.Timestamp("1940-01-01") + pd.to_timedelta(rng.integers(0, 20_000, n), unit="D")
+
+    df = pd.DataFrame(
+        {
+            "d_huurovereenkomst": pd.array(np.arange(n), dtype="Int64"),
+            COL_ID_HOVK: [f"HO{i:08d}" for i in range(n)],
+            COL_STARTDATE: startdate,
+            "startjaar_huurovereenkomst": pd.array(startdate.year, dtype="Int64"),
+            COL_ENDDATE: enddate,
+            COL_HOVK_STATUS: status,
+            "debiteur_type": rng.choice(np.array(["Particulier", "Zakelijk", np.nan], dtype=object), n),
+            COL_ID_EENHEID: [f"EH{i:08d}" for i in rng.integers(0, max(int(n * 0.8), 1), n)],
+            "aantal_kamers": pd.array(rng.integers(1, 6, n), dtype="Int64"),
+            "woningtype": rng.choice(["Eengezinswoning", "Appartement", "Studio", "Maisonnette"], n),
+            "opleverdatum": pd.to_datetime(rng.integers(1900, 2020, n).astype(str), format="%Y"),
+            "opleverjaarcategorie": rng.choice(["<1900", "1960-1969", "1970-1979", "1990-1999", ">=2010"], n),
+            "etagenummer": pd.array(rng.integers(0, 10, n), dtype="Int64"),
+            "daebnaam": rng.choice(np.array(["Daeb", "Niet Daeb", np.nan], dtype=object), n),
+            "vestigingsnaam": rng.choice([f"Vestiging {c}" for c in "ABCDEFGHIJKL"], n),
+            "lift_aanwezig_indicator": pd.array(rng.integers(0, 2, n), dtype="Int64"),
+            "gebruiksoppervlak": pd.array(rng.integers(20, 150, n), dtype="Int64"),
+            "min_geboortedatum": min_geboortedatum,
+            "max_geboortedatum": min_geboortedatum + pd.to_timedelta(rng.integers(0, 3000, n), unit="D"),
+            "percentage_man": rng.random(n),
+            "aantal_contractant_medebewoner": pd.array(rng.integers(1, 4, n), dtype="Int64"),
+        }
+    )
+    df["survival_eindjaar"] = df[COL_ENDDATE].dt.year
+
+    # Some missing values, as in the real data
+    for col in ["aantal_kamers", "gebruiksoppervlak", "min_geboortedatum", "max_geboortedatum"]:
+        df.loc[rng.random(n) < 0.02, col] = pd.NA if df[col].dtype == "Int64" else pd.NaT
+
+    return df
+
+
+def fit_synthetic_models(df: pd.DataFrame, horizons: tuple[int, ...] = (1, 2, 5), seed: int = 0) -> dict[int, dict]:
+    """Fits a preprocessing pipeline and a calibrated XGBoost model per horizon on synthetic contracts.
+
+    The models have the same structure as PRODUCTIONIZED_MODELS (see pick_model_to_productionize), so they can stand
+    in for the real models in load tests and benchmarks. Their predictions are meaningless.
+
+    Returns:
+        dict[int, dict]: per years_ahead a dict with keys model, pipeline, version_name and version_number
+    """
+    models = {}
+    for years_ahead in horizons:
+        peildatum = pd.Timestamp(datetime.today().date()) - pd.DateOffset(years=years_ahead)
+        df_peil = df.loc[(df[COL_STARTDATE] < peildatum) & (df[COL_ENDDATE] > peildatum)].copy()
+        df_peil["peildatum"] = peildatum
+        df_peil = create_peildatum_based_variables(df_peil, years_ahead=years_ahead)
+
+        preprocessor = DataPreprocessor(traindate=peildatum, testdate=peildatum, years_ahead=years_ahead)
+        preprocessor._get_preprocessing_pipeline()
+        pipeline = preprocessor.pipe
+        X = pd.DataFrame(pipeline.fit_transform(df_peil[FEATURE_COLUMNS]), columns=pipeline.get_feature_names_out())
+        y = df_peil[COL_LABEL_EVENT]
+
+        # Like the production refit in train_and_evaluate_models: fit on a numpy array, calibrate on a DataFrame
+        model = XGBClassifier(n_estimators=100, max_depth=5, random_state=seed).fit(X.to_numpy(), y)
+        model = CalibratedClassifierCV(estimator=FrozenEstimator(model), method="sigmoid", ensemble=False).fit(X, y)
+
+        models[years_ahead] = {
+            "model": model,
+            "pipeline": pipeline,
+            "version_name": "synthetic",
+            "version_number": str(years_ahead),
+        }
+
+    return models
@@ -0,0 +1,70 @@
+"""Timeline of the stages of a pipelined run, see main_train._run_jobs_pipelined.
+
+TimelineExporter collects the finished stages with the given names and save draws them as bars per thread, so it
+shows which stages of which jobs overlapped. It also logs how much: the busy time per thread and the overlap, the sum
+of the stage durations divided by the wall time of the run (1 if nothing overlapped).
+"""
+import threading
+from pathlib import Path
+
+from src.my_logging import logger
+from src.utils.tracing import Span, SpanExporter
+
+
+class TimelineExporter(SpanExporter):
+    """Collects the finished stages named in stages, to draw them in a timeline with save."""
+
+    def __init__(self, stages: list[str]):
+        """Initializes the exporter, only stages with these names end up in the timeline."""
+        self.stages = stages
+        self.spans: list[Span] = []
+        self.lock = threading.Lock()
+
+    def end(self, span: Span) -> None:
+        if span.name in self.stages:
+            with self.lock:
+                self.spans.append(span)
+
+    def summary(self) -> dict:
+        """Returns the wall time, the busy time per thread and per stage and the overlap (see the module docstring)."""
+        if not self.spans:
+            return {"wall_time": 0.0, "busy_time": {}, "stage_time": {}, "overlap": 1.0}
+        start = min(span.start_time for span in self.spans)
+        wall_time = max(span.start_time + span.duration for span in self.spans) - start
+        busy_time, stage_time = {}, {}
+        for span in self.spans:
+            busy_time[span.thread] = busy_time.get(span.thread, 0.0) + span.duration
+            stage_time[span.name] = stage_time.get(span.name, 0.0) + span.duration
+        overlap = sum(stage_time.values()) / wall_time if wall_time > 0 else 1.0
+        return {"wall_time": wall_time, "busy_time": busy_time, "stage_time": stage_time, "overlap": overlap}
+
+    def save(self, path: str | Path) -> dict:
+        """Draws the timeline to path (.png), logs the summary and returns it."""
+        import matplotlib.pyplot as plt
+
+        summary = self.summary()
+        busy = ", ".join(f"{thread} {seconds:.1f}s" for thread, seconds in summary["busy_time"].items())
+        wall_time, overlap = summary["wall_time"], summary["overlap"]
+        logger.info(f"Timeline: wall time {wall_time:.1f}s, busy per thread: {busy}, overlap {overlap:.2f}x")
+        if not self.spans:
+            return summary
+
+        start = min(span.start_time for span in self.spans)
+        threads = list(dict.fromkeys(span.thread for span in self.spans))
+        colors = dict(zip(self.stages, plt.get_cmap("Dark2").colors))
+        fig, ax = plt.subplots(figsize=(14, 1 + len(threads)))
+        for span in self.spans:
+            row = threads.index(span.thread)
+            ax.broken_barh(
+                [(span.start_time - start, span.duration)], (row - 0.4, 0.8), color=colors[span.name], edgecolor="white"
+            )
+            label = " ".join(str(value)[:10] for value in span.attributes.values())
+            ax.text(span.start_time - start, row, f"{span.name} {label}", va="center", fontsize=6, clip_on=True)
+        ax.set_yticks(range(len(threads)), threads)
+        ax.set_xlabel("seconds")
+        ax.set_title(f"Overlap {summary['overlap']:.2f}x (sum of stage durations / wall time)")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        fig.savefig(path, dpi=150, bbox_inches="tight")
+        plt.close(fig)
+        logger.info(f"Timeline saved to {path}")
+        return summary
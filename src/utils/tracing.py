@@ -0,0 +1,268 @@
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Iterator
+
+from src.my_logging import logger
+from src.settings import (
+    CPU_PROFILE,
+    MEMORY_PROFILE,
+    TRACE_DIR,
+    TRACE_EXPORTERS,
+    TRACE_RSS_INTERVAL,
+)
+from src.utils import get_timestamp
+
+
+@dataclass
+class Span:
+    """Duration, metrics and attributes of one (possibly nested) stage of the pipeline.
+
+    Metrics such as rows_in, rows_out, bytes_read and bytes_written are set by the traced code with span.set(...).
+    stage_peak_rss_mb is the peak resident memory of the process during the stage (see RssSampler) and thread is the
+    name of the thread the stage ran in.
+    """
+
+    name: str
+    path: str
+    attributes: dict = field(default_factory=dict)
+    metrics: dict = field(default_factory=dict)
+    start_time: float = 0.0
+    duration: float = 0.0
+    stage_peak_rss_mb: float = 0.0
+    status: str = "ok"
+    thread: str = field(default_factory=lambda: threading.current_thread().name)
+
+    def set(self, **metrics: int | float) -> None:
+        """Sets metrics of the stage, e.g. span.set(rows_in=len(df), rows_out=len(result))."""
+        self.metrics.update(metrics)
+
+
+class SpanExporter:
+    """Base class of span exporters: start is called when a stage starts, end when it is finished."""
+
+    def start(self, span: Span) -> None:
+        pass
+
+    def end(self, span: Span) -> None:
+        pass
+
+
+class ConsoleExporter(SpanExporter):
+    """Logs every finished stage."""
+
+    def end(self, span: Span) -> None:
+        metrics = "".join(f", {name}={value}" for name, value in span.metrics.items())
+        logger.info(
+            f"Stage {span.path} {span.status} in {span.duration:.2f}s "
+            f"(stage peak RSS {span.stage_peak_rss_mb:.0f} MB{metrics})"
+        )
+
+
+class FileExporter(SpanExporter):
+    """Appends every finished stage as a json line to a trace file (one file per run, in TRACE_DIR)."""
+
+    def __init__(self, path: str | Path | None = None):
+        self.path = Path(path) if path is not None else Path(TRACE_DIR) / f"trace_{get_timestamp()}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    def end(self, span: Span) -> None:
+        record = {**asdict(span), "pid": os.getpid()}
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+class AzureMonitorExporter(SpanExporter):
+    """Exports stages as OpenTelemetry spans and metrics, which end up in Application Insights.
+
+    Uses the tracer and meter providers set up by configure_azure_monitor (see src.my_logging). Without a connection
+    string no providers are configured and the OpenTelemetry API does nothing.
+    """
+
+    def __init__(self):
+        from opentelemetry import context, metrics, trace
+
+        self.context = context
+        self.trace = trace
+        self.tracer = trace.get_tracer("vhk")
+        meter = metrics.get_meter("vhk")
+        self.histograms = {
+            "duration": meter.create_histogram("vhk.stage.duration", unit="s"),
+            "stage_peak_rss_mb": meter.create_histogram("vhk.stage.peak_rss", unit="MB"),
+        }
+        self.open_spans = {}
+
+    def start(self, span: Span) -> None:
+        otel_span = self.tracer.start_span(span.name, attributes={"stage": span.path, **_otel_values(span.attributes)})
+        token = self.context.attach(self.trace.set_span_in_context(otel_span))
+        self.open_spans[id(span)] = (otel_span, token)
+
+    def end(self, span: Span) -> None:
+        otel_span, token = self.open_spans.pop(id(span))
+        otel_span.set_attributes({"stage_peak_rss_mb": span.stage_peak_rss_mb, **_otel_values(span.metrics)})
+        if span.status != "ok":
+            otel_span.set_status(self.trace.Status(self.trace.StatusCode.ERROR))
+        otel_span.end()
+        self.context.detach(token)
+
+        labels = {"stage": span.path, "status": span.status}
+        self.histograms["duration"].record(span.duration, labels)
+        self.histograms["stage_peak_rss_mb"].record(span.stage_peak_rss_mb, labels)
+
+
+class RssSampler(threading.Thread):
+    """Background thread that samples the resident memory of the process while stages are open.
+
+    Every sample raises stage_peak_rss_mb of all open spans, so every span gets the peak RSS during its own stage, not
+    the peak of the process so far. The RSS is that of the whole process, so stages that run at the same time in
+    other threads (e.g. in main_train._run_jobs_pipelined) count towards each other's peak. Peaks shorter than
+    interval can be missed, except at the start and end of a stage.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.open_spans: dict[int, Span] = {}
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if self.open_spans:
+                    self._update(current_rss_mb())
+
+    def open(self, span: Span) -> None:
+        """Starts sampling the peak of span."""
+        rss = current_rss_mb()
+        with self.lock:
+            self.open_spans[id(span)] = span
+            self._update(rss)
+
+    def close(self, span: Span) -> None:
+        """Stops sampling the peak of span, after a last sample."""
+        rss = current_rss_mb()
+        with self.lock:
+            self._update(rss)
+            self.open_spans.pop(id(span), None)
+
+    def _update(self, rss: float) -> None:
+        for span in self.open_spans.values():
+            span.stage_peak_rss_mb = max(span.stage_peak_rss_mb, rss)
+
+
+EXPORTERS = {"console": ConsoleExporter, "file": FileExporter, "azure": AzureMonitorExporter}
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+_exporters: list[SpanExporter] | None = None
+_rss_sampler: RssSampler | None = None
+_rss_sampler_lock = threading.Lock()
+
+
+def set_exporters(exporters: list[SpanExporter]) -> None:
+    """Replaces the exporters that receive all stages, e.g. to add a custom exporter."""
+    global _exporters
+    _exporters = list(exporters)
+
+
+def get_exporters() -> list[SpanExporter]:
+    """Returns the exporters, creating the ones in TRACE_EXPORTERS (and the profilers, if on) on first use."""
+    if _exporters is None:
+        exporters = [EXPORTERS[name]() for name in TRACE_EXPORTERS]
+        if CPU_PROFILE:
+            from src.utils.cpu_profile import CpuProfiler
+
+            exporters.append(CpuProfiler())
+        if MEMORY_PROFILE:
+            from src.utils.memory_profile import MemoryProfiler
+
+            # Last, so it ends every stage first and the other exporters receive its memory metrics
+            exporters.append(MemoryProfiler())
+        set_exporters(exporters)
+    return _exporters
+
+
+def get_rss_sampler() -> RssSampler:
+    """Returns the RssSampler of this process, starting it on first use."""
+    global _rss_sampler
+    with _rss_sampler_lock:
+        if _rss_sampler is None:
+            _rss_sampler = RssSampler(TRACE_RSS_INTERVAL)
+            _rss_sampler.start()
+    return _rss_sampler
+
+
+@contextmanager
+def stage(name: str, **attributes: str | int | float) -> Iterator[Span]:
+    """Traces a stage of the pipeline: its duration, peak memory and the metrics set on the yielded span.
+
+    Stages can be nested; the path of a nested stage includes its parents, e.g. 'predict/score'. Usage:
+
+    with stage("score", years_ahead=1) as span:
+        span.set(rows_in=len(df))
+        ...
+    """
+    parent = _current_span.get()
+    span = Span(name=name, path=f"{parent.path}/{name}" if parent is not None else name, attributes=attributes)
+    token = _current_span.set(span)
+    exporters = get_exporters()
+    for exporter in exporters:
+        exporter.start(span)
+
+    rss_sampler = get_rss_sampler()
+    rss_sampler.open(span)
+    span.start_time = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span.status = "error"
+        raise
+    finally:
+        span.duration = time.perf_counter() - t0
+        rss_sampler.close(span)
+        _current_span.reset(token)
+        for exporter in reversed(exporters):
+            exporter.end(span)
+
+
+def traced(name: str, **attributes: str | int | float) -> Callable:
+    """Decorator that traces every call of a function as a stage, see stage."""
+
+    def traced_decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name, **attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return traced_decorator
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    """Current resident memory of this process, in MB (the peak so far where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except OSError:
+        return peak_rss_mb()
+
+
+def _otel_values(values: dict) -> dict:
+    """OpenTelemetry attributes only accept str, bool, int and float."""
+    return {key: value if isinstance(value, (str, bool, int, float)) else str(value) for key, value in values.items()}
@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable
+
+from fsspec import AbstractFileSystem
+
+from src.my_logging import logger
+from src.settings import UPLOAD_BACKOFF_SECONDS, UPLOAD_MAX_RETRIES, UPLOAD_MAX_WORKERS
+
+
+class UploadManager:
+    """Uploads files to (datalake) filesystems concurrently in background threads.
+
+    Every file is a separate upload that is retried with exponential backoff when it fails. Submitting returns
+    immediately, so the caller can continue while the uploads drain; wait() blocks until all submitted uploads are
+    done and raises if any of them failed after all retries. Steps that may only run once the uploads arrived (e.g.
+    swapping an uploaded folder in, see upload_outputs_to_datalake) are registered with on_success and run by wait().
+    Used as a context manager, wait() is called on exit.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = UPLOAD_MAX_WORKERS,
+        max_retries: int = UPLOAD_MAX_RETRIES,
+        backoff_seconds: float = UPLOAD_BACKOFF_SECONDS,
+    ):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upload")
+        self.futures: list[Future] = []
+        self.callbacks: list[Callable[[], None]] = []
+        self.lock = threading.Lock()
+        self.uploaded_bytes = 0
+        self.t_start = None
+
+    def upload_file(self, local_file: str | Path, remote_folder: str, filesystem: AbstractFileSystem) -> Future:
+        """Submits the upload of local_file into remote_folder on filesystem."""
+        future = self.executor.submit(self._upload_with_retries, Path(local_file), remote_folder, filesystem)
+        with self.lock:
+            self.t_start = self.t_start or time.perf_counter()
+            self.futures.append(future)
+        return future
+
+    def upload_folder(self, local_path: str | Path, remote_folder: str, filesystem: AbstractFileSystem) -> list[Future]:
+        """Submits the upload of every file in local_path (recursively) into remote_folder, keeping the structure."""
+        local_path = Path(local_path)
+        futures = []
+        for local_file in sorted(local_path.rglob("*")):
+            if local_file.is_file():
+                subfolder = local_file.parent.relative_to(local_path).as_posix()
+                folder = remote_folder if subfolder == "." else f"{remote_folder}/{subfolder}"
+                futures.append(self.upload_file(local_file, folder, filesystem))
+        return futures
+
+    def on_success(self, callback: Callable[[], None]) -> None:
+        """Registers callback to be called by the next wait(), after all uploads submitted before it succeeded."""
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def wait(self) -> int:
+        """Blocks until all submitted uploads are done, calls the on_success callbacks and returns the bytes uploaded.
+
+        Raises:
+            RuntimeError: if any upload still failed after all retries (the callbacks are then not called)
+        """
+        with self.lock:
+            futures, self.futures = self.futures, []
+            callbacks, self.callbacks = self.callbacks, []
+        if not futures:
+            for callback in callbacks:
+                callback()
+            return 0
+
+        t0 = time.perf_counter()
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+
+        duration = time.perf_counter() - self.t_start
+        logger.info(
+            f"{len(futures) - len(errors)} of {len(futures)} uploads finished: {self.uploaded_bytes / 1e6:.1f} MB in "
+            f"{duration:.1f}s ({self.uploaded_bytes / 1e6 / max(duration, 1e-9):.1f} MB/s), "
+            f"of which {time.perf_counter() - t0:.1f}s spent waiting"
+        )
+        uploaded_bytes, self.uploaded_bytes, self.t_start = self.uploaded_bytes, 0, None
+        if errors:
+            raise RuntimeError(f"{len(errors)} upload(s) failed, first error: {errors[0]}") from errors[0]
+        for callback in callbacks:
+            callback()
+        return uploaded_bytes
+
+    def shutdown(self) -> int:
+        """Waits for all uploads, stops the upload threads and returns the number of bytes uploaded since wait()."""
+        try:
+            return self.wait()
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self) -> "UploadManager":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+    def _upload_with_retries(self, local_file: Path, remote_folder: str, filesystem: AbstractFileSystem) -> None:
+        size = local_file.stat().st_size
+        for attempt in range(self.max_retries + 1):
+            t0 = time.perf_counter()
+            try:
+                filesystem.makedirs(remote_folder, exist_ok=True)
+                filesystem.upload(
+                    lpath=str(local_file),
+                    rpath=f"{remote_folder}/",
+                    recursive=False,
+                    **{"overwrite": "MERGE_WITH_OVERWRITE"},
+                )
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Upload of {local_file} to {remote_folder} failed after {attempt + 1} attempts: {e}")
+                    raise
+                backoff = self.backoff_seconds * 2**attempt
+                logger.warning(f"Upload of {local_file} to {remote_folder} failed ({e}), retrying in {backoff:.0f}s..")
+                time.sleep(backoff)
+
+        duration = time.perf_counter() - t0
+        with self.lock:
+            self.uploaded_bytes += size
+        logger.info(
+            f"Uploaded {local_file.name} to {remote_folder}: {size / 1e6:.1f} MB in {duration:.2f}s "
+            f"({size / 1e6 / max(duration, 1e-9):.1f} MB/s)"
+        )
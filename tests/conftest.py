@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# src.my_logging starts a log file in logs/ of the working directory on import, unless a run already has one
+os.environ.setdefault("VHK_LOG_FILE", os.path.join(tempfile.mkdtemp(prefix="vhk_tests_"), "run.txt"))
+# src.utils.tracing writes the trace files of the traced stages to logs/ of the working directory
+os.environ.setdefault("VHK_TRACE_DIR", tempfile.mkdtemp(prefix="vhk_tests_trace_"))
@@ -0,0 +1,49 @@
+from datetime import date
+
+import fsspec
+import numpy as np
+import pytest
+
+from src.utils.audittrail import AuditTrail
+from src.utils.parquet_output import OutputWriter
+from src.utils.upload_manager import UploadManager
+from tests.test_save_to_datalake import make_outputs, normalize
+
+
+@pytest.fixture
+def trail(tmp_path):
+    with UploadManager() as uploads:
+        yield AuditTrail(fsspec.filesystem("file"), str(tmp_path / "audittrail"), uploads=uploads)
+
+
+def write(trail: AuditTrail, df, day: date, path) -> str:
+    with OutputWriter(path) as writer:
+        writer.write(df)
+    kind = trail.write(writer.path, day=day)
+    trail.uploads.wait()
+    return kind
+
+
+def test_read_rebuilds_every_day(trail, tmp_path):
+    first = make_outputs([1, 5])
+    second = make_outputs([1, 5], seed=1).iloc[10:]  # contracts 0-9 ended
+    second.loc[second.index[:5], "verhuiskans"] = first.loc[second.index[:5], "verhuiskans"] + 1e-4
+
+    assert write(trail, first, date(2025, 1, 1), tmp_path / "outputs") == "snapshot"
+    assert write(trail, second, date(2025, 1, 2), tmp_path / "outputs") == "delta"
+
+    np.testing.assert_allclose(
+        normalize(trail.read(date(2025, 1, 2)))["verhuiskans"], normalize(second)["verhuiskans"], atol=trail.tolerance
+    )
+    assert len(trail.read(date(2025, 1, 2))) == len(second)
+    assert len(trail.read(date(2025, 1, 1))) == len(first)
+
+
+@pytest.mark.parametrize("key", ["duplicated", "missing"])
+def test_write_rejects_invalid_keys(trail, tmp_path, key):
+    df = make_outputs([1])
+    df.loc[1, "bk_huurovereenkomst"] = df.loc[0, "bk_huurovereenkomst"] if key == "duplicated" else None
+
+    with pytest.raises(ValueError, match="key|without"):
+        write(trail, df, date(2025, 1, 1), tmp_path / "outputs")
+    assert trail.entries() == []
@@ -0,0 +1,55 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from sklearn.calibration import CalibratedClassifierCV
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.frozen import FrozenEstimator
+from xgboost import XGBClassifier
+
+from src.columns import COL_ENDDATE, COL_LABEL_EVENT, COL_STARTDATE, FEATURE_COLUMNS
+from src.compiled_scorer import compare_with_sklearn, compile_scorer
+from src.prepare import DataPreprocessor, create_peildatum_based_variables
+from src.utils.synthetic import make_synthetic_contracts
+
+
+@pytest.fixture(scope="module")
+def train_set() -> tuple[pd.DataFrame, object, pd.DataFrame, pd.Series]:
+    """Active contracts on a peildatum one year ago, the fitted preprocessing pipeline and its X and y."""
+    df = make_synthetic_contracts(3_000, seed=0)
+    peildatum = pd.Timestamp(datetime.today().date()) - pd.DateOffset(years=1)
+    df = df.loc[(df[COL_STARTDATE] < peildatum) & (df[COL_ENDDATE] > peildatum)].copy()
+    df["peildatum"] = peildatum
+    df = create_peildatum_based_variables(df, years_ahead=1)
+
+    preprocessor = DataPreprocessor(traindate=peildatum, testdate=peildatum, years_ahead=1)
+    preprocessor._get_preprocessing_pipeline()
+    pipeline = preprocessor.pipe
+    X = pd.DataFrame(pipeline.fit_transform(df[FEATURE_COLUMNS]), columns=pipeline.get_feature_names_out())
+    return df, pipeline, X, df[COL_LABEL_EVENT]
+
+
+def fit_estimator(algorithm: str, X: pd.DataFrame, y: pd.Series) -> object:
+    if algorithm == "RandomForestClassifier":
+        return RandomForestClassifier(n_estimators=20, max_depth=6, random_state=0).fit(X, y)
+    # As in train: XGBoost is fitted on a numpy array, as a category like '<1900' is no valid XGBoost feature name
+    if algorithm == "XGBoostClassifier early stopping":
+        half = len(X) // 2
+        model = XGBClassifier(n_estimators=200, max_depth=3, early_stopping_rounds=5, random_state=0)
+        model.fit(X.to_numpy()[:half], y[:half], eval_set=[(X.to_numpy()[half:], y[half:])], verbose=False)
+        assert model.best_iteration + 1 < model.n_estimators
+        return model
+    return XGBClassifier(n_estimators=50, max_depth=4, random_state=0).fit(X.to_numpy(), y)
+
+
+@pytest.mark.parametrize(
+    "algorithm", ["XGBoostClassifier", "XGBoostClassifier early stopping", "RandomForestClassifier"]
+)
+@pytest.mark.parametrize("calibration_method", ["no calibration", "sigmoid", "isotonic"])
+def test_compiled_scorer_equals_sklearn(train_set, algorithm, calibration_method):
+    df, pipeline, X, y = train_set
+    model = fit_estimator(algorithm, X, y)
+    if calibration_method != "no calibration":
+        model = CalibratedClassifierCV(FrozenEstimator(model), method=calibration_method, ensemble=False).fit(X, y)
+
+    assert compare_with_sklearn(compile_scorer(pipeline, model), pipeline, model, df, atol=1e-5) <= 1e-5
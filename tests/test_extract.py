@@ -0,0 +1,223 @@
+import random
+import sqlite3
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from src.extract import IncrementalExtractor, _to_base_types, derive_vhk_alle_queries
+
+DM_GOLD_TABLES = """
+CREATE TABLE dm_gold.f_huurovereenkomst (
+    d_dag TEXT, d_huurovereenkomst INT, d_eenheid INT, d_debiteur INT, "d_dag!huurovereenkomst_begindatum" TEXT,
+    "d_dag!huurovereenkomst_einddatum" TEXT, "d_huurklasse!aanvangshuur" INT, aanvangshuurbedrag REAL
+);
+CREATE TABLE dm_gold.d_huurovereenkomst (id INT, bk_huurovereenkomst TEXT, huurovereenkomst_statusnaam TEXT);
+CREATE TABLE dm_gold.d_eenheid (
+    id INT, bk_eenheid TEXT, eenheidnaam TEXT, eenheiddetailsoortnaam TEXT, aantal_kamers INT, woningtype TEXT,
+    opleverjaar INT, gemeentenaam TEXT, cbs_wijknaam TEXT, cbs_buurtnaam TEXT, etagenummer INT,
+    lift_aanwezig_indicator TEXT, gebruiksoppervlak REAL, eenheidsoortnaam TEXT, woonvormnaam TEXT
+);
+CREATE TABLE dm_gold.d_debiteur (id INT, debiteur_type TEXT);
+CREATE TABLE dm_gold.f_eenheid (d_dag TEXT, d_eenheid INT, d_daeb INT, d_vestiging INT);
+CREATE TABLE dm_gold.d_daeb (id INT, daebnaam TEXT);
+CREATE TABLE dm_gold.d_vestiging (id INT, vestigingsnaam TEXT);
+CREATE TABLE dm_gold.f_contactpersoon_huurovereenkomst (
+    d_dag TEXT, d_huurovereenkomst INT, d_relatie INT, d_relatierol_huurovereenkomst INT, "d_dag!begindatum" TEXT
+);
+CREATE TABLE dm_gold.d_relatie (id INT, geboortedatum TEXT, geslachtsnaam TEXT);
+CREATE TABLE dm_gold.d_relatierol_huurovereenkomst (id INT, relatierolnaam TEXT);
+CREATE TABLE dm_gold.d_huurklasse (id INT, huurklasse_code TEXT);
+"""
+STATUSES = ["Actief", "Beëindigd", "Historisch", "Opgezegd", "Voorlopig"]
+NO_ENDDATE = "2999-12-31"
+
+
+class DmGold:
+    """SQLite stand-in of the dm_gold tables that vhk_alle_queries_v2 reads, with snapshots of f_huurovereenkomst."""
+
+    def __init__(self, n_contracts: int = 500, n_units: int = 300, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("ATTACH ':memory:' AS dm_gold")
+        self.connection.executescript(DM_GOLD_TABLES)
+        self.n_units = n_units
+        self._insert("d_debiteur", [(1, "Particulier"), (2, "(Onbekend)")])
+        self._insert("d_daeb", [(1, "DAEB"), (2, "NIETDAEB")])
+        self._insert("d_vestiging", [(1, "Noord"), (2, "(Leeg)")])
+        self._insert("d_relatierol_huurovereenkomst", [(1, "Contractant"), (2, "Medebewoner"), (3, "Anders")])
+        self._insert("d_huurklasse", [(1, "A"), (2, "B")])
+        self._insert(
+            "d_eenheid",
+            [
+                (
+                    i,
+                    f"E{i}",
+                    f"eenheid {i}",
+                    "flat",
+                    self.rng.randint(1, 5),
+                    "Appartement",
+                    self.rng.choice([0, 1850, 1930, 1975, 2015]),
+                    "Amsterdam",
+                    "wijk",
+                    "buurt",
+                    self.rng.randint(0, 8),
+                    self.rng.choice(["Ja", "Nee"]),
+                    self.rng.uniform(20, 120),
+                    self.rng.choice(["Woningen", "Woonruimte", "Parkeren"]),
+                    "Woningen",
+                )
+                for i in range(1, n_units + 1)
+            ],
+        )
+
+        self.contracts = {}
+        self.new_contacts = []
+        self.n_relaties = 0
+        for _ in range(n_contracts):
+            status = self.rng.choice(STATUSES)
+            einddatum = NO_ENDDATE if status == "Actief" else self._date(date(2015, 1, 1), date(2027, 6, 1))
+            self.add_contract(status, self._date(date(2000, 1, 1), date(2026, 1, 1)), einddatum)
+
+    def add_contract(self, status: str, begindatum: str, einddatum: str) -> int:
+        """Adds a contract with one or two contact persons, which are in the warehouse from the next snapshot."""
+        i = len(self.contracts) + 1
+        self.contracts[i] = {
+            "d_eenheid": self.rng.randint(1, self.n_units),
+            "d_debiteur": self.rng.choice([1, 2]),
+            "begindatum": begindatum,
+            "einddatum": einddatum,
+            "d_huurklasse": self.rng.choice([1, 2]),
+            "aanvangshuurbedrag": self.rng.choice([500.0, 700.0, None]),
+        }
+        self._insert("d_huurovereenkomst", [(i, f"H{i}", status)])
+        for _ in range(self.rng.randint(1, 2)):
+            self.n_relaties += 1
+            geboortedatum = self.rng.choice([self._date(date(1940, 1, 1), date(2005, 1, 1)), "1900-01-01", NO_ENDDATE])
+            self._insert("d_relatie", [(self.n_relaties, geboortedatum, self.rng.choice(["Man", "Vrouw"]))])
+            self.new_contacts.append((i, self.n_relaties, self.rng.choice([1, 2, 3]), begindatum))
+        return i
+
+    def add_snapshot(self, d_dag: str) -> None:
+        """Adds a snapshot of f_huurovereenkomst and f_eenheid on d_dag.
+
+        The contact persons of the contracts added since the previous snapshot are added to
+        f_contactpersoon_huurovereenkomst with this d_dag. vhk_alle_queries_v2 joins them on d_dag without selecting
+        a snapshot, so adding them to every snapshot would count them once per snapshot.
+        """
+        self._insert(
+            "f_huurovereenkomst",
+            [
+                (
+                    d_dag,
+                    i,
+                    c["d_eenheid"],
+                    c["d_debiteur"],
+                    c["begindatum"],
+                    c["einddatum"],
+                    c["d_huurklasse"],
+                    c["aanvangshuurbedrag"],
+                )
+                for i, c in self.contracts.items()
+            ],
+        )
+        self._insert("f_eenheid", [(d_dag, i, 1 + i % 2, 1 + i % 2) for i in range(1, self.n_units + 1)])
+        if self.new_contacts:
+            self._insert("f_contactpersoon_huurovereenkomst", [(d_dag, *contact) for contact in self.new_contacts])
+        self.new_contacts = []
+        self.connection.commit()
+
+    def _insert(self, table: str, rows: list[tuple]) -> None:
+        placeholders = ",".join("?" * len(rows[0]))
+        self.connection.executemany(f"INSERT INTO dm_gold.{table} VALUES ({placeholders})", rows)
+
+    def _date(self, start: date, end: date) -> str:
+        return (start + timedelta(days=self.rng.randint(0, (end - start).days))).isoformat()
+
+
+@pytest.fixture
+def dm_gold():
+    dm_gold = DmGold()
+    dm_gold.add_snapshot("2026-10-18")
+    return dm_gold
+
+
+def change_contracts(dm_gold: DmGold) -> None:
+    """Ends, moves, deletes and adds contracts, and adds the next snapshot."""
+    contracts = list(dm_gold.contracts)
+    for i in [i for i in contracts if dm_gold.contracts[i]["einddatum"] == NO_ENDDATE][:20]:
+        dm_gold.contracts[i]["einddatum"] = "2026-11-01"
+    for i in contracts[100:110]:
+        dm_gold.contracts[i]["d_eenheid"] = dm_gold.rng.randint(1, dm_gold.n_units)
+    for i in contracts[200:205]:
+        del dm_gold.contracts[i]
+    for _ in range(15):
+        dm_gold.add_contract("Actief", "2026-10-01", NO_ENDDATE)
+    dm_gold.add_snapshot("2026-10-19")
+
+
+def sort(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values("d_huurovereenkomst").reset_index(drop=True)
+
+
+def test_incremental_equals_full_refresh(dm_gold, tmp_path):
+    extractor = IncrementalExtractor(dm_gold.connection, cache_path=tmp_path / "incremental" / "basis.parquet")
+    extractor.extract(now=datetime(2026, 10, 19, 9))
+    change_contracts(dm_gold)
+
+    incremental = extractor.extract(now=datetime(2026, 10, 20, 9))
+    full = IncrementalExtractor(dm_gold.connection, cache_path=tmp_path / "full" / "basis.parquet").extract(
+        now=datetime(2026, 10, 20, 9)
+    )
+
+    assert extractor._read_state()["last_full_refresh"] == "2026-10-19"
+    assert len(incremental) > 0
+    pd.testing.assert_frame_equal(sort(incremental), sort(full))
+
+
+def test_rerun_without_new_snapshot_queries_nothing(dm_gold, tmp_path, monkeypatch):
+    extractor = IncrementalExtractor(dm_gold.connection, cache_path=tmp_path / "basis.parquet")
+    now = datetime(2026, 10, 19, 9)
+    first = extractor.extract(now=now)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("queried the warehouse without a new snapshot")
+
+    monkeypatch.setattr(extractor, "_query", fail)
+    pd.testing.assert_frame_equal(extractor.extract(now=now), first)
+
+
+def test_full_refresh_when_the_watermark_snapshot_is_gone(dm_gold, tmp_path):
+    extractor = IncrementalExtractor(dm_gold.connection, cache_path=tmp_path / "basis.parquet")
+    extractor.extract(now=datetime(2026, 10, 19, 9))
+    change_contracts(dm_gold)
+    dm_gold.connection.execute("DELETE FROM dm_gold.f_huurovereenkomst WHERE d_dag = '2026-10-18'")
+
+    extractor.extract(now=datetime(2026, 10, 20, 9))
+    assert extractor._read_state()["last_full_refresh"] == "2026-10-20"
+
+
+def test_derived_enddate_follows_vhk_alle_queries(dm_gold, tmp_path):
+    extractor = IncrementalExtractor(dm_gold.connection, cache_path=tmp_path / "basis.parquet")
+    now = pd.Timestamp(datetime(2026, 10, 19, 9))
+    df = extractor.extract(now=now)
+
+    # The CASE of survival_hovk_einddatum and the filters on it in vhk_alle_queries_v2.sql, row by row
+    expected = {}
+    for _, row in _to_base_types(pd.read_parquet(extractor.cache_path)).iterrows():
+        einddatum, status = row["huurovereenkomst_einddatum"], row["huurovereenkomst_statusnaam"]
+        if status == "Actief" and einddatum > now:
+            survival_einddatum = now
+        elif status in ("Beëindigd", "Historisch") and einddatum < now + pd.Timedelta(days=31):
+            survival_einddatum = einddatum
+        elif status == "Opgezegd" and einddatum > now + pd.DateOffset(months=3):
+            survival_einddatum = now
+        elif status in ("Opgezegd", "Beëindigd") and einddatum <= now + pd.DateOffset(months=3):
+            survival_einddatum = einddatum
+        else:
+            continue
+        if not (status == "Actief" and einddatum < now) and survival_einddatum >= pd.Timestamp("2023-01-01"):
+            expected[row["d_huurovereenkomst"]] = survival_einddatum
+
+    assert df.set_index("d_huurovereenkomst")["survival_hovk_einddatum"].to_dict() == expected
+    assert derive_vhk_alle_queries(_to_base_types(pd.read_parquet(extractor.cache_path)), now).equals(df)
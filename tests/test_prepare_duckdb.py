@@ -0,0 +1,24 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from src.prepare_duckdb import compare_engines
+from src.utils.synthetic import make_synthetic_contracts
+
+
+@pytest.fixture(scope="module")
+def df_combined() -> pd.DataFrame:
+    return make_synthetic_contracts(2_000, seed=0)
+
+
+@pytest.mark.parametrize("years_ahead", [1, 2, 5])
+def test_duckdb_engine_equals_pandas(df_combined, years_ahead):
+    traindate = datetime(datetime.today().year - years_ahead - 1, 1, 1)
+    compare_engines(df_combined, traindate=traindate, years_ahead=years_ahead)
+
+
+def test_duckdb_engine_equals_pandas_with_duplicate_contracts(df_combined):
+    # The pandas merge repeats the rows of a contract id that occurs more than once, in its own order
+    df = pd.concat([df_combined, df_combined.iloc[::50]], ignore_index=True)
+    compare_engines(df, traindate=datetime(datetime.today().year - 2, 1, 1), years_ahead=1)
@@ -0,0 +1,98 @@
+from datetime import date
+
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.settings import OUTPUT_SUBFOLDER_LATEST_VERHUISKANS
+from src.utils.save_to_datalake import (
+    LATEST_FOLDER,
+    LATEST_POINTER,
+    read_audittrail,
+    read_latest,
+    save_outputs_to_datalake,
+)
+
+
+def make_outputs(horizons: list[int], n_contracts: int = 50, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    parts = []
+    for years_ahead in horizons:
+        parts.append(
+            pd.DataFrame(
+                {
+                    "bk_huurovereenkomst": [f"HOVK{i:05d}" for i in range(n_contracts)],
+                    "bk_eenheid": [f"E{i:05d}" for i in range(n_contracts)],
+                    "verhuiskans": rng.random(n_contracts).astype(np.float32),
+                    "aantal_jaar_vooruit": years_ahead,
+                    "voorspellingslabel": f"binnen {years_ahead} jaar",
+                    "modelnaam": "flat-slide",
+                    "modelversie": "44",
+                    "timestamp": "2025-01-01 06:00:00",
+                }
+            )
+        )
+    return pd.concat(parts, ignore_index=True)
+
+
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    df = df[make_outputs([1], n_contracts=1).columns].astype({"aantal_jaar_vooruit": int})
+    for col in ["voorspellingslabel", "modelnaam", "modelversie", "timestamp"]:
+        df[col] = df[col].astype(str)
+    return df.sort_values(["aantal_jaar_vooruit", "bk_huurovereenkomst"]).reset_index(drop=True)
+
+
+@pytest.fixture
+def fs(tmp_path, monkeypatch):
+    # The outputs and the datalake folders are relative paths, so both end up in tmp_path
+    monkeypatch.chdir(tmp_path)
+    return fsspec.filesystem("file")
+
+
+def test_outputs_round_trip(fs):
+    df = make_outputs([1, 2, 5])
+    save_outputs_to_datalake(df, filesystem=fs).shutdown()
+
+    pd.testing.assert_frame_equal(normalize(read_latest(filesystem=fs)), normalize(df))
+    pd.testing.assert_frame_equal(normalize(read_audittrail(date.today(), filesystem=fs)), normalize(df))
+
+
+def names(fs, folder: str) -> list[str]:
+    return sorted(path.rstrip("/").rsplit("/", 1)[-1] for path in fs.ls(folder, detail=False))
+
+
+def test_latest_is_replaced_as_a_whole(fs):
+    # The outputs of before the versioning: a single file and partitions directly in the latest folder
+    for old in [f"{LATEST_FOLDER}.parquet", f"{LATEST_FOLDER}/aantal_jaar_vooruit=1/part-0.parquet"]:
+        fs.makedirs(old.rsplit("/", 1)[0], exist_ok=True)
+        with fs.open(old, "wb") as f:
+            f.write(b"old")
+
+    versions = []
+    for seed, horizons in enumerate([[1, 2, 5], [1, 2, 5], [1, 2]]):
+        df = make_outputs(horizons, seed=seed)
+        save_outputs_to_datalake(df, filesystem=fs).shutdown()
+        with fs.open(f"{LATEST_FOLDER}/{LATEST_POINTER}", "rb") as f:
+            versions.append(f.read().decode())
+
+    pd.testing.assert_frame_equal(normalize(read_latest(filesystem=fs)), normalize(df))
+    # The previous version is kept for consumers that are still reading it, older ones are removed
+    assert names(fs, LATEST_FOLDER) == sorted([LATEST_POINTER, *versions[1:]])
+    assert names(fs, OUTPUT_SUBFOLDER_LATEST_VERHUISKANS) == ["latest_verhuiskansen"]
+
+
+def test_latest_is_kept_if_an_upload_fails(fs, monkeypatch):
+    df = make_outputs([1, 2, 5])
+    save_outputs_to_datalake(df, filesystem=fs).shutdown()
+
+    def failing_upload(*args, **kwargs):
+        raise OSError("datalake unavailable")
+
+    monkeypatch.setattr(fs, "upload", failing_upload)
+    uploads = save_outputs_to_datalake(make_outputs([1], seed=1), filesystem=fs)
+    uploads.backoff_seconds = 0
+    with pytest.raises(RuntimeError):
+        uploads.shutdown()
+
+    pd.testing.assert_frame_equal(normalize(read_latest(filesystem=fs)), normalize(df))